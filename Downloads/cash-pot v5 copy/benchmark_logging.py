@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Benchmark request latency with debug logging enabled versus disabled
+"""
+
+import requests
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+def login(backend_url, username, password):
+    """Log in once and return the access token"""
+    response = requests.post(
+        f"{backend_url}/api/auth/login",
+        json={"username": username, "password": password},
+        timeout=30
+    )
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+def set_log_levels(backend_url, token, levels):
+    response = requests.put(
+        f"{backend_url}/api/admin/logging",
+        json={"levels": levels},
+        headers={"Authorization": f"Bearer {token}"},
+        timeout=10
+    )
+    response.raise_for_status()
+    return response.json()
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of a list of samples"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def timed_request(session, method, url, headers, body):
+    started = time.perf_counter()
+    session.request(method, url, headers=headers, json=body, timeout=30)
+    return (time.perf_counter() - started) * 1000
+
+def measure(backend_url, token, requests_count, concurrency):
+    """Hit endpoints that log on every request and return their latencies"""
+    headers = {"Authorization": f"Bearer {token}"}
+    session = requests.Session()
+    cabinets = session.get(f"{backend_url}/api/cabinets", headers=headers, timeout=30).json()
+    calls = [("GET", f"{backend_url}/api/cabinets", None)]
+    if cabinets:
+        cabinet = cabinets[0]
+        calls.append(("PUT", f"{backend_url}/api/cabinets/{cabinet['id']}", {"name": cabinet["name"]}))
+
+    def run(i):
+        method, url, body = calls[i % len(calls)]
+        return timed_request(session, method, url, headers, body)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(run, range(requests_count)))
+
+def print_latency(label, samples):
+    print(f"   {label}: {len(samples)} requests, "
+          f"p50 {percentile(samples, 50):.1f} ms, "
+          f"p99 {percentile(samples, 99):.1f} ms, "
+          f"mean {statistics.mean(samples) if samples else 0:.1f} ms")
+
+def main():
+    """Main benchmark function"""
+    print("📝 CASHPOT Logging Benchmark")
+    print("=" * 40)
+
+    backend_url = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:8002"
+    username = sys.argv[2] if len(sys.argv) > 2 else "admin"
+    password = sys.argv[3] if len(sys.argv) > 3 else "password"
+    requests_count = int(sys.argv[4]) if len(sys.argv) > 4 else 500
+    concurrency = int(sys.argv[5]) if len(sys.argv) > 5 else 10
+
+    print(f"Backend: {backend_url}")
+    print(f"Requests: {requests_count} per run with concurrency {concurrency}")
+    print()
+
+    try:
+        token = login(backend_url, username, password)
+        original = set_log_levels(backend_url, token, {})["levels"]
+    except Exception as e:
+        print(f"❌ Setup failed: {e}")
+        return
+
+    try:
+        print("⏱️  Debug logging disabled...")
+        set_log_levels(backend_url, token, {"": "INFO", "cabinets": "NOTSET"})
+        disabled = measure(backend_url, token, requests_count, concurrency)
+
+        print("⏱️  Debug logging enabled...")
+        set_log_levels(backend_url, token, {"": "DEBUG", "cabinets": "NOTSET"})
+        enabled = measure(backend_url, token, requests_count, concurrency)
+        stats = set_log_levels(backend_url, token, {})
+    finally:
+        set_log_levels(backend_url, token, original)
+
+    print(f"\n📊 Results")
+    print_latency("debug disabled", disabled)
+    print_latency("debug enabled", enabled)
+    print(f"   Log queue: {stats['queued']} queued, {stats['dropped']} dropped")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Benchmark login throughput and the latency of unrelated endpoints during a login storm
+"""
+
+import requests
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+def login(backend_url, username, password):
+    """Log in once and return the access token"""
+    response = requests.post(
+        f"{backend_url}/api/auth/login",
+        json={"username": username, "password": password},
+        timeout=30
+    )
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of a list of samples"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def probe_latency(backend_url, token, stop_event, samples):
+    """Hit an unrelated authenticated endpoint until stop_event is set"""
+    headers = {"Authorization": f"Bearer {token}"}
+    session = requests.Session()
+    while not stop_event.is_set():
+        started = time.perf_counter()
+        session.get(f"{backend_url}/api/auth/me", headers=headers, timeout=30)
+        samples.append((time.perf_counter() - started) * 1000)
+
+def measure_probe(backend_url, token, seconds):
+    """Measure probe latency with nothing else running"""
+    samples = []
+    stop_event = threading.Event()
+    probe = threading.Thread(target=probe_latency, args=(backend_url, token, stop_event, samples))
+    probe.start()
+    time.sleep(seconds)
+    stop_event.set()
+    probe.join()
+    return samples
+
+def measure_login_storm(backend_url, token, username, password, logins, concurrency):
+    """Run a burst of logins while probing an unrelated endpoint"""
+    samples = []
+    stop_event = threading.Event()
+    probe = threading.Thread(target=probe_latency, args=(backend_url, token, stop_event, samples))
+    probe.start()
+    
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(lambda _: login(backend_url, username, password), range(logins)))
+    elapsed = time.perf_counter() - started
+    
+    stop_event.set()
+    probe.join()
+    return elapsed, samples
+
+def print_latency(label, samples):
+    print(f"   {label}: {len(samples)} requests, "
+          f"p50 {percentile(samples, 50):.1f} ms, "
+          f"p99 {percentile(samples, 99):.1f} ms, "
+          f"mean {statistics.mean(samples) if samples else 0:.1f} ms")
+
+def main():
+    """Main benchmark function"""
+    print("🔐 CASHPOT Login Benchmark")
+    print("=" * 40)
+    
+    backend_url = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:8002"
+    username = sys.argv[2] if len(sys.argv) > 2 else "admin"
+    password = sys.argv[3] if len(sys.argv) > 3 else "password"
+    logins = int(sys.argv[4]) if len(sys.argv) > 4 else 200
+    concurrency = int(sys.argv[5]) if len(sys.argv) > 5 else 50
+    
+    print(f"Backend: {backend_url}")
+    print(f"Logins: {logins} with concurrency {concurrency}")
+    print()
+    
+    try:
+        token = login(backend_url, username, password)
+    except Exception as e:
+        print(f"❌ Initial login failed: {e}")
+        return
+    
+    print("⏱️  Measuring /api/auth/me latency at rest...")
+    baseline = measure_probe(backend_url, token, 5)
+    
+    print("🚀 Running login storm...")
+    elapsed, during_storm = measure_login_storm(backend_url, token, username, password, logins, concurrency)
+    
+    print(f"\n📊 Results")
+    print(f"   Login throughput: {logins / elapsed:.1f} logins/s ({elapsed:.2f} s total)")
+    print_latency("/api/auth/me at rest", baseline)
+    print_latency("/api/auth/me during logins", during_storm)
+    
+    try:
+        response = requests.get(
+            f"{backend_url}/api/admin/password-hasher",
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=10
+        )
+        if response.status_code == 200:
+            print(f"   Password hasher: {response.json()}")
+    except Exception as e:
+        print(f"⚠️  Could not read password hasher stats: {e}")
+
+if __name__ == "__main__":
+    main()
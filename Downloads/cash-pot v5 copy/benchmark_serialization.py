@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Benchmark list serialization: the per-row pydantic path against the fast orjson path
+"""
+
+import json
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import List
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from server import SlotMachine, FastJSONResponse, convert_objectid_to_str, row_shaper
+
+def make_docs(count):
+    """Build slot machine documents shaped like the ones stored in Mongo"""
+    started = datetime(2024, 1, 1)
+    docs = []
+    for i in range(count):
+        docs.append({
+            "_id": ObjectId(),
+            "id": str(uuid.uuid4()),
+            "cabinet_id": str(uuid.uuid4()),
+            "game_mix_id": str(uuid.uuid4()),
+            "provider_id": str(uuid.uuid4()),
+            "model": f"Model {i % 40}",
+            "serial_number": f"SN{i:08d}",
+            "denomination": 0.01,
+            "max_bet": 100.0,
+            "rtp": 96.5,
+            "gaming_places": 1,
+            "commission_date": started + timedelta(days=i % 365),
+            "status": "active",
+            "created_at": started + timedelta(minutes=i),
+            "created_by": str(uuid.uuid4()),
+            "location_id": str(uuid.uuid4()),
+            "production_year": 2020,
+        })
+    return docs
+
+def legacy_path(docs):
+    """What list endpoints did before: convert, construct, revalidate, encode"""
+    rows = [convert_objectid_to_str(doc) for doc in docs]
+    models = [SlotMachine(**row) for row in rows]
+    validated = TypeAdapter(List[SlotMachine]).validate_python(models)
+    return json.dumps(jsonable_encoder(validated)).encode("utf-8")
+
+def fast_path(docs):
+    """Current path: `_id` projected out by the query, rows shaped and dumped with orjson"""
+    shape = row_shaper(SlotMachine)
+    return FastJSONResponse([shape(doc) for doc in docs]).body
+
+def measure(label, func, docs, rounds):
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        body = func(docs)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    rate = len(docs) / best
+    print(f"   {label}: {rate:,.0f} rows/s (best of {rounds}: {best * 1000:.1f} ms, {len(body):,} bytes)")
+    return rate
+
+def main():
+    """Main benchmark function"""
+    print("⚡ CASHPOT Serialization Benchmark")
+    print("=" * 40)
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    docs = make_docs(count)
+    projected = [{key: value for key, value in doc.items() if key != "_id"} for doc in docs]
+    print(f"Rows: {count} SlotMachine documents")
+    print()
+
+    legacy = measure("convert_objectid_to_str + pydantic + json", legacy_path, docs, rounds)
+    fast = measure("row_shaper + orjson", fast_path, projected, rounds)
+    print(f"\n📊 Speedup: {fast / legacy:.1f}x")
+
+if __name__ == "__main__":
+    main()
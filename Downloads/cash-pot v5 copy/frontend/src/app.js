@@ -302,7 +302,8 @@ const AvatarUpload = ({ entityType, entityId, currentAvatar, onAvatarChange, sho
       if (response.ok) {
         const attachment = await response.json();
         console.log('Upload successful:', attachment);
-        onAvatarChange(attachment);
+        // The response carries metadata only; show the image that was just sent
+        onAvatarChange({ ...attachment, file_data: base64 });
         showCustomNotification('Avatar uploaded successfully', 'success');
       } else {
         const errorText = await response.text();
@@ -1262,6 +1263,25 @@ const CvtAttachmentIndicator = ({ cvtId, onClick }) => {
   );
 };
 
+// Attachment listings carry metadata only; load the content of one that is shown inline,
+// using its WebP preview once the server has generated one
+const withFileData = async (attachment) => {
+  const headers = { Authorization: `Bearer ${localStorage.getItem('token')}` };
+  if (attachment.has_preview) {
+    const preview = await fetch(`${API}/attachments/${attachment.id}/preview?size=large`, { headers });
+    if (preview.ok) {
+      const bytes = new Uint8Array(await preview.arrayBuffer());
+      let binary = '';
+      bytes.forEach(byte => { binary += String.fromCharCode(byte); });
+      return { ...attachment, mime_type: 'image/webp', file_data: btoa(binary) };
+    }
+  }
+  const response = await fetch(`${API}/attachments/${attachment.id}`, { headers });
+  if (!response.ok) return null;
+  const data = await response.json();
+  return { ...attachment, file_data: data.file_data };
+};
+
 // Custom hook for fetching avatars
 const useAvatar = (entityType, entityId) => {
   const [avatar, setAvatar] = useState(null);
@@ -1297,7 +1317,7 @@ const useAvatar = (entityType, entityId) => {
           att.mime_type.startsWith('image/') && 
           (att.filename.includes('avatar') || att.filename.includes('custom_avatar'))
         );
-        setAvatar(avatarAttachment || null);
+        setAvatar(avatarAttachment ? await withFileData(avatarAttachment) : null);
       }
     } catch (error) {
       console.error('Error fetching avatar:', error);
@@ -1415,7 +1435,8 @@ const CustomAvatarEditor = ({ entityType, entityId, currentAvatar, onAvatarChang
 
         if (response.ok) {
           const uploadedAvatar = await response.json();
-          onAvatarChange(uploadedAvatar);
+          // The response carries metadata only; show the image that was just sent
+          onAvatarChange({ ...uploadedAvatar, file_data: avatarData.file_data });
           showCustomNotification('Custom avatar saved successfully!', 'success');
         } else {
           throw new Error('Failed to save avatar');
@@ -13461,7 +13482,7 @@ const Dashboard = () => {
                                       (att.filename.includes('avatar') || att.filename.includes('custom_avatar'))
                                     );
                                     if (avatarAttachment) {
-                                      setProviderAvatar(avatarAttachment);
+                                      setProviderAvatar(await withFileData(avatarAttachment));
                                     }
                                   }
                                 } catch (error) {
@@ -1,32 +1,308 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Request, Query, Response, File, Form, UploadFile
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
+from fastapi.responses import StreamingResponse, JSONResponse
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
-from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from bson import Binary, ObjectId
+from bson.binary import UUID_SUBTYPE
+from gridfs.errors import NoFile
 import os
 import logging
+import queue
+import re
+import sys
 from pathlib import Path
+from urllib.parse import quote
 from pydantic import BaseModel, Field
-from typing import List, Optional, Literal
+from typing import Dict, List, Optional, Literal
 import uuid
 from datetime import datetime, timedelta
 import bcrypt
 import jwt
 from geopy.geocoders import Nominatim
 import asyncio
+import bisect
+import contextvars
+import hashlib
+import hmac
+import threading
+import base64
+import mimetypes
 import random
 from datetime import date
 import requests
 import csv
-from io import StringIO
+import json
+import time
+import orjson
+import pypdfium2 as pdfium
+from PIL import Image, ImageOps
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from io import BytesIO, StringIO
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# ============= Metrics ============= #
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values: tuple = (), amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        # Copied under the lock: observers on other threads add label values
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Gauge(Counter):
+    def dec(self, label_values: tuple = (), amount: float = 1):
+        self.inc(label_values, -amount)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+class Histogram:
+    """Cumulative-bucket histogram of durations in seconds (or counts, given count buckets)"""
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # label values -> [per-bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, label_values: tuple, seconds: float):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += seconds
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        # Each series is copied too, so its buckets, sum and count agree
+        with self._lock:
+            all_series = sorted((label_values, list(series)) for label_values, series in self._series.items())
+        for label_values, series in all_series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                bucket_labels = format_labels(self.labels, label_values, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {cumulative}")
+        return lines
+
+http_request_duration = Histogram("http_request_duration_seconds", "HTTP request latency by route", ("method", "route"))
+http_responses = Counter("http_responses_total", "HTTP responses by route and status code", ("method", "route", "status"))
+http_in_flight = Gauge("http_requests_in_flight", "HTTP requests currently being served")
+mongo_command_duration = Histogram("mongo_command_duration_seconds", "MongoDB command latency", ("command", "collection"))
+mongo_command_failures = Counter("mongo_command_failures_total", "Failed MongoDB commands", ("command", "collection"))
+mongo_pool_wait = Histogram("mongo_pool_checkout_wait_seconds", "Time spent waiting for a pooled connection")
+mongo_pool_checkout_failures = Counter("mongo_pool_checkout_failures_total", "Connection checkouts that failed", ("reason",))
+mongo_queries_per_request = Histogram(
+    "mongo_queries_per_request", "MongoDB round trips issued while serving one request", ("method", "route"),
+    buckets=(1, 2, 3, 5, 10, 20, 50, 100, 200)
+)
+METRICS = [
+    http_request_duration, http_responses, http_in_flight,
+    mongo_command_duration, mongo_command_failures, mongo_pool_wait, mongo_pool_checkout_failures,
+    mongo_queries_per_request
+]
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every command sent by the Motor client, per command and collection"""
+
+    def __init__(self):
+        self._collections = {}  # request_id -> collection of a started command
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self._collections[event.request_id] = collection if isinstance(collection, str) else ""
+        queries = current_queries.get()
+        if queries is not None:
+            queries.started(event)
+
+    def succeeded(self, event):
+        collection = self._collections.pop(event.request_id, "")
+        mongo_command_duration.observe((event.command_name, collection), event.duration_micros / 1e6)
+        queries = current_queries.get()
+        if queries is not None:
+            queries.finished(event)
+
+    def failed(self, event):
+        collection = self._collections.pop(event.request_id, "")
+        mongo_command_duration.observe((event.command_name, collection), event.duration_micros / 1e6)
+        mongo_command_failures.inc((event.command_name, collection))
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    """Measures how long operations wait to check a connection out of the pool.
+
+    Check-out start and completion are reported on the same thread, so the
+    start time is kept per thread.
+    """
+
+    def __init__(self):
+        self._started = {}
+
+    def connection_check_out_started(self, event):
+        self._started[threading.get_ident()] = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        started = self._started.pop(threading.get_ident(), None)
+        if started is not None:
+            mongo_pool_wait.observe((), time.perf_counter() - started)
+
+    def connection_check_out_failed(self, event):
+        self._started.pop(threading.get_ident(), None)
+        mongo_pool_checkout_failures.inc((str(event.reason),))
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_created(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): pass
+    def connection_checked_in(self, event): pass
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# ============= Query Budgets ============= #
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '200'))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', '10'))
+QUERY_COUNT_HEADER = os.environ.get('QUERY_COUNT_HEADER', 'false').lower() == 'true'
+QUERY_BUDGET_STRICT = os.environ.get('QUERY_BUDGET_STRICT', 'false').lower() == 'true'
+EXPLAINABLE_COMMANDS = {"find", "aggregate", "count", "distinct", "update", "delete", "findAndModify"}
+SESSION_FIELDS = {"lsid", "txnNumber", "autocommit", "startTransaction", "readConcern", "writeConcern"}
+
+# The request being served, if any; Motor copies the context into the threads that run commands
+current_queries = contextvars.ContextVar("current_queries", default=None)
+
+def query_shape(value):
+    """Strip literal values from a filter so that queries differing only in their arguments compare equal"""
+    if isinstance(value, dict):
+        return "{" + ",".join(f"{key}:{query_shape(item)}" for key, item in value.items()) + "}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ",".join(sorted({query_shape(item) for item in value})) + "]"
+    return "?"
+
+def command_filter(command_name: str, command) -> object:
+    """The part of a command that selects documents"""
+    if command_name in ("find", "findAndModify"):
+        return command.get("filter", command.get("query"))
+    if command_name in ("count", "distinct"):
+        return command.get("query")
+    if command_name == "aggregate":
+        pipeline = command.get("pipeline") or [{}]
+        return [next(iter(stage)) for stage in pipeline] + [pipeline[0].get("$match")]
+    if command_name in ("update", "delete"):
+        statements = command.get("updates" if command_name == "update" else "deletes") or [{}]
+        return statements[0].get("q")
+    if command_name == "insert":
+        return None
+    return command.get("filter")
+
+class QueryLog:
+    """Mongo round trips issued while serving one request.
+
+    Commands are counted and grouped by shape (command, collection and filter
+    without its values); a shape seen N_PLUS_ONE_THRESHOLD times is reported
+    as a probable N+1. Commands slower than SLOW_QUERY_MS are kept so that
+    their plans can be explained once the response is sent.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.budget = None
+        self.shapes = {}  # (command, collection, filter shape) -> times issued
+        self.slow = []  # (duration ms, database, command) of the slowest commands
+        self._in_flight = {}  # request_id -> (database, command)
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        if event.command_name in ("explain", "endSessions"):
+            return
+        collection = event.command.get(event.command_name)
+        shape = (event.command_name, collection if isinstance(collection, str) else "",
+                 query_shape(command_filter(event.command_name, event.command)))
+        with self._lock:
+            self.count += 1
+            self.shapes[shape] = self.shapes.get(shape, 0) + 1
+            if event.command_name in EXPLAINABLE_COMMANDS:
+                self._in_flight[event.request_id] = (event.database_name, event.command)
+
+    def finished(self, event):
+        with self._lock:
+            started = self._in_flight.pop(event.request_id, None)
+            duration_ms = event.duration_micros / 1000
+            if started is not None and duration_ms >= SLOW_QUERY_MS and len(self.slow) < 5:
+                self.slow.append((duration_ms, *started))
+
+    def repeated(self) -> List[tuple]:
+        """Shapes issued often enough to look like a query inside a loop"""
+        return [(shape, times) for shape, times in self.shapes.items() if times >= N_PLUS_ONE_THRESHOLD]
+
+def query_budget(max_queries: int):
+    """Dependency declaring how many Mongo round trips a route may issue per request"""
+    async def declare():
+        queries = current_queries.get()
+        if queries is not None:
+            queries.budget = max_queries
+    return declare
+
+async def explain_slow_queries(route_path: str, slow: List[tuple]):
+    """Log each slow command of a request together with its query plan"""
+    for duration_ms, database, command in slow:
+        explained = {key: value for key, value in command.items() if not key.startswith("$") and key not in SESSION_FIELDS}
+        try:
+            plan = await client[database].command({"explain": explained, "verbosity": "queryPlanner"})
+            winning_plan = plan.get("queryPlanner", {}).get("winningPlan", plan)
+        except Exception as e:
+            winning_plan = f"explain failed: {e}"
+        query_logger.warning("Slow query on %s: %.0f ms %s, plan %s", route_path, duration_ms, explained, winning_plan)
+
 # MongoDB connection
 mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(
+    mongo_url,
+    uuidRepresentation="standard",
+    event_listeners=[MongoCommandMetrics(), MongoPoolMetrics()]
+)
 db = client[os.environ.get('DB_NAME', 'casino_management')]
 
 # Create the main app without a prefix
@@ -39,8 +315,104 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Total-Count", "X-Query-Count"],
 )
 
+# Multipart forms are parsed, and their files spooled, before a route runs, so
+# the upload route's size limit is applied here, to the declared length, first
+MULTIPART_UPLOAD_PATHS = {"/api/attachments/upload"}
+MULTIPART_OVERHEAD_BYTES = 64 * 1024  # boundaries and the other form fields
+
+@app.middleware("http")
+async def limit_multipart_uploads(request: Request, call_next):
+    """Refuse multipart uploads that declare no length or more than MAX_UPLOAD_MB before reading them"""
+    if request.method == "POST" and request.url.path in MULTIPART_UPLOAD_PATHS:
+        length = request.headers.get("content-length", "")
+        if not length.isdigit():
+            return JSONResponse(status_code=411, content={"detail": "Content-Length required"})
+        if int(length) > MAX_UPLOAD_MB * 1024 * 1024 + MULTIPART_OVERHEAD_BYTES:
+            return JSONResponse(status_code=413, content={"detail": f"File size exceeds {MAX_UPLOAD_MB}MB limit"})
+    return await call_next(request)
+
+def route_path_of(request: Request) -> str:
+    route = request.scope.get("route")
+    return route.path if route is not None else "unmatched"
+
+def after_body(response, callback):
+    """Run `callback` once the response body has been sent (or the client went away).
+
+    `call_next` returns as soon as the headers are ready, so a streamed
+    body is still being produced, and still querying, after it returns.
+    """
+    body = response.body_iterator
+
+    async def send_then_report():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            callback()
+
+    response.body_iterator = send_then_report()
+    return response
+
+def report_queries(request: Request, queries: QueryLog):
+    route_path = route_path_of(request)
+    mongo_queries_per_request.observe((request.method, route_path), queries.count)
+    for (command, collection, shape), times in queries.repeated():
+        query_logger.warning("Possible N+1 on %s %s: %s on %s issued %d times with filter %s",
+                             request.method, route_path, command, collection, times, shape)
+    if queries.slow:
+        asyncio.create_task(explain_slow_queries(route_path, queries.slow))
+    if queries.budget is not None and queries.count > queries.budget:
+        query_logger.warning("Query budget exceeded on %s %s: %d queries, budget %d",
+                             request.method, route_path, queries.count, queries.budget)
+
+@app.middleware("http")
+async def record_queries(request: Request, call_next):
+    """Count the Mongo round trips of each request, flag N+1 patterns, slow commands and exceeded budgets.
+
+    Queries a streamed (NDJSON) body issues after the headers went out are
+    counted in the metrics and logs, which are reported once the body is
+    sent. They cannot be in the X-Query-Count header or turn the response
+    into a strict-mode 500, as those are decided when the headers are.
+    """
+    queries = QueryLog()
+    token = current_queries.set(queries)
+    try:
+        response = await call_next(request)
+    finally:
+        current_queries.reset(token)
+    if QUERY_BUDGET_STRICT and queries.budget is not None and queries.count > queries.budget:
+        report_queries(request, queries)
+        return JSONResponse(
+            status_code=500,
+            content={"detail": f"Query budget exceeded: {queries.count} queries, budget {queries.budget}"}
+        )
+    if QUERY_COUNT_HEADER:
+        response.headers["X-Query-Count"] = str(queries.count)
+    return after_body(response, lambda: report_queries(request, queries))
+
+# Added last, so it wraps record_queries and also sees its strict-budget 500s
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Record latency (until the last body byte) and status per route template (not per concrete URL)"""
+    http_in_flight.inc()
+    started = time.perf_counter()
+
+    def finish(status_code: int):
+        http_in_flight.dec()
+        route_path = route_path_of(request)
+        http_request_duration.observe((request.method, route_path), time.perf_counter() - started)
+        http_responses.inc((request.method, route_path, str(status_code)))
+
+    try:
+        response = await call_next(request)
+    except BaseException:
+        finish(500)
+        raise
+    return after_body(response, lambda: finish(response.status_code))
+
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
@@ -48,6 +420,152 @@ api_router = APIRouter(prefix="/api")
 security = HTTPBearer()
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-here')
 JWT_ALGORITHM = 'HS256'
+JWT_ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get('JWT_ACCESS_TOKEN_EXPIRE_MINUTES', str(24 * 60)))
+JWT_REFRESH_TOKEN_EXPIRE_DAYS = int(os.environ.get('JWT_REFRESH_TOKEN_EXPIRE_DAYS', '7'))
+
+# ============= Logging ============= #
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = os.environ.get('LOG_LEVELS', '')  # e.g. "auth=DEBUG,attachments=WARNING"
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')  # json | text
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0.01'))
+
+REDACTED = "[REDACTED]"
+SECRET_FIELDS = {"password", "password_hash", "token", "access_token", "refresh_token", "authorization", "secret", "file_data"}
+SECRET_PATTERNS = [
+    (re.compile(r"(Bearer\s+)[A-Za-z0-9._~+/=-]+", re.IGNORECASE), r"\1" + REDACTED),
+    (re.compile(r"eyJ[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+"), REDACTED),
+    (re.compile(r"\$2[aby]\$\d{2}\$[./A-Za-z0-9]{53}"), REDACTED),
+    (re.compile(r"""(['"]?(?:password|password_hash|token|secret|file_data)['"]?\s*[:=]\s*)(['"]).*?\2""", re.IGNORECASE), r"\1\2" + REDACTED + r"\2"),
+    # Unquoted, as in query strings
+    (re.compile(r"\b((?:password|token|access_token|refresh_token|secret)=)[^\s&'\"]+", re.IGNORECASE), r"\1" + REDACTED),
+]
+# Attributes every LogRecord has; anything else was passed through `extra`
+STANDARD_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "sample"}
+
+def redact(value):
+    """Mask secrets in a log message or structured field value"""
+    if isinstance(value, dict):
+        return {key: REDACTED if key.lower() in SECRET_FIELDS else redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    if isinstance(value, str):
+        for pattern, replacement in SECRET_PATTERNS:
+            value = pattern.sub(replacement, value)
+    return value
+
+class RedactingFilter(logging.Filter):
+    """Renders the message and masks secrets before a record leaves the request path"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.msg = redact(record.getMessage())
+        record.args = None
+        for key in set(vars(record)) - STANDARD_RECORD_FIELDS:
+            value = getattr(record, key)
+            setattr(record, key, REDACTED if key.lower() in SECRET_FIELDS else redact(value))
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a fraction of DEBUG records logged with `extra={"sample": True}`.
+
+    Meant for per-row or per-field messages, so turning DEBUG on for a module
+    does not multiply the log volume by the size of every result.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno <= logging.DEBUG and getattr(record, "sample", False):
+            return random.random() < self.rate
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in set(vars(record)) - STANDARD_RECORD_FIELDS:
+            entry[key] = getattr(record, key)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode("utf-8")
+
+class DroppingQueueHandler(QueueHandler):
+    """Non-blocking handler: request code only enqueues, a listener thread writes.
+
+    When the queue is full records are dropped and counted rather than
+    making the event loop wait on stdout.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Filters already rendered and redacted the message; skip re-formatting
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def parse_log_levels(spec: str) -> dict:
+    levels = {}
+    for item in spec.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+def configure_logging():
+    """Route every `server.*` logger through one queue drained by a background thread"""
+    stream_handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
+    queue_handler.addFilter(RedactingFilter())
+    
+    root_logger = logging.getLogger(__name__)
+    root_logger.handlers = [queue_handler]
+    root_logger.propagate = False
+    root_logger.setLevel(LOG_LEVEL)
+    for name, level in parse_log_levels(LOG_LEVELS).items():
+        root_logger.getChild(name).setLevel(level)
+    
+    listener = QueueListener(queue_handler.queue, stream_handler, respect_handler_level=False)
+    listener.start()
+    return root_logger, queue_handler, listener
+
+logger, log_queue_handler, log_listener = configure_logging()
+
+def log_levels() -> dict:
+    """Effective level of the server logger and of every module logger with its own level"""
+    levels = {"": logging.getLevelName(logger.level)}
+    prefix = logger.name + "."
+    for name, module_logger in logging.Logger.manager.loggerDict.items():
+        if name.startswith(prefix) and isinstance(module_logger, logging.Logger) and module_logger.level:
+            levels[name[len(prefix):]] = logging.getLevelName(module_logger.level)
+    return levels
+auth_logger = logger.getChild("auth")
+cabinet_logger = logger.getChild("cabinets")
+slot_logger = logger.getChild("slots")
+attachment_logger = logger.getChild("attachments")
+metrology_logger = logger.getChild("metrology")
+comision_logger = logger.getChild("comision")
+query_logger = logger.getChild("queries")
+
+class LogLevelsUpdate(BaseModel):
+    levels: Dict[str, str]  # module ("" for all of them) -> level, e.g. {"auth": "DEBUG"}
 
 # Models
 class UserRole(str):
@@ -132,6 +650,9 @@ class UserLogin(BaseModel):
     username: str
     password: str
 
+class TokenRefresh(BaseModel):
+    refresh_token: str
+
 class Company(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
@@ -330,7 +851,9 @@ class Attachment(BaseModel):
     original_filename: str
     file_size: int
     mime_type: str
-    file_data: str  # base64 encoded file data
+    blob_id: Optional[str] = None  # content in the blob store
+    sha256: Optional[str] = None  # key of the content in `blob_contents`
+    file_data: Optional[str] = None  # legacy inline base64, moved out by migrate_attachment_blobs
     entity_type: str  # users, providers, cabinets, game_mixes, slots, invoices, onjn, legal, metrology, jackpots
     entity_id: str
     uploaded_by: str
@@ -345,6 +868,22 @@ class AttachmentCreate(BaseModel):
     entity_type: str
     entity_id: str
 
+class UploadSessionCreate(BaseModel):
+    filename: str
+    original_filename: Optional[str] = None
+    file_size: int
+    entity_type: str
+    entity_id: str
+
+class UploadSession(BaseModel):
+    id: str
+    filename: str
+    file_size: int
+    received: int
+    chunk_size: int
+    mime_type: Optional[str] = None
+    expires_at: datetime
+
 class Invoice(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     invoice_number: str
@@ -563,14 +1102,1647 @@ def convert_objectid_to_str(data):
     """Convert MongoDB ObjectId to string for JSON serialization"""
     from bson import ObjectId
     
-    if isinstance(data, ObjectId):
+    if isinstance(data, (ObjectId, uuid.UUID)):
         return str(data)
+    elif isinstance(data, Binary) and data.subtype == UUID_SUBTYPE:
+        return str(data.as_uuid())
     elif isinstance(data, dict):
         return {key: convert_objectid_to_str(value) for key, value in data.items()}
     elif isinstance(data, list):
         return [convert_objectid_to_str(item) for item in data]
     return data
 
+# ============= Primary Keys ============= #
+# Collections whose documents are addressed by their string `id`. The
+# change history is not listed: it has always used its ObjectId as its id.
+PRIMARY_KEY_COLLECTIONS = (
+    "users", "companies", "locations", "providers", "game_mixes", "cabinets",
+    "slot_machines", "attachments", "invoices", "onjn_reports", "legal_documents",
+    "metrology", "jackpots", "comision_dates", "marketing_campaigns"
+)
+PRIMARY_KEY_BATCH_SIZE = int(os.environ.get('PRIMARY_KEY_BATCH_SIZE', '500'))
+
+# Fields that used to hold the str(ObjectId) handed out for an entity and
+# must follow it to its new key: collection -> [(collection, field, filter)]
+LEGACY_ID_REFERENCES = {
+    "cabinets": [
+        ("slot_machines", "cabinet_id", {}),
+        ("attachments", "entity_id", {"entity_type": "cabinets"}),
+    ],
+    "metrology": [
+        ("attachments", "entity_id", {"entity_type": "metrology"}),
+    ],
+}
+
+def primary_key(entity_id: str):
+    """The `_id` stored for an entity id: canonical UUIDs as binary, anything else as is"""
+    try:
+        key = uuid.UUID(entity_id)
+    except (AttributeError, TypeError, ValueError):
+        return entity_id
+    return Binary.from_uuid(key) if str(key) == entity_id else entity_id
+
+def keyed(doc: dict) -> dict:
+    """Give a document about to be inserted its primary key"""
+    doc["_id"] = primary_key(doc["id"])
+    return doc
+
+class PrimaryKeyMigration:
+    """Online move of every document from an ObjectId `_id` to `primary_key(id)`.
+
+    Until the migration has completed, `by_id` matches on the `id` field (and
+    on legacy str(ObjectId) ids); afterwards each lookup is a single `_id`
+    index probe and the `id` field is kept only as part of the document.
+    """
+
+    STATE_ID = "primary_keys"
+
+    def __init__(self):
+        self.complete = False
+        self.task: Optional[asyncio.Task] = None
+        self.moved: Dict[str, int] = {}
+        self.conflicts: Dict[str, List[str]] = {}
+        self.error: Optional[str] = None
+
+    async def load(self):
+        state = await db.migrations.find_one({"_id": self.STATE_ID})
+        self.complete = bool(state and state.get("complete"))
+
+    def start(self) -> bool:
+        if self.task is not None and not self.task.done():
+            return False
+        self.error = None
+        self.task = asyncio.create_task(self.run())
+        return True
+
+    async def run(self):
+        try:
+            for name in PRIMARY_KEY_COLLECTIONS:
+                remapped = await self.migrate_collection(name)
+                for collection, field, scope in LEGACY_ID_REFERENCES.get(name, []):
+                    for old_id, new_id in remapped.items():
+                        await db[collection].update_many({**scope, field: old_id}, {"$set": {field: new_id}})
+            if not any(self.conflicts.values()):
+                await db.migrations.update_one(
+                    {"_id": self.STATE_ID},
+                    {"$set": {"complete": True, "completed_at": datetime.utcnow()}},
+                    upsert=True
+                )
+                self.complete = True
+                # Unique indexes can be built now, and the `id` index goes
+                indexes.start()
+        except Exception as e:
+            self.error = str(e)
+            logger.error("Primary key migration failed: %s", e)
+
+    async def migrate_collection(self, name: str) -> Dict[str, str]:
+        """Re-key one collection in batches; returns {old str(_id): id} where they differ"""
+        collection = db[name]
+        self.moved[name] = 0
+        self.conflicts[name] = []
+        skipped = []
+        remapped = {}
+        while True:
+            batch = await collection.find(
+                {"_id": {"$type": "objectId", "$nin": skipped}}
+            ).limit(PRIMARY_KEY_BATCH_SIZE).to_list(PRIMARY_KEY_BATCH_SIZE)
+            if not batch:
+                return remapped
+            for doc in batch:
+                old_id = doc.pop("_id")
+                doc.setdefault("id", str(old_id))
+                try:
+                    await collection.insert_one(keyed(doc))
+                except DuplicateKeyError:
+                    # Another document already holds this id; leave both for an admin
+                    skipped.append(old_id)
+                    self.conflicts[name].append(doc["id"])
+                    continue
+                # Until the old copy is gone both are visible; list pages drop
+                # the second one (see unique_rows). A transaction would close
+                # the gap, but needs a replica set.
+                # A write that landed on the old copy after it was read wins
+                latest = await collection.find_one_and_delete({"_id": old_id})
+                if latest is not None:
+                    latest.pop("_id")
+                    latest.setdefault("id", doc["id"])
+                    if latest != {k: v for k, v in doc.items() if k != "_id"}:
+                        await collection.replace_one({"_id": doc["_id"]}, latest)
+                if doc["id"] != str(old_id):
+                    remapped[str(old_id)] = doc["id"]
+                self.moved[name] += 1
+
+    def status(self) -> dict:
+        return {
+            "complete": self.complete,
+            "running": self.task is not None and not self.task.done(),
+            "moved": self.moved,
+            "conflicts": self.conflicts,
+            "error": self.error,
+        }
+
+primary_keys = PrimaryKeyMigration()
+
+def public_id(doc: dict) -> str:
+    """The id a document is handed out under: str(_id) while it still has an ObjectId"""
+    if isinstance(doc.get("_id"), ObjectId):
+        return str(doc["_id"])
+    return doc["id"]
+
+def by_id(entity_id: str) -> dict:
+    """Filter matching the one document with this id"""
+    if primary_keys.complete:
+        return {"_id": primary_key(entity_id)}
+    if len(entity_id) == 24 and ObjectId.is_valid(entity_id):
+        # Some endpoints used to hand out str(_id) as the id
+        return {"$or": [{"id": entity_id}, {"_id": ObjectId(entity_id)}]}
+    return {"id": entity_id}
+
+def by_ids(entity_ids) -> dict:
+    """Filter matching the documents with any of these ids"""
+    if primary_keys.complete:
+        return {"_id": {"$in": [primary_key(entity_id) for entity_id in entity_ids]}}
+    return {"id": {"$in": list(entity_ids)}}
+
+# ============= Indexes ============= #
+INDEX_RECONCILE_ON_STARTUP = os.environ.get('INDEX_RECONCILE_ON_STARTUP', 'true').lower() == 'true'
+
+def paged(*keys) -> IndexModel:
+    """Index for the (sort key, id) order used by keyset pagination"""
+    return IndexModel([*keys, ("created_at", ASCENDING), ("id", ASCENDING)])
+
+def unique(field: str) -> IndexModel:
+    """Unique among documents that have the field, so legacy rows without it do not collide on null"""
+    return IndexModel([(field, ASCENDING)], unique=True, partialFilterExpression={field: {"$exists": True}})
+
+# `id` is not unique: during the primary key migration a document briefly
+# exists under both its old and new `_id`. Uniqueness is declared only where
+# the create endpoints already reject duplicates. See `declared_indexes` for
+# how both depend on the migration.
+ID_INDEX = IndexModel([("id", ASCENDING)])
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [ID_INDEX, unique("username"), IndexModel([("email", ASCENDING)]), paged()],
+    "user_versions": [unique("id")],
+    "companies": [ID_INDEX, unique("name"), paged()],
+    "locations": [ID_INDEX, paged()],
+    "providers": [ID_INDEX, unique("name"), paged()],
+    "game_mixes": [ID_INDEX, paged()],
+    "cabinets": [
+        ID_INDEX,
+        # Derived provider scope and the per-location cabinet lists
+        IndexModel([("location_id", ASCENDING), ("provider_id", ASCENDING)]),
+        paged(),
+    ],
+    "slot_machines": [
+        ID_INDEX,
+        IndexModel([("serial_number", ASCENDING)]),
+        IndexModel([("cabinet_id", ASCENDING)]),
+        # Derived game mix scope
+        IndexModel([("location_id", ASCENDING), ("game_mix_id", ASCENDING)]),
+        # Common slot machine search filters
+        IndexModel([("location_id", ASCENDING), ("status", ASCENDING), ("created_at", ASCENDING)]),
+        IndexModel([("provider_id", ASCENDING), ("status", ASCENDING), ("created_at", ASCENDING)]),
+        paged(),
+    ],
+    "attachments": [
+        ID_INDEX,
+        IndexModel([("entity_type", ASCENDING), ("entity_id", ASCENDING)]),
+        # Attachments sharing deduplicated content, e.g. to queue missing previews
+        IndexModel([("sha256", ASCENDING)]),
+    ],
+    "change_history": [
+        ID_INDEX,
+        IndexModel([("entity_type", ASCENDING), ("entity_id", ASCENDING), ("scheduled_datetime", DESCENDING)]),
+        IndexModel([("entity_type", ASCENDING), ("created_at", DESCENDING), ("scheduled_datetime", DESCENDING)]),
+    ],
+    "invoices": [
+        ID_INDEX,
+        unique("invoice_number"),
+        IndexModel([("company_id", ASCENDING)]),
+        IndexModel([("location_id", ASCENDING)]),
+        paged(),
+    ],
+    "onjn_reports": [
+        ID_INDEX,
+        unique("report_number"),
+        IndexModel([("company_id", ASCENDING), ("location_id", ASCENDING)]),
+        paged(),
+    ],
+    "legal_documents": [
+        ID_INDEX,
+        IndexModel([("company_id", ASCENDING)]),
+        IndexModel([("location_id", ASCENDING)]),
+        paged(),
+    ],
+    "metrology": [ID_INDEX, paged()],
+    "jackpots": [ID_INDEX, paged()],
+    "comision_dates": [ID_INDEX, paged()],
+    "marketing_campaigns": [ID_INDEX, paged()],
+    # Activity feed: one `$in` over scope keys merged in created_at order; admins read it unfiltered
+    "activity": [
+        IndexModel([("scope", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)]),
+    ],
+    # Resumable uploads, swept once they expire
+    "upload_sessions": [IndexModel([("expires_at", ASCENDING)])],
+    # Dashboard counters, summed over the user's locations and companies
+    "stats": [IndexModel([("location_id", ASCENDING)]), IndexModel([("company_id", ASCENDING)])],
+}
+
+def declared_indexes(name: str) -> List[IndexModel]:
+    """The indexes a collection should have, given where the primary key migration stands.
+
+    Until it completes, `by_id` matches on `id` and the migration inserts each
+    re-keyed copy before deleting the original, so `id` is indexed and the
+    unique indexes wait (the copy would collide with its original). Once it
+    completes, lookups go through `_id`: the unique indexes are built and the
+    `id` index is dropped. `paged()` keeps `id` only as the keyset tie-breaker.
+    """
+    models = INDEXES[name]
+    if name not in PRIMARY_KEY_COLLECTIONS:
+        return models
+    if primary_keys.complete:
+        return [model for model in models if model is not ID_INDEX]
+    return [model for model in models if not model.document.get("unique")]
+
+class IndexManager:
+    """Creates the indexes declared in INDEXES that a collection lacks.
+
+    Reconciliation runs as a background task so that startup does not wait on
+    index builds. Indexes that exist but are not declared are only reported,
+    never dropped, except the `id` index once the primary key migration has
+    made it redundant.
+    """
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.created: Dict[str, List[str]] = {}
+        self.dropped: Dict[str, List[str]] = {}
+        self.failed: Dict[str, Dict[str, str]] = {}
+        self.finished_at: Optional[datetime] = None
+        self.rerun = False
+
+    def start(self) -> bool:
+        if self.task is not None and not self.task.done():
+            # Declarations may have changed under the running pass; go again after it
+            self.rerun = True
+            return False
+        self.task = asyncio.create_task(self.reconcile())
+        return True
+
+    async def reconcile(self):
+        self.rerun = True
+        while self.rerun:
+            self.rerun = False
+            await self.reconcile_once()
+        self.finished_at = datetime.utcnow()
+
+    async def reconcile_once(self):
+        self.created, self.dropped, self.failed = {}, {}, {}
+        for name in INDEXES:
+            existing = await db[name].index_information()
+            retired = ID_INDEX.document["name"]
+            if primary_keys.complete and name in PRIMARY_KEY_COLLECTIONS and retired in existing:
+                await db[name].drop_index(retired)
+                self.dropped.setdefault(name, []).append(retired)
+                logger.info("Dropped index %s.%s", name, retired)
+            for model in declared_indexes(name):
+                index_name = model.document["name"]
+                if index_name in existing:
+                    continue
+                try:
+                    await db[name].create_indexes([model])
+                    self.created.setdefault(name, []).append(index_name)
+                    logger.info("Created index %s.%s", name, index_name)
+                except (DuplicateKeyError, OperationFailure) as e:
+                    # e.g. duplicate values under a unique index, or a same-key index with other options
+                    self.failed.setdefault(name, {})[index_name] = str(e)
+                    logger.warning("Could not create index %s.%s: %s", name, index_name, e)
+
+    async def report(self) -> dict:
+        """Declared indexes that are missing, undeclared ones that exist, and indexes never used"""
+        collections = {}
+        for name in INDEXES:
+            declared = {model.document["name"] for model in declared_indexes(name)}
+            existing = set(await db[name].index_information())
+            try:
+                usage = await db[name].aggregate([{"$indexStats": {}}]).to_list(None)
+                unused = sorted(stat["name"] for stat in usage if stat["accesses"]["ops"] == 0 and stat["name"] != "_id_")
+                counting_since = min((stat["accesses"]["since"] for stat in usage), default=None)
+            except OperationFailure:
+                # $indexStats needs a real server (and the indexStats privilege)
+                unused, counting_since = None, None
+            collections[name] = {
+                "missing": sorted(declared - existing),
+                "extra": sorted(existing - declared - {"_id_"}),
+                "unused": unused,
+                "counting_since": counting_since,
+                "failed": self.failed.get(name, {}),
+            }
+        return {
+            "running": self.task is not None and not self.task.done(),
+            "finished_at": self.finished_at,
+            "created": self.created,
+            "dropped": self.dropped,
+            "collections": collections,
+        }
+
+indexes = IndexManager()
+
+# ============= Dashboard Counters ============= #
+STATS_RECONCILE_SECONDS = int(os.environ.get('STATS_RECONCILE_SECONDS', '3600'))
+
+# Fields each collection's counters are kept under, in the `stats` read model.
+# Equipment is counted per location; company documents per (company, location)
+# pair so that both the "company or location" and "company and location"
+# access rules can be applied; the rest is not scoped and has one global row.
+STAT_KEYS = {
+    "cabinets": ("location_id",),
+    "slot_machines": ("location_id",),
+    "invoices": ("location_id", "company_id"),
+    "onjn_reports": ("location_id", "company_id"),
+    "legal_documents": ("location_id", "company_id"),
+    "metrology": (),
+    "jackpots": (),
+    "comision_dates": (),
+}
+STAT_ACTIVE = ("cabinets", "slot_machines")  # also counted as `<collection>_active`
+
+def stat_row_id(location_id: Optional[str], company_id: Optional[str]) -> str:
+    return f"{location_id or ''}:{company_id or ''}"
+
+def stat_contribution(collection: str, doc: dict) -> tuple:
+    """The counter row a document is counted in, and what it adds there"""
+    key = {field: doc.get(field) for field in STAT_KEYS[collection]}
+    counts = {collection: 1}
+    if collection in STAT_ACTIVE and doc.get("status") == "active":
+        counts[f"{collection}_active"] = 1
+    return (key.get("location_id"), key.get("company_id")), counts
+
+async def count_change(collection: str, before: Optional[dict] = None, after: Optional[dict] = None):
+    """Move a document's contribution to the dashboard counters from its old state to its new one.
+
+    Pass only `after` for a create and only `before` for a delete. Each row is
+    adjusted with a single atomic `$inc`; a failure is logged rather than
+    failing the write, and reconcile_stats() corrects the drift.
+    """
+    deltas = {}
+    for doc, sign in ((before, -1), (after, 1)):
+        if doc is None:
+            continue
+        key, counts = stat_contribution(collection, doc)
+        row = deltas.setdefault(key, {})
+        for field, n in counts.items():
+            row[field] = row.get(field, 0) + sign * n
+    try:
+        for (location_id, company_id), row in deltas.items():
+            increments = {field: n for field, n in row.items() if n}
+            if increments:
+                await db.stats.update_one(
+                    {"_id": stat_row_id(location_id, company_id)},
+                    {"$inc": increments, "$setOnInsert": {"location_id": location_id, "company_id": company_id}},
+                    upsert=True
+                )
+    except Exception as e:
+        logger.warning("Could not update %s counters: %s", collection, e)
+
+async def reconcile_stats() -> int:
+    """Recount every counter from the source collections; returns how many rows were corrected.
+
+    An increment that lands while a row is being recounted can be lost or
+    applied twice; the next run corrects it.
+    """
+    rows = {}
+    for collection, key_fields in STAT_KEYS.items():
+        group = {"_id": {field: f"${field}" for field in key_fields} or None, "n": {"$sum": 1}}
+        if collection in STAT_ACTIVE:
+            group["active"] = {"$sum": {"$cond": [{"$eq": ["$status", "active"]}, 1, 0]}}
+        async for counted in db[collection].aggregate([{"$group": group}]):
+            key = counted["_id"] or {}
+            location_id, company_id = key.get("location_id"), key.get("company_id")
+            row = rows.setdefault(stat_row_id(location_id, company_id), {"location_id": location_id, "company_id": company_id})
+            row[collection] = row.get(collection, 0) + counted["n"]
+            if collection in STAT_ACTIVE:
+                row[f"{collection}_active"] = row.get(f"{collection}_active", 0) + counted["active"]
+    
+    def counters(row: dict) -> dict:
+        return {field: value for field, value in row.items() if (field in STAT_KEYS or field.endswith("_active")) and value}
+    
+    corrected = 0
+    stored = {row["_id"]: row for row in await db.stats.find({}).to_list(None)}
+    for row_id, row in rows.items():
+        if counters(stored.pop(row_id, {})) != counters(row):
+            await db.stats.replace_one({"_id": row_id}, row, upsert=True)
+            corrected += 1
+    # Rows for locations or companies that no longer have anything counted
+    for row_id, row in stored.items():
+        if any(counters(row).values()):
+            corrected += 1
+        await db.stats.delete_one({"_id": row_id})
+    if corrected:
+        logger.info("Dashboard counters reconciled: %d rows corrected", corrected)
+    return corrected
+
+async def stats_reconcile_loop():
+    """Rebuild the counters at startup, then correct drift periodically"""
+    while True:
+        try:
+            await reconcile_stats()
+        except Exception as e:
+            logger.warning("Dashboard counter reconciliation failed: %s", e)
+        await asyncio.sleep(STATS_RECONCILE_SECONDS)
+
+async def scoped_counters(user: User, companies: List[str], locations: List[str]) -> dict:
+    """Sum the counter rows visible to the user: O(accessible locations), not O(fleet)"""
+    in_locations = {"$in": ["$location_id", locations]}
+    in_companies = {"$in": ["$company_id", companies]}
+    # Which rows count towards each field, per the rules of filter_by_user_access (None: all of them)
+    scopes = {
+        "cabinets": in_locations,
+        "slot_machines": in_locations,
+        "invoices": {"$or": [in_companies, in_locations]},
+        "legal_documents": {"$or": [in_companies, in_locations]},
+        "onjn_reports": {"$and": [in_companies, in_locations]},
+        "metrology": None,
+        "jackpots": None,
+        "comision_dates": None,
+    }
+    scopes.update({f"{collection}_active": scopes[collection] for collection in STAT_ACTIVE})
+    if user.role == UserRole.ADMIN:
+        match = {}
+        scopes = dict.fromkeys(scopes)
+    else:
+        match = {"$or": [
+            {"location_id": {"$in": locations}},
+            {"company_id": {"$in": companies}},
+            {"_id": stat_row_id(None, None)},
+        ]}
+    group = {"_id": None}
+    for field, scope in scopes.items():
+        group[field] = {"$sum": f"${field}" if scope is None else {"$cond": [scope, f"${field}", 0]}}
+    result = await db.stats.aggregate([{"$match": match}, {"$group": group}]).to_list(1)
+    totals = result[0] if result else {}
+    return {field: totals.get(field) or 0 for field in scopes}
+
+# ============= Activity Feed ============= #
+ACTIVITY_PAGE_SIZE = int(os.environ.get('ACTIVITY_PAGE_SIZE', '20'))
+ACTIVITY_BACKFILL_ID = "activity"
+
+# Collection -> entity type shown in the feed
+ACTIVITY_TYPES = {
+    "companies": "company",
+    "locations": "location",
+    "providers": "provider",
+    "game_mixes": "game_mix",
+    "cabinets": "cabinet",
+    "slot_machines": "slot_machine",
+    "invoices": "invoice",
+    "onjn_reports": "onjn_report",
+    "legal_documents": "legal_document",
+    "metrology": "metrology",
+    "jackpots": "jackpot",
+    "comision_dates": "comision_date",
+    "marketing_campaigns": "marketing_campaign",
+    "users": "user",
+    "attachments": "attachment",
+}
+GLOBAL_SCOPE = "global"  # entities whose lists are not filtered by access
+CATALOG_SCOPE = "catalog"  # providers and game mixes, which admins and managers all see
+ADMIN_SCOPE = "admin"  # users, which only admins manage
+
+# Attachment entity types that are aliases of a collection name
+ATTACHMENT_ENTITY_COLLECTIONS = {
+    "slots": "slot_machines",
+    "onjn": "onjn_reports",
+    "comision_date": "comision_dates",
+    "marketing": "marketing_campaigns",
+}
+
+def activity_label(collection: str, doc: dict) -> str:
+    if collection == "cabinets":
+        return f"{doc.get('name', '')} {doc.get('model') or ''}".strip()
+    field = {
+        "slot_machines": "serial_number",
+        "invoices": "invoice_number",
+        "onjn_reports": "report_number",
+        "legal_documents": "title",
+        "metrology": "certificate_number",
+        "jackpots": "jackpot_name",
+        "comision_dates": "event_name",
+        "users": "username",
+        "attachments": "original_filename",
+    }.get(collection, "name")
+    return str(doc.get(field) or "")
+
+def activity_scopes(collection: str, doc: dict) -> List[str]:
+    """Scope keys an entry is visible under; mirrors filter_by_user_access"""
+    if collection == "companies":
+        return [f"company:{doc.get('id')}"]
+    if collection == "locations":
+        return [f"location:{doc.get('id')}"]
+    if collection == "providers":
+        return [CATALOG_SCOPE, f"provider:{doc.get('id')}"]
+    if collection == "game_mixes":
+        return [CATALOG_SCOPE, f"game_mix:{doc.get('id')}"]
+    if collection in ("cabinets", "slot_machines"):
+        return [f"location:{doc['location_id']}"] if doc.get("location_id") else []
+    if collection in ("invoices", "legal_documents", "onjn_reports"):
+        # ONJN reports need both the company and the location; a location's
+        # own company is always accessible with it, so the location decides
+        scopes = [] if collection == "onjn_reports" else [f"company:{doc.get('company_id')}"]
+        return scopes + ([f"location:{doc['location_id']}"] if doc.get("location_id") else [])
+    if collection == "users":
+        return [ADMIN_SCOPE]
+    return [GLOBAL_SCOPE]
+
+async def attachment_scopes(attachment: dict) -> List[str]:
+    """Scope keys of an attachment: those of the entity it is attached to"""
+    collection = ATTACHMENT_ENTITY_COLLECTIONS.get(attachment.get("entity_type"), attachment.get("entity_type"))
+    if collection not in ACTIVITY_TYPES or collection == "attachments":
+        return [ADMIN_SCOPE]
+    entity = {"id": attachment.get("entity_id")}
+    if collection in ("cabinets", "slot_machines", "invoices", "legal_documents", "onjn_reports"):
+        entity = await db[collection].find_one(by_id(entity["id"]), {"_id": 0, "location_id": 1, "company_id": 1}) or {}
+    return activity_scopes(collection, entity)
+
+def activity_entry(collection: str, action: str, doc: dict, user_id: Optional[str], created_at: datetime,
+                   scope: Optional[List[str]] = None) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "scope": activity_scopes(collection, doc) if scope is None else scope,
+        "type": ACTIVITY_TYPES[collection],
+        "action": action,
+        "entity_id": doc.get("id"),
+        "name": activity_label(collection, doc),
+        "user_id": user_id,
+        "created_at": created_at,
+    }
+
+async def record_activity(user: Optional[User], action: str, collection: str, *docs: dict):
+    """Append created/updated/deleted entries to the feed; failures are logged, not raised"""
+    if not docs:
+        return
+    now = datetime.utcnow()
+    try:
+        entries = []
+        for doc in docs:
+            scope = await attachment_scopes(doc) if collection == "attachments" else None
+            entries.append(activity_entry(collection, action, doc, user.id if user else None, now, scope))
+        await db.activity.insert_many(entries)
+    except Exception as e:
+        logger.warning("Could not record %s activity for %s: %s", action, collection, e)
+
+async def activity_query(user: User) -> dict:
+    """Feed filter for a user: one `$in` over the scope keys they can see"""
+    if user.role == UserRole.ADMIN:
+        return {}
+    locations, companies, providers, game_mixes = await asyncio.gather(
+        access_scopes.get(user, "locations"),
+        access_scopes.get(user, "companies"),
+        access_scopes.get(user, "providers"),
+        access_scopes.get(user, "game_mixes"),
+    )
+    scopes = [GLOBAL_SCOPE]
+    scopes += [f"location:{location_id}" for location_id in locations]
+    scopes += [f"company:{company_id}" for company_id in companies]
+    if user.role == UserRole.MANAGER:
+        scopes.append(CATALOG_SCOPE)
+    else:
+        scopes += [f"provider:{provider_id}" for provider_id in providers]
+        scopes += [f"game_mix:{game_mix_id}" for game_mix_id in game_mixes]
+    return {"scope": {"$in": scopes}}
+
+def activity_time(created_at) -> datetime:
+    """created_at of a legacy document, which may be stored as an ISO string or be missing"""
+    if isinstance(created_at, datetime):
+        return created_at
+    try:
+        return datetime.fromisoformat(str(created_at))
+    except ValueError:
+        return datetime.min
+
+async def backfill_activity():
+    """Seed the feed with a "created" entry for every existing document.
+
+    Entries get a deterministic `_id`, so an interrupted run can simply be
+    repeated; finished collections are checkpointed in `migrations`.
+    """
+    state = await db.migrations.find_one({"_id": ACTIVITY_BACKFILL_ID}) or {}
+    done = set(state.get("collections", []))
+    try:
+        for collection in ACTIVITY_TYPES:
+            if collection in done:
+                continue
+            batch = []
+            async for doc in db[collection].find({}, {"file_data": 0, "password_hash": 0}):
+                scope = await attachment_scopes(doc) if collection == "attachments" else None
+                entry = activity_entry(collection, "created", doc, doc.get("created_by") or doc.get("uploaded_by"),
+                                       activity_time(doc.get("created_at")), scope)
+                entry["_id"] = entry["id"] = f"created:{collection}:{public_id(doc)}"
+                batch.append(entry)
+                if len(batch) == 500:
+                    await insert_missing(db.activity, batch)
+                    batch = []
+            await insert_missing(db.activity, batch)
+            await db.migrations.update_one({"_id": ACTIVITY_BACKFILL_ID}, {"$addToSet": {"collections": collection}}, upsert=True)
+        logger.info("Activity backfill complete")
+    except Exception as e:
+        logger.error("Activity backfill stopped: %s", e)
+
+async def insert_missing(collection, docs: List[dict]):
+    """Insert documents, skipping those whose `_id` is already present"""
+    if docs:
+        try:
+            await collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+
+# ============= Blob Store ============= #
+# Attachment content lives outside the attachment documents: in GridFS by
+# default, or in a directory on local disk with BLOB_STORE=local. Content is
+# stored once per SHA-256 digest; `blob_contents` maps each digest to its blob
+# and counts the attachments referencing it, which keep `blob_id` and `sha256`.
+BLOB_STORE = os.environ.get('BLOB_STORE', 'gridfs')  # gridfs | local
+BLOB_STORE_PATH = Path(os.environ.get('BLOB_STORE_PATH', str(ROOT_DIR / 'blobs')))
+BLOB_CHUNK_SIZE = int(os.environ.get('BLOB_CHUNK_SIZE', str(1024 * 1024)))
+MAX_UPLOAD_MB = int(os.environ.get('MAX_UPLOAD_MB', '50'))
+UPLOAD_CHUNK_MB = int(os.environ.get('UPLOAD_CHUNK_MB', '8'))
+UPLOAD_SESSION_HOURS = int(os.environ.get('UPLOAD_SESSION_HOURS', '24'))
+UPLOAD_CLEANUP_SECONDS = int(os.environ.get('UPLOAD_CLEANUP_SECONDS', '3600'))
+ATTACHMENT_CONTENT_MIGRATION_ID = "attachment_contents"
+
+COMPOSED_BLOB_PREFIX = "composed-"
+
+class BlobStore:
+    """Reading and deleting blobs, including composed ones.
+
+    A composed blob is a small manifest naming other blobs and their sizes,
+    read back to back as one. Resumable uploads become content this way, so
+    committing one does not copy the chunks it received.
+    """
+
+    async def compose(self, parts: List[dict]) -> str:
+        """A blob made of `parts` ({blob_id, size}) in order; it owns them from now on"""
+        if len(parts) == 1:
+            return parts[0]["blob_id"]
+
+        async def manifest():
+            yield orjson.dumps([[part["blob_id"], part["size"]] for part in parts])
+
+        return await self.put(manifest(), f"{COMPOSED_BLOB_PREFIX}{uuid.uuid4().hex}")
+
+    async def parts(self, blob_id: str) -> List[list]:
+        return orjson.loads(b"".join([chunk async for chunk in self.read_blob(blob_id, 0, sys.maxsize)]))
+
+    async def read(self, blob_id: str, start: int, end: int):
+        if not blob_id.startswith(COMPOSED_BLOB_PREFIX):
+            async for chunk in self.read_blob(blob_id, start, end):
+                yield chunk
+            return
+        offset = 0
+        for part_id, size in await self.parts(blob_id):
+            if offset < end and offset + size > start:
+                async for chunk in self.read_blob(part_id, max(start - offset, 0), min(end - offset, size)):
+                    yield chunk
+            offset += size
+
+    async def delete(self, blob_id: str):
+        if blob_id.startswith(COMPOSED_BLOB_PREFIX):
+            try:
+                parts = await self.parts(blob_id)
+            except (NoFile, OSError):
+                parts = []
+            for part_id, _ in parts:
+                await self.delete_blob(part_id)
+        await self.delete_blob(blob_id)
+
+class GridFSBlobStore(BlobStore):
+    """Blobs stored as GridFS files in the `blobs` bucket"""
+
+    def __init__(self, database):
+        self.bucket = AsyncIOMotorGridFSBucket(database, bucket_name="blobs")
+
+    async def put(self, chunks, blob_id: Optional[str] = None) -> str:
+        blob_id = blob_id or uuid.uuid4().hex
+        stream = self.bucket.open_upload_stream_with_id(blob_id, blob_id)
+        try:
+            async for chunk in chunks:
+                await stream.write(chunk)
+        except BaseException:
+            await stream.abort()
+            raise
+        await stream.close()
+        return blob_id
+
+    async def read_blob(self, blob_id: str, start: int, end: int):
+        stream = await self.bucket.open_download_stream(blob_id)
+        stream.seek(start)
+        while start < end:
+            chunk = await stream.read(min(BLOB_CHUNK_SIZE, end - start))
+            if not chunk:
+                return
+            start += len(chunk)
+            yield chunk
+
+    async def delete_blob(self, blob_id: str):
+        try:
+            await self.bucket.delete(blob_id)
+        except NoFile:
+            pass
+
+class LocalBlobStore(BlobStore):
+    """Blobs stored as files under BLOB_STORE_PATH, fanned out by id prefix"""
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def path(self, blob_id: str) -> Path:
+        return self.root / blob_id.removeprefix(COMPOSED_BLOB_PREFIX)[:2] / blob_id
+
+    async def put(self, chunks, blob_id: Optional[str] = None) -> str:
+        blob_id = blob_id or uuid.uuid4().hex
+        target = self.path(blob_id)
+        partial = target.with_suffix(".partial")
+        await asyncio.to_thread(target.parent.mkdir, parents=True, exist_ok=True)
+        handle = await asyncio.to_thread(open, partial, "wb")
+        try:
+            async for chunk in chunks:
+                await asyncio.to_thread(handle.write, chunk)
+            await asyncio.to_thread(handle.close)
+            await asyncio.to_thread(os.replace, partial, target)
+        except BaseException:
+            handle.close()
+            partial.unlink(missing_ok=True)
+            raise
+        return blob_id
+
+    async def read_blob(self, blob_id: str, start: int, end: int):
+        handle = await asyncio.to_thread(open, self.path(blob_id), "rb")
+        try:
+            handle.seek(start)
+            while start < end:
+                chunk = await asyncio.to_thread(handle.read, min(BLOB_CHUNK_SIZE, end - start))
+                if not chunk:
+                    return
+                start += len(chunk)
+                yield chunk
+        finally:
+            handle.close()
+
+    async def delete_blob(self, blob_id: str):
+        await asyncio.to_thread(self.path(blob_id).unlink, missing_ok=True)
+
+blobs = LocalBlobStore(BLOB_STORE_PATH) if BLOB_STORE == "local" else GridFSBlobStore(db)
+
+def byte_range(header: Optional[str], size: int):
+    """The [start, end) slice asked for by a single-range `Range` header, or None for the whole body"""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if first:
+            start, end = int(first), int(last) + 1 if last else size
+        else:
+            start, end = size - int(last), size
+    except ValueError:
+        return None
+    if first and last and end <= start:
+        # last-pos before first-pos makes the range invalid, which RFC 9110 says to ignore
+        return None
+    start, end = max(start, 0), min(end, size)
+    if start >= end:
+        raise HTTPException(status_code=416, detail="Requested range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+async def attachment_content(attachment: dict, start: int, end: int):
+    """Yield bytes [start, end) of an attachment, whether in the blob store or still inline"""
+    if attachment.get("blob_id"):
+        async for chunk in blobs.read(attachment["blob_id"], start, end):
+            yield chunk
+    else:
+        yield base64.b64decode(attachment["file_data"])[start:end]
+
+async def register_content(blob_id: str, sha256: str, size: int) -> str:
+    """Take a reference to the content with this digest; returns the blob holding it.
+
+    Content seen before keeps its existing blob, and `blob_id` is then the
+    caller's to delete; new content adopts `blob_id`.
+    """
+    while True:
+        existing = await db.blob_contents.find_one_and_update({"_id": sha256}, {"$inc": {"refs": 1}})
+        if existing is not None:
+            return existing["blob_id"]
+        try:
+            await db.blob_contents.insert_one({
+                "_id": sha256, "blob_id": blob_id, "size": size, "refs": 1, "created_at": datetime.utcnow()
+            })
+            return blob_id
+        except DuplicateKeyError:
+            # The same content was registered concurrently; take a reference to that one
+            continue
+
+async def put_content(chunks) -> dict:
+    """Stream content into the blob store once per SHA-256 digest, taking a reference to it"""
+    digest = hashlib.sha256()
+    size = 0
+
+    async def hashed():
+        nonlocal size
+        async for chunk in chunks:
+            digest.update(chunk)
+            size += len(chunk)
+            yield chunk
+
+    written = await blobs.put(hashed())
+    sha256 = digest.hexdigest()
+    blob_id = await register_content(written, sha256, size)
+    if blob_id != written:
+        await blobs.delete(written)
+    return {"blob_id": blob_id, "sha256": sha256, "file_size": size}
+
+async def release_content(attachment: dict):
+    """Drop an attachment's reference to its content, deleting the blob with the last one"""
+    if not attachment.get("sha256"):
+        # Blobs written before content was hashed belong to one attachment
+        if attachment.get("blob_id"):
+            await blobs.delete(attachment["blob_id"])
+        return
+    content = await db.blob_contents.find_one_and_update(
+        {"_id": attachment["sha256"]}, {"$inc": {"refs": -1}}, return_document=ReturnDocument.AFTER
+    )
+    if content is not None and content["refs"] <= 0:
+        # Only while no upload has taken a new reference in the meantime
+        result = await db.blob_contents.delete_one({"_id": content["_id"], "refs": {"$lte": 0}})
+        if result.deleted_count:
+            await blobs.delete(content["blob_id"])
+            for preview in (content.get("previews") or {}).values():
+                await blobs.delete(preview["blob_id"])
+
+# Magic bytes of the accepted file types. Office documents share the ZIP
+# (OOXML) and OLE (legacy) containers, so for those the extension decides
+# which of the allowed types it is.
+MAGIC_TYPES = [
+    (b"%PDF-", "application/pdf"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"PK\x03\x04", "zip"),
+    (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "ole"),
+]
+CONTAINER_TYPES = {
+    "zip": {
+        "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    },
+    "ole": {"application/msword", "application/vnd.ms-excel"},
+}
+SNIFF_BYTES = 16
+
+def sniff_mime_type(head: bytes, filename: str) -> str:
+    """MIME type of a file from its first bytes; raises 400 when the content is not an accepted type"""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    claimed = attachment_mime_type(filename)
+    for magic, mime_type in MAGIC_TYPES:
+        if head.startswith(magic):
+            if mime_type not in CONTAINER_TYPES:
+                return mime_type
+            if claimed in CONTAINER_TYPES[mime_type]:
+                return claimed
+            break
+    else:
+        if claimed in ("text/plain", "text/csv") and b"\x00" not in head:
+            return claimed
+    attachment_logger.info("Content of %s does not match an allowed type", filename)
+    raise HTTPException(status_code=400, detail="File content does not match an allowed type")
+
+# Running SHA-256 of each upload session received by this process:
+# upload id -> (bytes hashed, hasher, session expiry). A session continued by
+# another worker or after a restart is hashed again from its parts on commit.
+# Entries of sessions committed or cancelled elsewhere go once they expire.
+upload_hashers: Dict[str, tuple] = {}
+
+def evict_upload_hashers():
+    now = datetime.utcnow()
+    for upload_id in [upload_id for upload_id, state in upload_hashers.items() if state[2] < now]:
+        upload_hashers.pop(upload_id, None)
+
+async def hash_upload(session: dict) -> str:
+    """SHA-256 of an upload session's received bytes, from this worker's running hash if it has one"""
+    state = upload_hashers.get(session["id"])
+    if state and state[0] == session["file_size"]:
+        return state[1].hexdigest()
+    digest = hashlib.sha256()
+    for part in session["parts"]:
+        async for chunk in blobs.read(part["blob_id"], 0, part["size"]):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+async def discard_upload(session: dict):
+    upload_hashers.pop(session["id"], None)
+    for part in session["parts"]:
+        await blobs.delete(part["blob_id"])
+
+async def expire_upload_sessions() -> int:
+    """Delete upload sessions past their expiry along with the chunks they received"""
+    expired = 0
+    async for session in db.upload_sessions.find({"expires_at": {"$lt": datetime.utcnow()}}):
+        if (await db.upload_sessions.delete_one({"_id": session["_id"]})).deleted_count:
+            await discard_upload(session)
+            expired += 1
+    return expired
+
+async def upload_cleanup_loop():
+    while True:
+        try:
+            evict_upload_hashers()
+            expired = await expire_upload_sessions()
+            if expired:
+                attachment_logger.info("Expired %d upload sessions", expired)
+        except Exception as e:
+            attachment_logger.warning("Upload session cleanup failed: %s", e)
+        await asyncio.sleep(UPLOAD_CLEANUP_SECONDS)
+
+# Attachment entity types (and their aliases) whose entities belong to a
+# company: the collection they live in and the field naming the company,
+# or the location whose company they belong to
+ATTACHMENT_COMPANY_FIELDS = {
+    "companies": ("companies", "id"),
+    "locations": ("locations", "company_id"),
+    "invoices": ("invoices", "company_id"),
+    "onjn_reports": ("onjn_reports", "company_id"),
+    "onjn": ("onjn_reports", "company_id"),
+    "legal_documents": ("legal_documents", "company_id"),
+    "cabinets": ("cabinets", "location_id"),
+    "slot_machines": ("slot_machines", "location_id"),
+    "slots": ("slot_machines", "location_id"),
+}
+
+async def attachment_companies(entities) -> Dict[tuple, str]:
+    """Company owning each (entity_type, entity_id) an attachment hangs off, where there is one"""
+    wanted: Dict[tuple, set] = {}
+    for entity_type, entity_id in entities:
+        if entity_type in ATTACHMENT_COMPANY_FIELDS:
+            wanted.setdefault(ATTACHMENT_COMPANY_FIELDS[entity_type], set()).add(entity_id)
+    owners: Dict[tuple, str] = {}
+    for (collection, field), ids in wanted.items():
+        async for doc in db[collection].find(by_ids(ids), {"_id": 0, "id": 1, field: 1}):
+            owners[(collection, doc["id"])] = doc.get(field)
+    # Equipment belongs to the company of its location
+    location_ids = {
+        owner for (collection, _), owner in owners.items()
+        if owner and collection in ("cabinets", "slot_machines")
+    }
+    location_companies = {}
+    if location_ids:
+        async for location in db.locations.find(by_ids(location_ids), {"_id": 0, "id": 1, "company_id": 1}):
+            location_companies[location["id"]] = location.get("company_id")
+
+    companies = {}
+    for entity_type, entity_id in entities:
+        collection, field = ATTACHMENT_COMPANY_FIELDS.get(entity_type, (None, None))
+        owner = owners.get((collection, entity_id))
+        if field == "location_id":
+            owner = location_companies.get(owner)
+        if owner:
+            companies[(entity_type, entity_id)] = owner
+    return companies
+
+async def storage_report() -> dict:
+    """Attachment bytes referenced versus stored, overall and per owning company.
+
+    Per company, bytes saved counts copies of the same content attached
+    within that company; the totals also count content shared across
+    companies.
+    """
+    groups = await db.attachments.aggregate([
+        {"$group": {
+            "_id": {"entity_type": "$entity_type", "entity_id": "$entity_id", "sha256": "$sha256"},
+            "attachments": {"$sum": 1},
+            "bytes": {"$sum": "$file_size"},
+            "size": {"$max": "$file_size"},
+        }}
+    ]).to_list(None)
+    companies = await attachment_companies({(g["_id"]["entity_type"], g["_id"]["entity_id"]) for g in groups})
+
+    rows: Dict[Optional[str], dict] = {}
+    contents: Dict[Optional[str], set] = {}
+    unhashed_bytes = 0
+    for group in groups:
+        key = group["_id"]
+        company_id = companies.get((key["entity_type"], key["entity_id"]))
+        row = rows.setdefault(company_id, {"attachments": 0, "referenced_bytes": 0, "stored_bytes": 0})
+        row["attachments"] += group["attachments"]
+        row["referenced_bytes"] += group["bytes"]
+        if not key.get("sha256"):
+            # Not hashed yet: every attachment is its own copy
+            row["stored_bytes"] += group["bytes"]
+            unhashed_bytes += group["bytes"]
+        elif key["sha256"] not in contents.setdefault(company_id, set()):
+            contents[company_id].add(key["sha256"])
+            row["stored_bytes"] += group["size"]
+
+    names = {
+        company["id"]: company.get("name")
+        async for company in db.companies.find(by_ids([c for c in rows if c]), {"_id": 0, "id": 1, "name": 1})
+    }
+    report = []
+    for company_id, row in rows.items():
+        row["bytes_saved"] = row["referenced_bytes"] - row["stored_bytes"]
+        report.append({"company_id": company_id, "company_name": names.get(company_id) if company_id else None, **row})
+    report.sort(key=lambda row: row["bytes_saved"], reverse=True)
+
+    stored = await db.blob_contents.aggregate([
+        {"$group": {"_id": None, "contents": {"$sum": 1}, "bytes": {"$sum": "$size"}}}
+    ]).to_list(1)
+    stored = stored[0] if stored else {"contents": 0, "bytes": 0}
+    referenced_bytes = sum(row["referenced_bytes"] for row in report)
+    stored_bytes = stored["bytes"] + unhashed_bytes
+    return {
+        "attachments": sum(row["attachments"] for row in report),
+        "contents": stored["contents"],
+        "referenced_bytes": referenced_bytes,
+        "stored_bytes": stored_bytes,
+        "bytes_saved": referenced_bytes - stored_bytes,
+        "companies": report,
+    }
+
+async def migrate_attachment_blobs():
+    """Move attachment content that is not yet hashed into the deduplicated store.
+
+    Covers base64 `file_data` still inline in attachment documents and blobs
+    written before content was hashed. Runs in the background at startup, one
+    document at a time since each may be close to 16 MB. The swap only applies
+    while the document is unchanged, so a concurrent delete just releases the
+    reference again. Undecodable documents and unreadable blobs are skipped
+    and left for an admin; the migration is then not marked complete, so the
+    next startup looks at them again.
+    """
+    state = await db.migrations.find_one({"_id": ATTACHMENT_CONTENT_MIGRATION_ID}) or {}
+    if state.get("complete"):
+        return
+    skipped = 0
+    moved = 0
+    try:
+        # One cursor in `_id` order: documents it has passed are not looked at again
+        cursor = db.attachments.find({"sha256": {"$exists": False}}).sort("_id", 1).batch_size(1)
+        async for attachment in cursor:
+            if attachment.get("file_data") is not None:
+                try:
+                    data = base64.b64decode(re.sub(r"\s", "", attachment["file_data"]), validate=True)
+                except (TypeError, ValueError):
+                    attachment_logger.warning("Attachment %s has undecodable file_data; left inline", attachment.get("id"))
+                    skipped += 1
+                    continue
+
+                async def inline():
+                    yield data
+
+                content = await put_content(inline())
+                unchanged = {"_id": attachment["_id"], "sha256": {"$exists": False}, "file_data": {"$exists": True}}
+            elif attachment.get("blob_id"):
+                digest = hashlib.sha256()
+                size = 0
+                try:
+                    async for chunk in blobs.read(attachment["blob_id"], 0, attachment["file_size"]):
+                        digest.update(chunk)
+                        size += len(chunk)
+                except (NoFile, OSError) as e:
+                    attachment_logger.warning("Attachment %s blob could not be read (%s); left unhashed", attachment.get("id"), e)
+                    skipped += 1
+                    continue
+                content = {"sha256": digest.hexdigest(), "file_size": size}
+                content["blob_id"] = await register_content(attachment["blob_id"], content["sha256"], size)
+                unchanged = {"_id": attachment["_id"], "sha256": {"$exists": False}, "blob_id": attachment["blob_id"]}
+            else:
+                attachment_logger.warning("Attachment %s has no content", attachment.get("id"))
+                skipped += 1
+                continue
+
+            result = await db.attachments.update_one(unchanged, {"$set": content, "$unset": {"file_data": ""}})
+            if not result.modified_count:
+                await release_content(content)
+            else:
+                if attachment.get("blob_id") and attachment["blob_id"] != content["blob_id"]:
+                    # Superseded by an identical blob already in the store
+                    await blobs.delete(attachment["blob_id"])
+                preview_worker.submit(content["sha256"], attachment.get("mime_type"))
+                moved += 1
+        if not skipped:
+            await db.migrations.update_one(
+                {"_id": ATTACHMENT_CONTENT_MIGRATION_ID},
+                {"$set": {"complete": True, "completed_at": datetime.utcnow()}},
+                upsert=True
+            )
+        logger.info("Moved %d attachments to the content store (%d skipped)", moved, skipped)
+    except Exception as e:
+        logger.error("Attachment content migration stopped after %d attachments: %s", moved, e)
+
+# ============= Previews ============= #
+# Small WebP renders of image attachments and of the first page of PDFs.
+# They are generated in the background after upload and stored in the blob
+# store next to the content they show: `blob_contents.previews` maps each
+# size name to its blob, and an empty map means there is nothing to show.
+PREVIEW_SIZES = {"small": 160, "large": 640}  # longest edge in pixels
+PREVIEW_TYPES = {
+    "image/jpeg", "image/jpg", "image/png", "image/gif", "image/webp", "image/bmp", "image/tiff", "application/pdf"
+}
+PREVIEW_WORKERS = int(os.environ.get('PREVIEW_WORKERS', '2'))
+PREVIEW_QUALITY = int(os.environ.get('PREVIEW_QUALITY', '80'))
+PREVIEW_CACHE_MB = int(os.environ.get('PREVIEW_CACHE_MB', '64'))
+PREVIEW_BACKFILL_BATCH_SIZE = int(os.environ.get('PREVIEW_BACKFILL_BATCH_SIZE', '200'))
+PREVIEW_MAX_PIXELS = int(os.environ.get('PREVIEW_MAX_PIXELS', str(40_000_000)))
+PREVIEW_CLAIM_SECONDS = int(os.environ.get('PREVIEW_CLAIM_SECONDS', '600'))
+
+# Pillow refuses images twice this size on open; smaller ones over
+# PREVIEW_MAX_PIXELS are refused from their header by render_previews
+Image.MAX_IMAGE_PIXELS = PREVIEW_MAX_PIXELS
+
+# pdfium is not thread-safe: PDF pages are rendered one at a time
+pdfium_lock = threading.Lock()
+
+class UnrenderableContent(Exception):
+    """Content that fails to decode or render, and would on every attempt"""
+
+def render_previews(data: bytes, mime_type: str) -> Dict[str, bytes]:
+    """Encode the image, or a PDF's first page, as WebP at each of PREVIEW_SIZES"""
+    edge = max(PREVIEW_SIZES.values())
+    if mime_type == "application/pdf":
+        with pdfium_lock:
+            pdf = pdfium.PdfDocument(data)
+            try:
+                page = pdf[0]
+                image = page.render(scale=edge / max(page.get_size())).to_pil()
+            finally:
+                pdf.close()
+    else:
+        image = Image.open(BytesIO(data))  # reads the header only
+        if image.width * image.height > PREVIEW_MAX_PIXELS:
+            raise ValueError(f"{image.width}x{image.height} image is over the {PREVIEW_MAX_PIXELS} pixel limit")
+        image.draft("RGB", (edge, edge))  # JPEGs decode straight at a reduced scale
+        image = ImageOps.exif_transpose(image)
+    image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+    previews = {}
+    for name, size in PREVIEW_SIZES.items():
+        preview = image.copy()
+        preview.thumbnail((size, size))
+        encoded = BytesIO()
+        preview.save(encoded, "WEBP", quality=PREVIEW_QUALITY)
+        previews[name] = encoded.getvalue()
+    return previews
+
+# Identifies this process in preview claims
+preview_claimant = uuid.uuid4().hex
+
+async def claim_preview(sha256: str) -> bool:
+    """Take on rendering the previews of some content, unless it has them or another process recently claimed it"""
+    now = datetime.utcnow()
+    result = await db.blob_contents.update_one(
+        {
+            "_id": sha256,
+            "previews": {"$exists": False},
+            "$or": [
+                {"preview_claimed_by": preview_claimant},
+                {"preview_claimed_at": {"$not": {"$gt": now - timedelta(seconds=PREVIEW_CLAIM_SECONDS)}}},
+            ],
+        },
+        {"$set": {"preview_claimed_by": preview_claimant, "preview_claimed_at": now}}
+    )
+    return bool(result.modified_count)
+
+PREVIEW_CLAIM_FIELDS = {"preview_claimed_by": "", "preview_claimed_at": ""}
+
+class PreviewWorker:
+    """Generates previews on a small pool of background tasks.
+
+    Uploads queue the digest of their content; decoding and encoding run on a
+    thread pool so the event loop keeps serving requests. Each piece of
+    content is claimed in `blob_contents` first, so only one process renders
+    it. Content that already has previews is skipped, and previews for
+    content deleted meanwhile are thrown away. Content that cannot be
+    rendered gets an empty preview map; other failures (database, blob
+    store) release the claim so that a later backfill tries again.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.tasks: List[asyncio.Task] = []
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preview")
+        self.generated = 0
+        self.failed = 0
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self._executor.shutdown(wait=False)
+
+    def submit(self, sha256: Optional[str], mime_type: str):
+        if sha256 and mime_type in PREVIEW_TYPES:
+            self.queue.put_nowait((sha256, mime_type))
+
+    async def work(self):
+        while True:
+            sha256, mime_type = await self.queue.get()
+            try:
+                await self.generate(sha256, mime_type)
+            except UnrenderableContent as e:
+                self.failed += 1
+                attachment_logger.warning("Preview of %s failed: %s", sha256, e)
+                await db.blob_contents.update_one(
+                    {"_id": sha256, "previews": {"$exists": False}},
+                    {"$set": {"previews": {}}, "$unset": PREVIEW_CLAIM_FIELDS}
+                )
+            except Exception as e:
+                self.failed += 1
+                attachment_logger.warning("Preview of %s failed, left for a later attempt: %s", sha256, e)
+                try:
+                    await db.blob_contents.update_one(
+                        {"_id": sha256, "preview_claimed_by": preview_claimant}, {"$unset": PREVIEW_CLAIM_FIELDS}
+                    )
+                except Exception:
+                    pass  # the claim expires on its own
+            finally:
+                self.queue.task_done()
+
+    async def generate(self, sha256: str, mime_type: str):
+        if not await claim_preview(sha256):
+            return
+        content = await db.blob_contents.find_one({"_id": sha256})
+        if content is None:
+            return
+        data = b"".join([chunk async for chunk in blobs.read(content["blob_id"], 0, content["size"])])
+        try:
+            rendered = await asyncio.get_running_loop().run_in_executor(self._executor, render_previews, data, mime_type)
+        except Exception as e:
+            raise UnrenderableContent(str(e)) from e
+        del data
+        previews = {}
+        for name, image in rendered.items():
+            async def single(image=image):
+                yield image
+            previews[name] = {"blob_id": await blobs.put(single()), "size": len(image)}
+        result = await db.blob_contents.update_one(
+            {"_id": sha256, "previews.small": {"$exists": False}},
+            {"$set": {"previews": previews}, "$unset": PREVIEW_CLAIM_FIELDS}
+        )
+        if not result.modified_count:
+            for preview in previews.values():
+                await blobs.delete(preview["blob_id"])
+            return
+        self.generated += 1
+
+    def stats(self) -> dict:
+        return {"workers": self.workers, "queued": self.queue.qsize(), "generated": self.generated, "failed": self.failed}
+
+preview_worker = PreviewWorker(PREVIEW_WORKERS)
+
+class PreviewCache:
+    """LRU of encoded previews, bounded by their total size in bytes"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._previews = OrderedDict()  # (sha256, size name) -> WebP bytes
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> Optional[bytes]:
+        data = self._previews.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self._previews.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        previous = self._previews.pop(key, None)
+        self.bytes += len(data) - (len(previous) if previous is not None else 0)
+        self._previews[key] = data
+        while self.bytes > self.max_bytes:
+            _, evicted = self._previews.popitem(last=False)
+            self.bytes -= len(evicted)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._previews), "bytes": self.bytes, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
+
+preview_cache = PreviewCache(PREVIEW_CACHE_MB * 1024 * 1024)
+
+async def queue_missing_previews():
+    """Queue previews for stored content that has none yet, e.g. after a restart dropped the queue"""
+    try:
+        last_id = None
+        while True:
+            # Content another process is rendering right now is left to it
+            claimed_since = datetime.utcnow() - timedelta(seconds=PREVIEW_CLAIM_SECONDS)
+            query = {"previews": {"$exists": False}, "preview_claimed_at": {"$not": {"$gt": claimed_since}}}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            batch = await db.blob_contents.find(query, {"_id": 1}).sort("_id", 1).limit(PREVIEW_BACKFILL_BATCH_SIZE).to_list(PREVIEW_BACKFILL_BATCH_SIZE)
+            if not batch:
+                return
+            digests = [content["_id"] for content in batch]
+            previewable = {}
+            async for attachment in db.attachments.find(
+                {"sha256": {"$in": digests}, "mime_type": {"$in": list(PREVIEW_TYPES)}}, {"_id": 0, "sha256": 1, "mime_type": 1}
+            ):
+                previewable[attachment["sha256"]] = attachment["mime_type"]
+            for sha256 in digests:
+                if sha256 in previewable:
+                    if await claim_preview(sha256):
+                        preview_worker.submit(sha256, previewable[sha256])
+                else:
+                    await db.blob_contents.update_one({"_id": sha256, "previews": {"$exists": False}}, {"$set": {"previews": {}}})
+            last_id = digests[-1]
+    except Exception as e:
+        attachment_logger.error("Queueing missing previews stopped: %s", e)
+
+# ============= Pagination ============= #
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', '1000'))
+
+class PageParams:
+    """Keyset pagination query parameters shared by the list endpoints.
+
+    Without `limit` the whole (access-filtered) result set is returned, as
+    before but without the old 1000 row cap. Rows always come in a stable
+    (sort_key, id) order; with `limit`, the `X-Next-Cursor` response header
+    holds the value to pass as `after` for the next page, and
+    `include_total` adds an `X-Total-Count` header.
+    """
+
+    def __init__(
+        self,
+        limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+        after: Optional[str] = None,
+        include_total: bool = False
+    ):
+        self.limit = limit
+        self.after = after
+        self.include_total = include_total
+
+def encode_cursor(sort_value, item_id: str) -> str:
+    if isinstance(sort_value, datetime):
+        value = {"dt": sort_value.isoformat()}
+    else:
+        value = sort_value
+    raw = json.dumps([value, item_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        value, item_id = json.loads(raw)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid pagination cursor")
+    if isinstance(value, dict) and "dt" in value:
+        value = datetime.fromisoformat(value["dt"])
+    return value, item_id
+
+def keyset_filter(sort_key: str, sort_value, item_id: str, descending: bool) -> dict:
+    """Match rows strictly after (sort_value, item_id) in (sort_key, id) order"""
+    op = "$lt" if descending else "$gt"
+    if sort_value is None:
+        # Missing values sort first ascending and last descending
+        if descending:
+            return {sort_key: None, "id": {op: item_id}}
+        return {"$or": [{sort_key: None, "id": {op: item_id}}, {sort_key: {"$ne": None}}]}
+    after_value = {"$or": [{sort_key: {op: sort_value}}, {sort_key: sort_value, "id": {op: item_id}}]}
+    if descending:
+        after_value["$or"].append({sort_key: None})
+    return after_value
+
+async def fetch_page(collection, query: dict, page: PageParams, response: Response,
+                     sort_key: str = "created_at", descending: bool = False,
+                     projection: Optional[dict] = None) -> List[dict]:
+    """Run an access-filtered find with optional keyset pagination.
+
+    `_id` is always projected out; rows are keyed by their `id` field.
+    """
+    projection = {"_id": 0, **(projection or {})}
+    if page.include_total:
+        response.headers["X-Total-Count"] = str(await collection.count_documents(query))
+    
+    direction = -1 if descending else 1
+    order = [(sort_key, direction), ("id", direction)]
+    if page.limit is None and page.after is None:
+        return unique_rows(await collection.find(query, projection).sort(order).to_list(None))
+    
+    limit = page.limit or MAX_PAGE_SIZE
+    fetched = limit + page_lookahead()
+    find_query = page_query(query, page, sort_key, descending)
+    cursor = collection.find(find_query, projection).sort(order).limit(fetched)
+    return trim_page(unique_rows(await cursor.to_list(fetched)), limit, response, sort_key)
+
+async def aggregate_page(collection, query: dict, page: PageParams, response: Response,
+                         stages: List[dict], sort_key: str = "created_at",
+                         descending: bool = False, keys: Optional[List[dict]] = None) -> List[dict]:
+    """Like fetch_page, but runs `stages` (joins, computed fields) on the selected rows only.
+
+    `keys` are stages computing the sort key or `id` on every row; they run
+    ahead of the match, so keyset pages are cut on the computed values.
+    """
+    if page.include_total:
+        response.headers["X-Total-Count"] = str(await collection.count_documents(query))
+    
+    keys = keys or []
+    direction = -1 if descending else 1
+    order = {"$sort": {sort_key: direction, "id": direction}}
+    if page.limit is None and page.after is None:
+        return unique_rows(await collection.aggregate(keys + [{"$match": query}, order] + stages).to_list(None))
+    
+    limit = page.limit or MAX_PAGE_SIZE
+    fetched = limit + page_lookahead()
+    pipeline = keys + [
+        {"$match": page_query(query, page, sort_key, descending)},
+        order,
+        {"$limit": fetched}
+    ]
+    return trim_page(unique_rows(await collection.aggregate(pipeline + stages).to_list(fetched)), limit, response, sort_key)
+
+def page_lookahead() -> int:
+    """Rows fetched past the page: one to detect a next page, plus room for a dropped duplicate"""
+    return 1 if primary_keys.complete else 2
+
+def unique_rows(items: List[dict]) -> List[dict]:
+    """Drop the second copy of a document the primary key migration is moving.
+
+    The re-keyed copy is inserted before the old one is deleted, and the two
+    share their sort key and `id`, so they come out next to each other.
+    """
+    if primary_keys.complete:
+        return items
+    result = []
+    for item in items:
+        if result and item.get("id") is not None and item.get("id") == result[-1].get("id"):
+            continue
+        result.append(item)
+    return result
+
+def page_query(query: dict, page: PageParams, sort_key: str, descending: bool) -> dict:
+    if not page.after:
+        return query
+    sort_value, item_id = decode_cursor(page.after)
+    after_query = keyset_filter(sort_key, sort_value, item_id, descending)
+    return {"$and": [query, after_query]} if query else after_query
+
+def trim_page(items: List[dict], limit: int, response: Response, sort_key: str) -> List[dict]:
+    """Drop the look-ahead row and advertise the next cursor when there is one"""
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(last.get(sort_key), last.get("id"))
+    return items
+
+# ============= Sparse Fieldsets ============= #
+def field_selector(model, hidden: tuple = ()):
+    """Dependency parsing `?fields=a,b,c` against the fields of a response model.
+
+    Returns None when no fields were requested. `id` is always included so
+    rows stay addressable.
+    """
+    allowed = set(model.model_fields) - set(hidden)
+
+    def select_fields(fields: Optional[str] = None) -> Optional[List[str]]:
+        if not fields:
+            return None
+        requested = list(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip()))
+        unknown = [name for name in requested if name not in allowed]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+        if "id" not in requested:
+            requested.insert(0, "id")
+        return requested
+
+    return select_fields
+
+def field_projection(fields: Optional[List[str]], sort_key: str = "created_at") -> Optional[dict]:
+    """Mongo projection for the requested fields plus the keyset sort key"""
+    if not fields:
+        return None
+    projection = {"_id": 0, sort_key: 1}
+    projection.update({name: 1 for name in fields})
+    return projection
+
+def pick_fields(docs: List[dict], fields: List[str]) -> List[dict]:
+    return [{name: doc[name] for name in fields if name in doc} for doc in docs]
+
+def sparse_response(docs: List[dict], fields: List[str], response: Response) -> Response:
+    """Serialize projected rows directly, skipping response_model validation of omitted fields"""
+    return fast_response(pick_fields(docs, fields), response)
+
+# ============= NDJSON Streaming ============= #
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', '500'))
+
+def wants_ndjson(request: Request) -> bool:
+    """Clients opt into streaming with `Accept: application/x-ndjson`"""
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+def json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (ObjectId, uuid.UUID)):
+        return str(value)
+    if isinstance(value, Binary) and value.subtype == UUID_SUBTYPE:
+        return str(value.as_uuid())
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def field_rows(fields: List[str]):
+    """Batch transform that keeps only the requested fields"""
+    async def transform(docs: List[dict]) -> List[dict]:
+        return pick_fields(docs, fields)
+    return transform
+
+def model_rows(model):
+    """Batch transform that shapes rows like the JSON response_model would"""
+    shape = row_shaper(model)
+    async def transform(docs: List[dict]) -> List[dict]:
+        return [shape(doc) for doc in docs]
+    return transform
+
+def ndjson_response(cursor, transform=None) -> StreamingResponse:
+    """Stream a Motor cursor as one JSON document per line.
+
+    Rows are pulled and written one cursor batch at a time, so memory is
+    bounded by STREAM_BATCH_SIZE rather than by the size of the result.
+    `transform` is an async callable applied to each batch, which lets
+    callers resolve related data with one query per batch.
+    """
+    cursor.batch_size(STREAM_BATCH_SIZE)
+
+    async def lines():
+        batch = []
+        async for doc in cursor:
+            batch.append(doc)
+            if len(batch) >= STREAM_BATCH_SIZE:
+                yield await encode_batch(batch)
+                batch = []
+        if batch:
+            yield await encode_batch(batch)
+
+    async def encode_batch(batch: List[dict]) -> str:
+        if transform is not None:
+            batch = await transform(batch)
+        else:
+            for doc in batch:
+                doc.pop("_id", None)
+        return b"".join(orjson.dumps(doc, default=json_default, option=orjson.OPT_APPEND_NEWLINE) for doc in batch)
+
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE)
+
+# ============= Fast Serialization ============= #
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered with orjson; ObjectIds fall back to strings"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+
+def row_shaper(model):
+    """Build a callable that shapes a trusted Mongo document like `model`.
+
+    Documents written through the API already went through the model on the
+    way in, so list endpoints skip re-validating every row: known fields are
+    copied as stored, missing ones get the model default (None when the field
+    is required) and unknown keys are dropped.
+    """
+    defaults = [
+        (name, field.default_factory, None if field.is_required() else field.default)
+        for name, field in model.model_fields.items()
+    ]
+
+    def shape(doc: dict) -> dict:
+        row = {}
+        for name, factory, default in defaults:
+            if name in doc:
+                row[name] = doc[name]
+            else:
+                row[name] = factory() if factory is not None else default
+        return row
+
+    return shape
+
+def fast_response(content, response: Optional[Response] = None) -> FastJSONResponse:
+    """Return already-shaped rows, bypassing response_model validation.
+
+    Pagination headers set on the injected `response` are carried over.
+    """
+    headers = None
+    if response is not None:
+        headers = {name: value for name, value in response.headers.items() if name.lower().startswith("x-")}
+    return FastJSONResponse(content, headers=headers)
+
 def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
 
@@ -588,38 +2760,168 @@ async def check_user_permission(user: User, module: str, action: str) -> bool:
     module_actions = user.permissions.actions.get(module, {})
     return module_actions.get(action, False)
 
-async def get_user_accessible_locations(user: User) -> List[str]:
-    """Get list of location IDs that user has access to"""
+# ============= Access Scopes ============= #
+async def _load_scope_locations(user: User) -> List[str]:
     if user.role == UserRole.ADMIN:
         # Admin sees all locations
-        locations = await db.locations.find({}).to_list(1000)
-        return [loc["id"] for loc in locations]
-    else:
-        # Use explicit permissions if available, fallback to assigned_locations
-        if user.permissions.accessible_locations:
-            return user.permissions.accessible_locations
-        # If no explicit permissions, use assigned_locations (which should be restricted)
-        return user.assigned_locations if user.assigned_locations else []
+        return await db.locations.distinct("id")
+    # Use explicit permissions if available, fallback to assigned_locations
+    if user.permissions.accessible_locations:
+        return user.permissions.accessible_locations
+    # If no explicit permissions, use assigned_locations (which should be restricted)
+    return user.assigned_locations if user.assigned_locations else []
+
+async def _load_scope_companies(user: User) -> List[str]:
+    if user.role == UserRole.ADMIN:
+        # Admin sees all companies
+        return await db.companies.distinct("id")
+    # Use explicit permissions if available
+    if user.permissions.accessible_companies:
+        return user.permissions.accessible_companies
+    
+    # Get companies from accessible locations
+    accessible_locations = await access_scopes.get(user, "locations")
+    if not accessible_locations:
+        return []  # No accessible locations = no accessible companies
+    return await db.locations.distinct("company_id", by_ids(accessible_locations))
+
+async def _load_scope_providers(user: User) -> List[str]:
+    if user.role == UserRole.ADMIN:
+        return await db.providers.distinct("id")
+    # Get providers used in accessible cabinets, resolved on the (location_id, provider_id) index
+    accessible_locations = await access_scopes.get(user, "locations")
+    if not accessible_locations:
+        return []
+    return await db.cabinets.distinct("provider_id", {"location_id": {"$in": list(accessible_locations)}})
+
+async def _load_scope_game_mixes(user: User) -> List[str]:
+    if user.role == UserRole.ADMIN:
+        return await db.game_mixes.distinct("id")
+    # Get game mixes used in accessible slot machines, resolved on the (location_id, game_mix_id) index
+    accessible_locations = await access_scopes.get(user, "locations")
+    if not accessible_locations:
+        return []
+    return await db.slot_machines.distinct("game_mix_id", {"location_id": {"$in": list(accessible_locations)}})
+
+class AccessScopeService:
+    """Materialized per-user sets of accessible location, company, provider and game mix ids.
+
+    Each part is loaded on first use and kept as a frozenset. Writes to
+    locations, companies, cabinets, slot machines and users drop only the
+    parts they can affect; other workers are told through a shared epoch in
+    the `cache_epochs` collection and drop everything on their next sync.
+    """
+
+    loaders = {
+        "locations": _load_scope_locations,
+        "companies": _load_scope_companies,
+        "providers": _load_scope_providers,
+        "game_mixes": _load_scope_game_mixes,
+    }
+
+    def __init__(self):
+        self._scopes = {}  # scope key -> {part: frozenset}
+        self._generation = 0  # bumped on every local invalidation
+        self.synced_epoch = None
+        self.loads = 0
+
+    @staticmethod
+    def _key(user: User) -> str:
+        # All admins share one unrestricted scope
+        return UserRole.ADMIN if user.role == UserRole.ADMIN else user.id
+
+    async def get(self, user: User, part: str) -> frozenset:
+        key = self._key(user)
+        ids = self._scopes.get(key, {}).get(part)
+        if ids is None:
+            generation = self._generation
+            ids = frozenset(await self.loaders[part](user))
+            self.loads += 1
+            # Do not keep a set that was loaded while an invalidation happened
+            if generation == self._generation:
+                self._scopes.setdefault(key, {})[part] = ids
+        return ids
+
+    def _drop(self, parts: tuple, location_ids: Optional[set] = None):
+        """Drop parts from every scope whose locations touch location_ids (all scopes if None)"""
+        self._generation += 1
+        for key, scope in self._scopes.items():
+            if location_ids is not None:
+                # The admin scope does not depend on what sits in a location
+                if key == UserRole.ADMIN:
+                    continue
+                locations = scope.get("locations")
+                if locations is not None and locations.isdisjoint(location_ids):
+                    continue
+            for part in parts:
+                scope.pop(part, None)
+
+    def invalidate_user(self, user_id: str):
+        self._generation += 1
+        self._scopes.pop(user_id, None)
+
+    def clear(self):
+        self._generation += 1
+        self._scopes.clear()
+
+    async def locations_changed(self, *location_ids: Optional[str]):
+        self._generation += 1
+        self._scopes.get(UserRole.ADMIN, {}).pop("locations", None)
+        # Derived company sets follow a location's company_id
+        self._drop(("companies",), {loc for loc in location_ids if loc})
+        await self._publish()
+
+    async def companies_changed(self):
+        self._generation += 1
+        self._scopes.get(UserRole.ADMIN, {}).pop("companies", None)
+        await self._publish()
+
+    async def providers_changed(self):
+        self._generation += 1
+        self._scopes.get(UserRole.ADMIN, {}).pop("providers", None)
+        await self._publish()
+
+    async def game_mixes_changed(self):
+        self._generation += 1
+        self._scopes.get(UserRole.ADMIN, {}).pop("game_mixes", None)
+        await self._publish()
+
+    async def equipment_changed(self, *location_ids: Optional[str]):
+        """Cabinets or slot machines moved in or out of the given locations"""
+        self._drop(("providers", "game_mixes"), {loc for loc in location_ids if loc})
+        await self._publish()
+
+    async def _publish(self):
+        epoch_doc = await db.cache_epochs.find_one_and_update(
+            {"id": "access_scopes"},
+            {"$inc": {"epoch": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        # Only adopt the new epoch if no other worker published in between
+        if self.synced_epoch is not None and epoch_doc["epoch"] == self.synced_epoch + 1:
+            self.synced_epoch = epoch_doc["epoch"]
+
+    async def sync(self):
+        """Drop every scope if another worker published changes since the last sync"""
+        epoch_doc = await db.cache_epochs.find_one({"id": "access_scopes"})
+        epoch = epoch_doc["epoch"] if epoch_doc else 0
+        if epoch != self.synced_epoch:
+            self.clear()
+            self.synced_epoch = epoch
+
+    def stats(self) -> dict:
+        return {"scopes": len(self._scopes), "loads": self.loads, "epoch": self.synced_epoch}
+
+access_scopes = AccessScopeService()
+
+async def get_user_accessible_locations(user: User) -> List[str]:
+    """Get list of location IDs that user has access to"""
+    return list(await access_scopes.get(user, "locations"))
 
 async def get_user_accessible_companies(user: User) -> List[str]:
     """Get list of company IDs that user has access to through locations"""
-    if user.role == UserRole.ADMIN:
-        # Admin sees all companies
-        companies = await db.companies.find({}).to_list(1000)
-        return [comp["id"] for comp in companies]
-    else:
-        # Use explicit permissions if available
-        if user.permissions.accessible_companies:
-            return user.permissions.accessible_companies
-        
-        # Get companies from accessible locations
-        accessible_locations = await get_user_accessible_locations(user)
-        if not accessible_locations:
-            return []  # No accessible locations = no accessible companies
-        
-        locations = await db.locations.find({"id": {"$in": accessible_locations}}).to_list(1000)
-        company_ids = list(set([loc["company_id"] for loc in locations if "company_id" in loc]))
-        return company_ids
+    return list(await access_scopes.get(user, "companies"))
 
 async def filter_by_user_access(user: User, query: dict, entity_type: str) -> dict:
     """Add access control filters to query based on user role and locations"""
@@ -627,47 +2929,25 @@ async def filter_by_user_access(user: User, query: dict, entity_type: str) -> di
         return query  # Admin sees everything
     
     if entity_type == "companies":
-        accessible_companies = await get_user_accessible_companies(user)
-        query["id"] = {"$in": accessible_companies}
+        query.update(by_ids(await get_user_accessible_companies(user)))
     elif entity_type == "locations":
-        accessible_locations = await get_user_accessible_locations(user)
-        query["id"] = {"$in": accessible_locations}
+        query.update(by_ids(await get_user_accessible_locations(user)))
     elif entity_type in ["cabinets", "slot_machines"]:
-        accessible_locations = await get_user_accessible_locations(user)
-        query["location_id"] = {"$in": accessible_locations}
+        query["location_id"] = {"$in": await get_user_accessible_locations(user)}
     elif entity_type in ["providers", "game_mixes"]:
         # These are accessible to managers but not operators
         if user.role == UserRole.OPERATOR:
             # Operators can only see providers/game_mixes used in their locations
-            accessible_locations = await get_user_accessible_locations(user)
-            if entity_type == "providers":
-                # Get providers used in accessible cabinets
-                cabinets = await db.cabinets.find({"location_id": {"$in": accessible_locations}}).to_list(1000)
-                provider_ids = list(set([cab["provider_id"] for cab in cabinets if "provider_id" in cab]))
-                query["id"] = {"$in": provider_ids}
-            elif entity_type == "game_mixes":
-                # Get game mixes used in accessible slot machines
-                slot_machines = await db.slot_machines.find({}).to_list(1000)
-                accessible_slots = []
-                for slot in slot_machines:
-                    # Check if slot has location_id and if it's in accessible locations
-                    if slot.get("location_id") and slot["location_id"] in accessible_locations:
-                        accessible_slots.append(slot)
-                game_mix_ids = list(set([slot["game_mix_id"] for slot in accessible_slots if "game_mix_id" in slot]))
-                query["id"] = {"$in": game_mix_ids}
+            query.update(by_ids(await access_scopes.get(user, entity_type)))
     elif entity_type in ["invoices", "legal_documents"]:
-        accessible_companies = await get_user_accessible_companies(user)
-        accessible_locations = await get_user_accessible_locations(user)
         query["$or"] = [
-            {"company_id": {"$in": accessible_companies}},
-            {"location_id": {"$in": accessible_locations}}
+            {"company_id": {"$in": await get_user_accessible_companies(user)}},
+            {"location_id": {"$in": await get_user_accessible_locations(user)}}
         ]
     elif entity_type == "onjn_reports":
-        accessible_companies = await get_user_accessible_companies(user)
-        accessible_locations = await get_user_accessible_locations(user)
         query["$and"] = [
-            {"company_id": {"$in": accessible_companies}},
-            {"location_id": {"$in": accessible_locations}}
+            {"company_id": {"$in": await get_user_accessible_companies(user)}},
+            {"location_id": {"$in": await get_user_accessible_locations(user)}}
         ]
     
     return query
@@ -683,9 +2963,79 @@ def verify_password(password: str, hashed: str) -> bool:
         # Use bcrypt directly
         return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
     except Exception as e:
-        print(f"❌ Error in verify_password: {e}")
+        auth_logger.warning("Password verification failed: %s", e)
         return False
 
+# ============= Password Hashing ============= #
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_QUEUE = int(os.environ.get('PASSWORD_HASH_MAX_QUEUE', '256'))
+
+class PasswordHasher:
+    """Runs bcrypt on a bounded thread pool so it never stalls the event loop.
+
+    bcrypt releases the GIL, so threads give real parallelism. At most
+    `max_workers` hashes run at once; further callers wait in a queue, and
+    once `max_queue` are waiting new callers get a 503 instead of piling up.
+    """
+
+    def __init__(self, max_workers: int, max_queue: int):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bcrypt")
+        self._slots = asyncio.Semaphore(max_workers)
+        self.waiting = 0
+        self.running = 0
+        self.peak_waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait_seconds = 0.0
+        self.total_run_seconds = 0.0
+
+    async def _run(self, func, *args):
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="Server busy, please retry")
+        
+        self.waiting += 1
+        self.peak_waiting = max(self.peak_waiting, self.waiting)
+        queued_at = time.perf_counter()
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        
+        started_at = time.perf_counter()
+        self.total_wait_seconds += started_at - queued_at
+        self.running += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.running -= 1
+            self.completed += 1
+            self.total_run_seconds += time.perf_counter() - started_at
+            self._slots.release()
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._run(verify_password, password, hashed)
+
+    def stats(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "running": self.running,
+            "waiting": self.waiting,
+            "peak_waiting": self.peak_waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait_seconds * 1000 / self.completed, 2) if self.completed else 0.0,
+            "avg_run_ms": round(self.total_run_seconds * 1000 / self.completed, 2) if self.completed else 0.0
+        }
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_QUEUE)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -695,17 +3045,295 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
+PERMISSION_ACTIONS = ["create", "read", "update", "delete"]
+
+def permission_digest(permissions: dict) -> str:
+    """Pack module and action flags into a compact hex bitmask.
+
+    Bits are emitted per module in UserPermissions order: the module flag
+    followed by create/read/update/delete.
+    """
+    modules = permissions.get("modules", {})
+    actions = permissions.get("actions", {})
+    bits = 0
+    for module in UserPermissions.model_fields["modules"].default:
+        bits = (bits << 1) | bool(modules.get(module))
+        module_actions = actions.get(module, {})
+        for action in PERMISSION_ACTIONS:
+            bits = (bits << 1) | bool(module_actions.get(action))
+    return format(bits, "x")
+
+def permissions_from_digest(digest: str, scope: dict) -> UserPermissions:
+    """Inverse of permission_digest, with the accessible ids carried in the `scope` claim"""
+    bits = int(digest, 16)
+    modules, actions = {}, {}
+    for module in reversed(UserPermissions.model_fields["modules"].default):
+        module_actions = {}
+        for action in reversed(PERMISSION_ACTIONS):
+            module_actions[action] = bool(bits & 1)
+            bits >>= 1
+        modules[module] = bool(bits & 1)
+        bits >>= 1
+        if module in UserPermissions.model_fields["actions"].default:
+            actions[module] = module_actions
+    return UserPermissions(
+        modules=modules,
+        actions=actions,
+        accessible_companies=scope.get("companies", []),
+        accessible_locations=scope.get("locations", [])
+    )
+
+def principal_from_claims(payload: dict) -> User:
+    """The user an access token describes, built without reading the `users` collection"""
+    scope = payload["scope"]
+    return User(
+        id=payload["sub"],
+        username=payload.get("preferred_username", ""),
+        email=payload.get("email", ""),
+        password_hash="",
+        first_name=payload.get("given_name", ""),
+        last_name=payload.get("family_name", ""),
+        role=payload["role"],
+        assigned_locations=scope.get("assigned", []),
+        permissions=permissions_from_digest(payload["perm"], scope)
+    )
+
+async def issue_tokens(user: dict, version: Optional[int] = None) -> dict:
+    """Create an access/refresh token pair carrying the user's role, permissions, scope and version"""
+    if version is None:
+        version = await get_user_version(user["id"])
+    permissions = user.get("permissions") or UserPermissions().model_dump()
+    # Only the non-empty lists are sent; admins are not restricted by any of them
+    scope = {} if user.get("role") == UserRole.ADMIN else {
+        name: ids for name, ids in (
+            ("locations", permissions.get("accessible_locations")),
+            ("companies", permissions.get("accessible_companies")),
+            ("assigned", user.get("assigned_locations")),
+        ) if ids
+    }
+    access_token = create_access_token(
+        data={
+            "sub": user["id"],
+            "typ": "access",
+            "role": user.get("role"),
+            "perm": permission_digest(permissions),
+            "scope": scope,
+            "preferred_username": user.get("username", ""),
+            "email": user.get("email", ""),
+            "given_name": user.get("first_name", ""),
+            "family_name": user.get("last_name", ""),
+            "sv": version
+        },
+        expires_delta=timedelta(minutes=JWT_ACCESS_TOKEN_EXPIRE_MINUTES)
+    )
+    refresh_token = create_access_token(
+        data={"sub": user["id"], "typ": "refresh", "sv": version},
+        expires_delta=timedelta(days=JWT_REFRESH_TOKEN_EXPIRE_DAYS)
+    )
+    return {
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "token_type": "bearer",
+        "expires_in": JWT_ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    }
+
+# ============= Principal Cache ============= #
+PRINCIPAL_CACHE_SIZE = int(os.environ.get('PRINCIPAL_CACHE_SIZE', '1024'))
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.environ.get('PRINCIPAL_CACHE_TTL_SECONDS', '300'))
+CACHE_SYNC_INTERVAL_SECONDS = float(os.environ.get('CACHE_SYNC_INTERVAL_SECONDS', '5'))
+
+class PrincipalCache:
+    """Bounded LRU cache of authenticated users keyed by user id and version.
+
+    Versions are published in the `user_versions` collection whenever a user
+    is changed, so workers that did not make the change drop their copy on
+    the next sync.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # user_id -> (version, loaded_at, User)
+        self._versions = {}  # user_id -> newest version seen by this worker
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def known_version(self, user_id: str) -> int:
+        return self._versions.get(user_id, 0)
+
+    def get(self, user_id: str) -> Optional[User]:
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            version, loaded_at, user = entry
+            if version >= self.known_version(user_id) and time.monotonic() - loaded_at < self.ttl_seconds:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return user
+            del self._entries[user_id]
+        self.misses += 1
+        return None
+
+    def put(self, user_id: str, user: User, version: int):
+        """Cache a user loaded while `version` was the newest known version"""
+        self._entries[user_id] = (version, time.monotonic(), user)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def observe_version(self, user_id: str, version: int) -> bool:
+        """Record a published version and drop any older cached copy"""
+        if version <= self.known_version(user_id):
+            return False
+        self._versions[user_id] = version
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0] < version:
+            del self._entries[user_id]
+        return True
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL_SECONDS)
+
+# ============= Display Names ============= #
+DISPLAY_NAME_CACHE_SIZE = int(os.environ.get('DISPLAY_NAME_CACHE_SIZE', '4096'))
+DISPLAY_NAME_TTL_SECONDS = float(os.environ.get('DISPLAY_NAME_TTL_SECONDS', '60'))
+
+def full_name(user: dict) -> str:
+    return f"{user.get('first_name') or ''} {user.get('last_name') or ''}".strip()
+
+class DisplayNameResolver:
+    """Resolve user ids to full names for a whole page of rows at once.
+
+    Ids missing from the small TTL cache are fetched with one `$in` query.
+    Unknown users resolve to None. Entries are dropped whenever a newer user
+    version is observed, i.e. after update_user or delete_user on any worker.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._names = OrderedDict()  # user_id -> (loaded_at, name or None)
+        self.hits = 0
+        self.misses = 0
+
+    async def resolve(self, user_ids) -> Dict[str, Optional[str]]:
+        now = time.monotonic()
+        names = {}
+        missing = []
+        for user_id in set(filter(None, user_ids)):
+            entry = self._names.get(user_id)
+            if entry is not None and now - entry[0] < self.ttl_seconds:
+                self._names.move_to_end(user_id)
+                names[user_id] = entry[1]
+                self.hits += 1
+            else:
+                missing.append(user_id)
+        if missing:
+            self.misses += len(missing)
+            users = await db.users.find(
+                by_ids(missing),
+                {"_id": 0, "id": 1, "first_name": 1, "last_name": 1}
+            ).to_list(None)
+            found = {user["id"]: full_name(user) for user in users}
+            for user_id in missing:
+                names[user_id] = found.get(user_id)
+                self._names[user_id] = (now, names[user_id])
+                self._names.move_to_end(user_id)
+            while len(self._names) > self.max_size:
+                self._names.popitem(last=False)
+        return names
+
+    def invalidate(self, user_id: str):
+        self._names.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {"size": len(self._names), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+display_names = DisplayNameResolver(DISPLAY_NAME_CACHE_SIZE, DISPLAY_NAME_TTL_SECONDS)
+
+def observe_user_version(user_id: str, version: int):
+    """Drop cached state for a user once a newer version is known"""
+    if principal_cache.observe_version(user_id, version):
+        access_scopes.invalidate_user(user_id)
+        display_names.invalidate(user_id)
+
+async def bump_user_version(user_id: str) -> int:
+    """Publish a new version for a user so every worker reloads it"""
+    version_doc = await db.user_versions.find_one_and_update(
+        {"id": user_id},
+        {"$inc": {"version": 1}, "$set": {"updated_at": datetime.utcnow()}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    observe_user_version(user_id, version_doc["version"])
+    return version_doc["version"]
+
+async def get_user_version(user_id: str) -> int:
+    version_doc = await db.user_versions.find_one({"id": user_id})
+    version = version_doc["version"] if version_doc else 0
+    observe_user_version(user_id, version)
+    return version
+
+async def sync_user_versions(since: datetime):
+    """Pull versions published by other workers since the given time"""
+    cursor = db.user_versions.find({"updated_at": {"$gte": since}}, {"_id": 0, "id": 1, "version": 1})
+    async for version_doc in cursor:
+        observe_user_version(version_doc["id"], version_doc["version"])
+
+async def cache_sync_loop():
+    """Keep worker-local caches in line with changes made by other workers"""
+    since = datetime.min
+    while True:
+        started = datetime.utcnow()
+        try:
+            await sync_user_versions(since)
+            await access_scopes.sync()
+            if not primary_keys.complete:
+                await primary_keys.load()
+            # Overlap the windows a little to absorb clock skew between workers
+            since = started - timedelta(seconds=CACHE_SYNC_INTERVAL_SECONDS)
+        except Exception as e:
+            logger.warning("Cache sync failed: %s", e)
+        await asyncio.sleep(CACHE_SYNC_INTERVAL_SECONDS)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         user_id: str = payload.get("sub")
-        if user_id is None:
+        if user_id is None or payload.get("typ", "access") != "access":
             raise HTTPException(status_code=401, detail="Invalid authentication credentials")
         
-        user = await db.users.find_one({"id": user_id})
-        if user is None:
-            raise HTTPException(status_code=401, detail="User not found")
-        return User(**user)
+        # A token issued after a change carries the newer version, so this worker
+        # drops its stale copy right away instead of waiting for the next sync
+        observe_user_version(user_id, payload.get("sv", 0))
+        
+        cached_user = principal_cache.get(user_id)
+        if cached_user is not None:
+            return cached_user
+        
+        # Capture the version before loading so a concurrent change marks this copy stale
+        version = principal_cache.known_version(user_id)
+        if payload.get("sv", 0) == version and "scope" in payload:
+            # Nothing changed since the token was issued, so its claims are current
+            user_obj = principal_from_claims(payload)
+        else:
+            user = await db.users.find_one(by_id(user_id))
+            if user is None or not user.get("is_active", True):
+                raise HTTPException(status_code=401, detail="User not found or inactive")
+            user_obj = User(**user)
+        principal_cache.put(user_id, user_obj, version)
+        return user_obj
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
 
@@ -718,7 +3346,7 @@ async def geocode_address(address: str, city: str, country: str = "Romania"):
             return location.latitude, location.longitude
         return None, None
     except Exception as e:
-        print(f"Geocoding error: {e}")
+        logger.warning("Geocoding error: %s", e)
         return None, None
 
 # Routes
@@ -731,50 +3359,43 @@ async def register(user_data: UserCreate):
     
     # Create new user
     user_dict = user_data.model_dump()
-    user_dict["password_hash"] = hash_password(user_data.password)
+    user_dict["password_hash"] = await password_hasher.hash(user_data.password)
     del user_dict["password"]
     # Ensure permissions is always a valid dict
     if not user_dict.get("permissions"):
         from pydantic import parse_obj_as
         user_dict["permissions"] = UserPermissions().model_dump()
     user_obj = User(**user_dict)
-    await db.users.insert_one(user_obj.model_dump())
+    try:
+        await db.users.insert_one(keyed(user_obj.model_dump()))
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Username or email already registered")
+    await record_activity(None, "created", "users", user_obj.model_dump())
     
     return {"message": "User created successfully", "user_id": user_obj.id}
 
 @api_router.post("/auth/login", response_model=dict)
 async def login(user_data: UserLogin):
-    print(f"🔍 Login attempt for username: {user_data.username}")
-    print(f"🔍 Password received: '{user_data.password}' (length: {len(user_data.password)})")
-    print(f"🔍 Password type: {type(user_data.password)}")
+    auth_logger.debug("Login attempt", extra={"username": user_data.username})
     
     user = await db.users.find_one({"username": user_data.username})
-    print(f"👤 User found: {user is not None}")
-    
     if not user:
-        print("❌ User not found")
+        auth_logger.info("Login failed: unknown user", extra={"username": user_data.username})
         raise HTTPException(status_code=401, detail="Invalid username or password")
     
-    print(f"🔐 Hash from database: {user['password_hash']}")
-    print(f"🔐 User ID: {user.get('id', 'N/A')}")
-    print(f"🔐 Created at: {user.get('created_at', 'N/A')}")
-    print(f"🔐 Password verification for user: {user['username']}")
-    password_valid = verify_password(user_data.password, user["password_hash"])
-    print(f"✅ Password valid: {password_valid}")
-    
+    password_valid = await password_hasher.verify(user_data.password, user["password_hash"])
     if not password_valid:
-        print("❌ Password invalid")
+        auth_logger.info("Login failed: invalid password", extra={"username": user_data.username})
         raise HTTPException(status_code=401, detail="Invalid username or password")
     
     if not user.get("is_active", True):
-        print("❌ Account inactive")
+        auth_logger.info("Login failed: account inactive", extra={"username": user_data.username})
         raise HTTPException(status_code=401, detail="Account is inactive")
     
-    print("🎉 Login successful, creating token")
-    access_token = create_access_token(data={"sub": user["id"]})
+    auth_logger.debug("Login successful", extra={"username": user_data.username, "user_id": user["id"]})
+    tokens = await issue_tokens(user)
     return {
-        "access_token": access_token, 
-        "token_type": "bearer", 
+        **tokens,
         "user": {
             "id": user["id"], 
             "username": user["username"], 
@@ -784,6 +3405,27 @@ async def login(user_data: UserLogin):
         }
     }
 
+@api_router.post("/auth/refresh", response_model=dict)
+async def refresh_access_token(token_data: TokenRefresh):
+    try:
+        payload = jwt.decode(token_data.refresh_token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except jwt.PyJWTError:
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    
+    if payload.get("typ") != "refresh" or payload.get("sub") is None:
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    
+    # A change to the user since the token was issued revokes it
+    version = await get_user_version(payload["sub"])
+    if payload.get("sv", 0) < version:
+        raise HTTPException(status_code=401, detail="Refresh token revoked, please log in again")
+    
+    user = await db.users.find_one(by_id(payload["sub"]))
+    if not user or not user.get("is_active", True):
+        raise HTTPException(status_code=401, detail="User not found or inactive")
+    
+    return await issue_tokens(user, version)
+
 @api_router.get("/auth/me", response_model=dict)
 async def get_current_user_info(current_user: User = Depends(get_current_user)):
     return {
@@ -810,25 +3452,30 @@ async def create_company(company_data: CompanyCreate, current_user: User = Depen
     company_dict["created_by"] = current_user.id
     company_obj = Company(**company_dict)
     
-    await db.companies.insert_one(company_obj.model_dump())
+    try:
+        await db.companies.insert_one(keyed(company_obj.model_dump()))
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Company name already exists")
+    await access_scopes.companies_changed()
+    await record_activity(current_user, "created", "companies", company_obj.model_dump())
     return company_obj
 
-@api_router.get("/companies", response_model=List[Company])
-async def get_companies(current_user: User = Depends(get_current_user)):
+@api_router.get("/companies", response_model=List[Company], dependencies=[Depends(query_budget(6))])
+async def get_companies(response: Response, page: PageParams = Depends(), fields: Optional[List[str]] = Depends(field_selector(Company)), current_user: User = Depends(get_current_user)):
     query = await filter_by_user_access(current_user, {}, "companies")
-    companies = await db.companies.find(query).to_list(1000)
-    # Convert ObjectIds to strings
-    companies = [convert_objectid_to_str(company) for company in companies]
-    return [Company(**company) for company in companies]
+    companies = await fetch_page(db.companies, query, page, response, projection=field_projection(fields))
+    if fields:
+        return sparse_response(companies, fields, response)
+    shape = row_shaper(Company)
+    return fast_response([shape(company) for company in companies], response)
 
 @api_router.get("/companies/{company_id}", response_model=Company)
 async def get_company(company_id: str, current_user: User = Depends(get_current_user)):
     # Check if user has access to this company
-    accessible_companies = await get_user_accessible_companies(current_user)
-    if current_user.role != UserRole.ADMIN and company_id not in accessible_companies:
+    if current_user.role != UserRole.ADMIN and company_id not in await access_scopes.get(current_user, "companies"):
         raise HTTPException(status_code=403, detail="Access denied to this company")
     
-    company = await db.companies.find_one({"id": company_id})
+    company = await db.companies.find_one(by_id(company_id))
     if not company:
         raise HTTPException(status_code=404, detail="Company not found")
     return Company(**company)
@@ -838,14 +3485,18 @@ async def update_company(company_id: str, company_data: CompanyCreate, current_u
     if current_user.role not in [UserRole.ADMIN, UserRole.MANAGER]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
-    company = await db.companies.find_one({"id": company_id})
+    company = await db.companies.find_one(by_id(company_id))
     if not company:
         raise HTTPException(status_code=404, detail="Company not found")
     
     update_data = company_data.model_dump()
-    await db.companies.update_one({"id": company_id}, {"$set": update_data})
+    try:
+        await db.companies.update_one(by_id(company_id), {"$set": update_data})
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Company name already exists")
     
-    updated_company = await db.companies.find_one({"id": company_id})
+    updated_company = await db.companies.find_one(by_id(company_id))
+    await record_activity(current_user, "updated", "companies", updated_company)
     return Company(**updated_company)
 
 @api_router.delete("/companies/{company_id}")
@@ -853,12 +3504,14 @@ async def delete_company(company_id: str, current_user: User = Depends(get_curre
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    company = await db.companies.find_one({"id": company_id})
+    company = await db.companies.find_one(by_id(company_id))
     if not company:
         raise HTTPException(status_code=404, detail="Company not found")
     
     # HARD DELETE - actually remove from database
-    await db.companies.delete_one({"id": company_id})
+    await db.companies.delete_one(by_id(company_id))
+    await access_scopes.companies_changed()
+    await record_activity(current_user, "deleted", "companies", company)
     return {"message": "Company deleted successfully"}
 
 @api_router.post("/companies/bulk-delete")
@@ -867,7 +3520,7 @@ async def bulk_delete_companies(company_ids: List[str], current_user: User = Dep
         raise HTTPException(status_code=403, detail="Admin access required")
     
     # Verify all companies exist
-    companies = await db.companies.find({"id": {"$in": company_ids}}).to_list(1000)
+    companies = await db.companies.find(by_ids(company_ids)).to_list(1000)
     found_ids = {company["id"] for company in companies}
     missing_ids = set(company_ids) - found_ids
     
@@ -875,7 +3528,9 @@ async def bulk_delete_companies(company_ids: List[str], current_user: User = Dep
         raise HTTPException(status_code=404, detail=f"Companies not found: {', '.join(missing_ids)}")
     
     # HARD DELETE - actually remove from database
-    result = await db.companies.delete_many({"id": {"$in": company_ids}})
+    result = await db.companies.delete_many(by_ids(company_ids))
+    await access_scopes.companies_changed()
+    await record_activity(current_user, "deleted", "companies", *companies)
     
     return {"message": f"Successfully deleted {result.deleted_count} companies"}
 
@@ -885,7 +3540,7 @@ async def create_location(location_data: LocationCreate, current_user: User = De
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
     # Verify company exists
-    company = await db.companies.find_one({"id": location_data.company_id})
+    company = await db.companies.find_one(by_id(location_data.company_id))
     if not company:
         raise HTTPException(status_code=400, detail="Company not found")
     
@@ -894,7 +3549,7 @@ async def create_location(location_data: LocationCreate, current_user: User = De
     
     # If manager_id is provided, get manager details and populate phone/email
     if location_data.manager_id:
-        manager = await db.users.find_one({"id": location_data.manager_id})
+        manager = await db.users.find_one(by_id(location_data.manager_id))
         if manager:
             location_dict["manager_phone"] = manager.get("phone", "")
             location_dict["manager_email"] = manager.get("email", "")
@@ -905,25 +3560,27 @@ async def create_location(location_data: LocationCreate, current_user: User = De
     location_dict["longitude"] = lng
     
     location_obj = Location(**location_dict)
-    await db.locations.insert_one(location_obj.model_dump())
+    await db.locations.insert_one(keyed(location_obj.model_dump()))
+    await access_scopes.locations_changed(location_obj.id)
+    await record_activity(current_user, "created", "locations", location_obj.model_dump())
     return location_obj
 
 @api_router.get("/locations", response_model=List[Location])
-async def get_locations(current_user: User = Depends(get_current_user)):
+async def get_locations(response: Response, page: PageParams = Depends(), fields: Optional[List[str]] = Depends(field_selector(Location)), current_user: User = Depends(get_current_user)):
     query = await filter_by_user_access(current_user, {}, "locations")
-    locations = await db.locations.find(query).to_list(1000)
-    # Convert ObjectIds to strings
-    locations = [convert_objectid_to_str(location) for location in locations]
-    return [Location(**location) for location in locations]
+    locations = await fetch_page(db.locations, query, page, response, projection=field_projection(fields))
+    if fields:
+        return sparse_response(locations, fields, response)
+    shape = row_shaper(Location)
+    return fast_response([shape(location) for location in locations], response)
 
 @api_router.get("/locations/{location_id}", response_model=Location)
 async def get_location(location_id: str, current_user: User = Depends(get_current_user)):
     # Check if user has access to this location
-    accessible_locations = await get_user_accessible_locations(current_user)
-    if current_user.role != UserRole.ADMIN and location_id not in accessible_locations:
+    if current_user.role != UserRole.ADMIN and location_id not in await access_scopes.get(current_user, "locations"):
         raise HTTPException(status_code=403, detail="Access denied to this location")
     
-    location = await db.locations.find_one({"id": location_id})
+    location = await db.locations.find_one(by_id(location_id))
     if not location:
         raise HTTPException(status_code=404, detail="Location not found")
     return Location(**location)
@@ -933,7 +3590,7 @@ async def update_location(location_id: str, location_data: LocationCreate, curre
     if current_user.role not in [UserRole.ADMIN, UserRole.MANAGER]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
-    location = await db.locations.find_one({"id": location_id})
+    location = await db.locations.find_one(by_id(location_id))
     if not location:
         raise HTTPException(status_code=404, detail="Location not found")
     
@@ -941,7 +3598,7 @@ async def update_location(location_id: str, location_data: LocationCreate, curre
     
     # If manager_id is provided, get manager details and populate phone/email
     if location_data.manager_id:
-        manager = await db.users.find_one({"id": location_data.manager_id})
+        manager = await db.users.find_one(by_id(location_data.manager_id))
         if manager:
             update_data["manager_phone"] = manager.get("phone", "")
             update_data["manager_email"] = manager.get("email", "")
@@ -956,9 +3613,12 @@ async def update_location(location_id: str, location_data: LocationCreate, curre
         update_data["latitude"] = lat
         update_data["longitude"] = lng
     
-    await db.locations.update_one({"id": location_id}, {"$set": update_data})
+    await db.locations.update_one(by_id(location_id), {"$set": update_data})
+    if location_data.company_id != location.get("company_id"):
+        await access_scopes.locations_changed(location_id)
     
-    updated_location = await db.locations.find_one({"id": location_id})
+    updated_location = await db.locations.find_one(by_id(location_id))
+    await record_activity(current_user, "updated", "locations", updated_location)
     return Location(**updated_location)
 
 @api_router.delete("/locations/{location_id}")
@@ -966,12 +3626,14 @@ async def delete_location(location_id: str, current_user: User = Depends(get_cur
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    location = await db.locations.find_one({"id": location_id})
+    location = await db.locations.find_one(by_id(location_id))
     if not location:
         raise HTTPException(status_code=404, detail="Location not found")
     
     # HARD DELETE - actually remove from database
-    await db.locations.delete_one({"id": location_id})
+    await db.locations.delete_one(by_id(location_id))
+    await access_scopes.locations_changed(location_id)
+    await record_activity(current_user, "deleted", "locations", location)
     return {"message": "Location deleted successfully"}
 
 @api_router.post("/locations/bulk-delete")
@@ -980,7 +3642,7 @@ async def bulk_delete_locations(location_ids: List[str], current_user: User = De
         raise HTTPException(status_code=403, detail="Admin access required")
     
     # Verify all locations exist
-    locations = await db.locations.find({"id": {"$in": location_ids}}).to_list(1000)
+    locations = await db.locations.find(by_ids(location_ids)).to_list(1000)
     found_ids = {location["id"] for location in locations}
     missing_ids = set(location_ids) - found_ids
     
@@ -988,7 +3650,9 @@ async def bulk_delete_locations(location_ids: List[str], current_user: User = De
         raise HTTPException(status_code=404, detail=f"Locations not found: {', '.join(missing_ids)}")
     
     # HARD DELETE - actually remove from database
-    result = await db.locations.delete_many({"id": {"$in": location_ids}})
+    result = await db.locations.delete_many(by_ids(location_ids))
+    await access_scopes.locations_changed(*location_ids)
+    await record_activity(current_user, "deleted", "locations", *locations)
     
     return {"message": f"Successfully deleted {result.deleted_count} locations"}
 
@@ -1006,20 +3670,26 @@ async def create_provider(provider_data: ProviderCreate, current_user: User = De
     provider_dict["created_by"] = current_user.id
     provider_obj = Provider(**provider_dict)
     
-    await db.providers.insert_one(provider_obj.model_dump())
+    try:
+        await db.providers.insert_one(keyed(provider_obj.model_dump()))
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Provider name already exists")
+    await access_scopes.providers_changed()
+    await record_activity(current_user, "created", "providers", provider_obj.model_dump())
     return provider_obj
 
 @api_router.get("/providers", response_model=List[Provider])
-async def get_providers(current_user: User = Depends(get_current_user)):
+async def get_providers(response: Response, page: PageParams = Depends(), fields: Optional[List[str]] = Depends(field_selector(Provider)), current_user: User = Depends(get_current_user)):
     query = await filter_by_user_access(current_user, {}, "providers")
-    providers = await db.providers.find(query).to_list(1000)
-    # Convert ObjectIds to strings
-    providers = [convert_objectid_to_str(provider) for provider in providers]
-    return [Provider(**provider) for provider in providers]
+    providers = await fetch_page(db.providers, query, page, response, projection=field_projection(fields))
+    if fields:
+        return sparse_response(providers, fields, response)
+    shape = row_shaper(Provider)
+    return fast_response([shape(provider) for provider in providers], response)
 
 @api_router.get("/providers/{provider_id}", response_model=Provider)
 async def get_provider(provider_id: str, current_user: User = Depends(get_current_user)):
-    provider = await db.providers.find_one({"id": provider_id})
+    provider = await db.providers.find_one(by_id(provider_id))
     if not provider:
         raise HTTPException(status_code=404, detail="Provider not found")
     return Provider(**provider)
@@ -1029,14 +3699,18 @@ async def update_provider(provider_id: str, provider_data: ProviderCreate, curre
     if current_user.role not in [UserRole.ADMIN, UserRole.MANAGER]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
-    provider = await db.providers.find_one({"id": provider_id})
+    provider = await db.providers.find_one(by_id(provider_id))
     if not provider:
         raise HTTPException(status_code=404, detail="Provider not found")
     
     update_data = provider_data.model_dump()
-    await db.providers.update_one({"id": provider_id}, {"$set": update_data})
+    try:
+        await db.providers.update_one(by_id(provider_id), {"$set": update_data})
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Provider name already exists")
     
-    updated_provider = await db.providers.find_one({"id": provider_id})
+    updated_provider = await db.providers.find_one(by_id(provider_id))
+    await record_activity(current_user, "updated", "providers", updated_provider)
     return Provider(**updated_provider)
 
 @api_router.delete("/providers/{provider_id}")
@@ -1044,12 +3718,14 @@ async def delete_provider(provider_id: str, current_user: User = Depends(get_cur
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    provider = await db.providers.find_one({"id": provider_id})
+    provider = await db.providers.find_one(by_id(provider_id))
     if not provider:
         raise HTTPException(status_code=404, detail="Provider not found")
     
     # HARD DELETE - actually remove from database
-    await db.providers.delete_one({"id": provider_id})
+    await db.providers.delete_one(by_id(provider_id))
+    await access_scopes.providers_changed()
+    await record_activity(current_user, "deleted", "providers", provider)
     return {"message": "Provider deleted successfully"}
 
 @api_router.post("/game-mixes", response_model=GameMix)
@@ -1058,7 +3734,7 @@ async def create_game_mix(game_mix_data: GameMixCreate, current_user: User = Dep
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
     # Verify provider exists
-    provider = await db.providers.find_one({"id": game_mix_data.provider_id})
+    provider = await db.providers.find_one(by_id(game_mix_data.provider_id))
     if not provider:
         raise HTTPException(status_code=400, detail="Provider not found")
     
@@ -1067,20 +3743,23 @@ async def create_game_mix(game_mix_data: GameMixCreate, current_user: User = Dep
     game_mix_dict["game_count"] = len(game_mix_data.games)
     game_mix_obj = GameMix(**game_mix_dict)
     
-    await db.game_mixes.insert_one(game_mix_obj.model_dump())
+    await db.game_mixes.insert_one(keyed(game_mix_obj.model_dump()))
+    await access_scopes.game_mixes_changed()
+    await record_activity(current_user, "created", "game_mixes", game_mix_obj.model_dump())
     return game_mix_obj
 
 @api_router.get("/game-mixes", response_model=List[GameMix])
-async def get_game_mixes(current_user: User = Depends(get_current_user)):
+async def get_game_mixes(response: Response, page: PageParams = Depends(), fields: Optional[List[str]] = Depends(field_selector(GameMix)), current_user: User = Depends(get_current_user)):
     query = await filter_by_user_access(current_user, {}, "game_mixes")
-    game_mixes = await db.game_mixes.find(query).to_list(1000)
-    # Convert ObjectIds to strings
-    game_mixes = [convert_objectid_to_str(game_mix) for game_mix in game_mixes]
-    return [GameMix(**game_mix) for game_mix in game_mixes]
+    game_mixes = await fetch_page(db.game_mixes, query, page, response, projection=field_projection(fields))
+    if fields:
+        return sparse_response(game_mixes, fields, response)
+    shape = row_shaper(GameMix)
+    return fast_response([shape(game_mix) for game_mix in game_mixes], response)
 
 @api_router.get("/game-mixes/{game_mix_id}", response_model=GameMix)
 async def get_game_mix(game_mix_id: str, current_user: User = Depends(get_current_user)):
-    game_mix = await db.game_mixes.find_one({"id": game_mix_id})
+    game_mix = await db.game_mixes.find_one(by_id(game_mix_id))
     if not game_mix:
         raise HTTPException(status_code=404, detail="Game mix not found")
     return GameMix(**game_mix)
@@ -1090,15 +3769,16 @@ async def update_game_mix(game_mix_id: str, game_mix_data: GameMixCreate, curren
     if current_user.role not in [UserRole.ADMIN, UserRole.MANAGER]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
-    game_mix = await db.game_mixes.find_one({"id": game_mix_id})
+    game_mix = await db.game_mixes.find_one(by_id(game_mix_id))
     if not game_mix:
         raise HTTPException(status_code=404, detail="Game mix not found")
     
     update_data = game_mix_data.model_dump()
     update_data["game_count"] = len(game_mix_data.games)
-    await db.game_mixes.update_one({"id": game_mix_id}, {"$set": update_data})
+    await db.game_mixes.update_one(by_id(game_mix_id), {"$set": update_data})
     
-    updated_game_mix = await db.game_mixes.find_one({"id": game_mix_id})
+    updated_game_mix = await db.game_mixes.find_one(by_id(game_mix_id))
+    await record_activity(current_user, "updated", "game_mixes", updated_game_mix)
     return GameMix(**updated_game_mix)
 
 @api_router.delete("/game-mixes/{game_mix_id}")
@@ -1106,12 +3786,14 @@ async def delete_game_mix(game_mix_id: str, current_user: User = Depends(get_cur
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    game_mix = await db.game_mixes.find_one({"id": game_mix_id})
+    game_mix = await db.game_mixes.find_one(by_id(game_mix_id))
     if not game_mix:
         raise HTTPException(status_code=404, detail="Game mix not found")
     
     # HARD DELETE - actually remove from database
-    await db.game_mixes.delete_one({"id": game_mix_id})
+    await db.game_mixes.delete_one(by_id(game_mix_id))
+    await access_scopes.game_mixes_changed()
+    await record_activity(current_user, "deleted", "game_mixes", game_mix)
     return {"message": "Game mix deleted successfully"}
 
 @api_router.post("/cabinets", response_model=Cabinet)
@@ -1120,7 +3802,7 @@ async def create_cabinet(cabinet_data: CabinetCreate, current_user: User = Depen
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
     # Verify provider exists
-    provider = await db.providers.find_one({"id": cabinet_data.provider_id})
+    provider = await db.providers.find_one(by_id(cabinet_data.provider_id))
     if not provider:
         raise HTTPException(status_code=400, detail="Provider not found")
     
@@ -1128,7 +3810,10 @@ async def create_cabinet(cabinet_data: CabinetCreate, current_user: User = Depen
     cabinet_dict["created_by"] = current_user.id
     cabinet_obj = Cabinet(**cabinet_dict)
     
-    await db.cabinets.insert_one(cabinet_obj.model_dump())
+    await db.cabinets.insert_one(keyed(cabinet_obj.model_dump()))
+    await count_change("cabinets", after=cabinet_obj.model_dump())
+    await access_scopes.equipment_changed(cabinet_dict.get("location_id"))
+    await record_activity(current_user, "created", "cabinets", cabinet_obj.model_dump())
     return cabinet_obj
 
 @api_router.get("/cabinets", response_model=List[Cabinet])
@@ -1140,7 +3825,7 @@ async def get_cabinets(current_user: User = Depends(get_current_user)):
         for cabinet in cabinets:
             # Create a simple dict
             cabinet_dict = {
-                "id": str(cabinet["_id"]),
+                "id": public_id(cabinet),
                 "name": cabinet.get("name", ""),
                 "model": cabinet.get("model", ""),
                 "provider_id": cabinet.get("provider_id", ""),
@@ -1149,10 +3834,10 @@ async def get_cabinets(current_user: User = Depends(get_current_user)):
                 "created_by": cabinet.get("created_by", "")
             }
             result.append(cabinet_dict)
-        print(f"Returning {len(result)} cabinets from API")
+        cabinet_logger.debug("Returning %d cabinets", len(result))
         return result
     except Exception as e:
-        print(f"Error in get_cabinets: {e}")
+        cabinet_logger.exception("Error in get_cabinets: %s", e)
         return []
 
 @api_router.get("/cabinets-simple")
@@ -1163,7 +3848,7 @@ async def get_cabinets_simple():
         result = []
         for cabinet in cabinets:
             cabinet_dict = {
-                "id": str(cabinet["_id"]),
+                "id": public_id(cabinet),
                 "name": cabinet.get("name", ""),
                 "model": cabinet.get("model", ""),
                 "provider_id": cabinet.get("provider_id", ""),
@@ -1172,10 +3857,10 @@ async def get_cabinets_simple():
                 "created_by": cabinet.get("created_by", "")
             }
             result.append(cabinet_dict)
-        print(f"Simple endpoint returning {len(result)} cabinets")
+        cabinet_logger.debug("Simple endpoint returning %d cabinets", len(result))
         return result
     except Exception as e:
-        print(f"Error in get_cabinets_simple: {e}")
+        cabinet_logger.exception("Error in get_cabinets_simple: %s", e)
         return []
 
 
@@ -1186,18 +3871,12 @@ async def get_cabinets_simple():
 async def get_cabinets_test():
     # Test endpoint without authentication
     cabinets = await db.cabinets.find({}).to_list(1000)
-    # Convert ObjectIds to strings
     cabinets = [convert_objectid_to_str(cabinet) for cabinet in cabinets]
     return [Cabinet(**cabinet) for cabinet in cabinets]
 
 @api_router.get("/cabinets/{cabinet_id}", response_model=Cabinet)
 async def get_cabinet(cabinet_id: str, current_user: User = Depends(get_current_user)):
-    # Try to find by _id first (ObjectId), then by id (UUID string)
-    try:
-        cabinet = await db.cabinets.find_one({"_id": ObjectId(cabinet_id)})
-    except Exception as e:
-        cabinet = await db.cabinets.find_one({"id": cabinet_id})
-    
+    cabinet = await db.cabinets.find_one(by_id(cabinet_id))
     if not cabinet:
         raise HTTPException(status_code=404, detail="Cabinet not found")
     return Cabinet(**cabinet)
@@ -1207,14 +3886,8 @@ async def update_cabinet(cabinet_id: str, cabinet_data: CabinetUpdate, current_u
     if current_user.role not in [UserRole.ADMIN, UserRole.MANAGER]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
-    # Try to find by _id first (ObjectId), then by id (UUID string)
-    try:
-        cabinet = await db.cabinets.find_one({"_id": ObjectId(cabinet_id)})
-        query = {"_id": ObjectId(cabinet_id)}
-    except:
-        cabinet = await db.cabinets.find_one({"id": cabinet_id})
-        query = {"id": cabinet_id}
-    
+    query = by_id(cabinet_id)
+    cabinet = await db.cabinets.find_one(query)
     if not cabinet:
         raise HTTPException(status_code=404, detail="Cabinet not found")
     
@@ -1226,23 +3899,20 @@ async def update_cabinet(cabinet_id: str, cabinet_data: CabinetUpdate, current_u
     
     if update_data:
         await db.cabinets.update_one(query, {"$set": update_data})
+        if "provider_id" in update_data:
+            await access_scopes.equipment_changed(cabinet.get("location_id"))
     
     updated_cabinet = await db.cabinets.find_one(query)
     
     if not updated_cabinet:
         raise HTTPException(status_code=404, detail="Cabinet not found after update")
     
-    # Debug: Print the cabinet data to see what fields are present
-    print(f"DEBUG: Cabinet data from DB: {updated_cabinet}")
-    
     # Ensure all required fields are present for Cabinet model
-    # Convert ObjectId to string for id field
-    if '_id' in updated_cabinet:
-        updated_cabinet['id'] = str(updated_cabinet['_id'])
+    updated_cabinet['id'] = public_id(updated_cabinet)
     
     # Ensure created_by field exists (use existing or default)
     if 'created_by' not in updated_cabinet:
-        print(f"DEBUG: created_by field missing, setting to: {current_user.id}")
+        cabinet_logger.debug("Cabinet %s has no created_by, using %s", cabinet_id, current_user.id)
         updated_cabinet['created_by'] = current_user.id
     
     # Ensure status field exists
@@ -1253,13 +3923,13 @@ async def update_cabinet(cabinet_id: str, cabinet_data: CabinetUpdate, current_u
     if 'created_at' not in updated_cabinet:
         updated_cabinet['created_at'] = datetime.utcnow()
     
-    print(f"DEBUG: Final cabinet data: {updated_cabinet}")
+    cabinet_logger.debug("Updated cabinet %s", cabinet_id, extra={"cabinet": updated_cabinet})
+    await record_activity(current_user, "updated", "cabinets", updated_cabinet)
     
     try:
         return Cabinet(**updated_cabinet)
     except Exception as e:
-        print(f"DEBUG: Error creating Cabinet object: {e}")
-        print(f"DEBUG: Cabinet data that failed: {updated_cabinet}")
+        cabinet_logger.error("Error creating Cabinet object: %s", e, extra={"cabinet": updated_cabinet})
         raise HTTPException(status_code=500, detail=f"Error creating cabinet object: {str(e)}")
 
 @api_router.delete("/cabinets/{cabinet_id}")
@@ -1267,19 +3937,17 @@ async def delete_cabinet(cabinet_id: str, current_user: User = Depends(get_curre
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    # Try to find by _id first (ObjectId), then by id (UUID string)
-    try:
-        cabinet = await db.cabinets.find_one({"_id": ObjectId(cabinet_id)})
-        query = {"_id": ObjectId(cabinet_id)}
-    except:
-        cabinet = await db.cabinets.find_one({"id": cabinet_id})
-        query = {"id": cabinet_id}
-    
+    query = by_id(cabinet_id)
+    cabinet = await db.cabinets.find_one(query)
     if not cabinet:
         raise HTTPException(status_code=404, detail="Cabinet not found")
     
     # HARD DELETE - actually remove from database
-    await db.cabinets.delete_one(query)
+    result = await db.cabinets.delete_one(query)
+    if result.deleted_count:
+        await count_change("cabinets", before=cabinet)
+        await record_activity(current_user, "deleted", "cabinets", cabinet)
+    await access_scopes.equipment_changed(cabinet.get("location_id"))
     return {"message": "Cabinet deleted successfully"}
 
 @api_router.post("/slot-machines", response_model=SlotMachine)
@@ -1288,33 +3956,156 @@ async def create_slot_machine(slot_data: SlotMachineCreate, current_user: User =
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
     # Verify cabinet and game mix exist
-    cabinet = await db.cabinets.find_one({"id": slot_data.cabinet_id})
+    cabinet = await db.cabinets.find_one(by_id(slot_data.cabinet_id))
     if not cabinet:
         raise HTTPException(status_code=400, detail="Cabinet not found")
     
-    game_mix = await db.game_mixes.find_one({"id": slot_data.game_mix_id})
+    game_mix = await db.game_mixes.find_one(by_id(slot_data.game_mix_id))
     if not game_mix:
         raise HTTPException(status_code=400, detail="Game mix not found")
     
     slot_dict = slot_data.model_dump()
     slot_dict["created_by"] = current_user.id
     
-    slot_obj = SlotMachine(**slot_dict)
+    slot_obj = SlotMachine(**slot_dict)
+    
+    await db.slot_machines.insert_one(keyed(slot_obj.model_dump()))
+    await count_change("slot_machines", after=slot_obj.model_dump())
+    await access_scopes.equipment_changed(slot_obj.location_id)
+    await record_activity(current_user, "created", "slot_machines", slot_obj.model_dump())
+    return slot_obj
+
+@api_router.get("/slot-machines", response_model=List[SlotMachine])
+async def get_slot_machines(request: Request, response: Response, page: PageParams = Depends(), fields: Optional[List[str]] = Depends(field_selector(SlotMachine)), current_user: User = Depends(get_current_user)):
+    query = await filter_by_user_access(current_user, {}, "slot_machines")
+    if wants_ndjson(request):
+        if fields:
+            return ndjson_response(db.slot_machines.find(query, field_projection(fields)), field_rows(fields))
+        return ndjson_response(db.slot_machines.find(query), model_rows(SlotMachine))
+    slot_machines = await fetch_page(db.slot_machines, query, page, response, projection=field_projection(fields))
+    if fields:
+        return sparse_response(slot_machines, fields, response)
+    shape = row_shaper(SlotMachine)
+    return fast_response([shape(slot_machine) for slot_machine in slot_machines], response)
+
+SLOT_FACET_FIELDS = ("provider_id", "location_id", "cabinet_id", "game_mix_id", "status", "ownership_type", "production_year")
+SLOT_SORT_FIELDS = ("created_at", "serial_number", "model", "rtp", "denomination", "max_bet", "production_year", "commission_date")
+
+def range_filter(low: Optional[float], high: Optional[float]) -> Optional[dict]:
+    bounds = {}
+    if low is not None:
+        bounds["$gte"] = low
+    if high is not None:
+        bounds["$lte"] = high
+    return bounds or None
+
+# Access scope lookups, the page, and one count per facet with a selection
+@api_router.get("/slot-machines/search", dependencies=[Depends(query_budget(3 + len(SLOT_FACET_FIELDS)))])
+async def search_slot_machines(
+    provider_id: Optional[List[str]] = Query(None),
+    location_id: Optional[List[str]] = Query(None),
+    cabinet_id: Optional[List[str]] = Query(None),
+    game_mix_id: Optional[List[str]] = Query(None),
+    status: Optional[List[str]] = Query(None),
+    ownership_type: Optional[List[str]] = Query(None),
+    production_year: Optional[List[int]] = Query(None),
+    rtp_min: Optional[float] = None,
+    rtp_max: Optional[float] = None,
+    denomination_min: Optional[float] = None,
+    denomination_max: Optional[float] = None,
+    sort: str = "created_at",
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    fields: Optional[List[str]] = Depends(field_selector(SlotMachine)),
+    current_user: User = Depends(get_current_user)
+):
+    """Filter, sort and page slot machines server-side.
+
+    List filters may be repeated (`?status=active&status=inactive`). The
+    response carries one page of `items`, the `total` match count and, for
+    each of SLOT_FACET_FIELDS, the counts of its values among the machines
+    matching every filter but that field's own, so that the other values of a
+    field stay selectable.
+    
+    Items, total and the facets without a selection come from one aggregation
+    whose `$match` and `$sort` run ahead of `$facet`, on the slot indexes.
+    Each facet with a selection is counted by its own aggregation, run
+    concurrently.
+    """
+    sort_field = sort.lstrip("-")
+    if sort_field not in SLOT_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Cannot sort by {sort_field}")
+    direction = -1 if sort.startswith("-") else 1
+    
+    conditions = [await filter_by_user_access(current_user, {}, "slot_machines")]
+    selected = {
+        "provider_id": provider_id,
+        "location_id": location_id,
+        "cabinet_id": cabinet_id,
+        "game_mix_id": game_mix_id,
+        "status": status,
+        "ownership_type": ownership_type,
+        "production_year": production_year,
+    }
+    for name, bounds in (("rtp", range_filter(rtp_min, rtp_max)),
+                         ("denomination", range_filter(denomination_min, denomination_max))):
+        if bounds:
+            conditions.append({name: bounds})
+    facet_conditions = {
+        name: {name: values[0] if len(values) == 1 else {"$in": values}}
+        for name, values in selected.items() if values
+    }
+    
+    def all_of(conditions: List[dict]) -> dict:
+        conditions = [condition for condition in conditions if condition]
+        return {"$and": conditions} if len(conditions) > 1 else (conditions[0] if conditions else {})
+    
+    def counts(name: str) -> List[dict]:
+        return [{"$group": {"_id": f"${name}", "count": {"$sum": 1}}}, {"$sort": {"count": -1, "_id": 1}}]
+    
+    pipeline = [
+        {"$match": all_of(conditions + list(facet_conditions.values()))},
+        {"$sort": {sort_field: direction, "id": direction}},
+        {"$facet": {
+            "items": [
+                {"$skip": offset},
+                {"$limit": limit},
+                {"$project": field_projection(fields, sort_field) or {"_id": 0}}
+            ],
+            "total": [{"$count": "count"}],
+            **{name: counts(name) for name in SLOT_FACET_FIELDS if name not in facet_conditions}
+        }}
+    ]
+    
+    async def facet_without_own(name: str) -> List[dict]:
+        others = [condition for other, condition in facet_conditions.items() if other != name]
+        return await db.slot_machines.aggregate([{"$match": all_of(conditions + others)}] + counts(name)).to_list(None)
     
-    await db.slot_machines.insert_one(slot_obj.model_dump())
-    return slot_obj
-
-@api_router.get("/slot-machines", response_model=List[SlotMachine])
-async def get_slot_machines(current_user: User = Depends(get_current_user)):
-    query = await filter_by_user_access(current_user, {}, "slot_machines")
-    slot_machines = await db.slot_machines.find(query).to_list(1000)
-    # Convert ObjectIds to strings
-    slot_machines = [convert_objectid_to_str(slot_machine) for slot_machine in slot_machines]
-    return [SlotMachine(**slot_machine) for slot_machine in slot_machines]
+    results = await asyncio.gather(
+        db.slot_machines.aggregate(pipeline).to_list(1),
+        *(facet_without_own(name) for name in facet_conditions)
+    )
+    result = {**results[0][0], **dict(zip(facet_conditions, results[1:]))}
+    
+    if fields:
+        items = pick_fields(result["items"], fields)
+    else:
+        shape = row_shaper(SlotMachine)
+        items = [shape(item) for item in result["items"]]
+    return fast_response({
+        "items": items,
+        "total": result["total"][0]["count"] if result["total"] else 0,
+        "limit": limit,
+        "offset": offset,
+        "facets": {
+            name: [{"value": bucket["_id"], "count": bucket["count"]} for bucket in result[name]]
+            for name in SLOT_FACET_FIELDS
+        }
+    })
 
 @api_router.get("/slot-machines/{slot_machine_id}", response_model=SlotMachine)
 async def get_slot_machine(slot_machine_id: str, current_user: User = Depends(get_current_user)):
-    slot_machine = await db.slot_machines.find_one({"id": slot_machine_id})
+    slot_machine = await db.slot_machines.find_one(by_id(slot_machine_id))
     if not slot_machine:
         raise HTTPException(status_code=404, detail="Slot machine not found")
     return SlotMachine(**slot_machine)
@@ -1323,7 +4114,7 @@ async def get_slot_machine(slot_machine_id: str, current_user: User = Depends(ge
 async def update_slot_machine(slot_machine_id: str, slot_data: SlotMachineUpdate, current_user: User = Depends(get_current_user)):
     try:
         # Check if slot machine exists
-        slot_machine = await db.slot_machines.find_one({"id": slot_machine_id})
+        slot_machine = await db.slot_machines.find_one(by_id(slot_machine_id))
         if not slot_machine:
             raise HTTPException(status_code=404, detail="Slot machine not found")
         
@@ -1358,24 +4149,31 @@ async def update_slot_machine(slot_machine_id: str, slot_data: SlotMachineUpdate
                     "user_name": f"{current_user.first_name} {current_user.last_name}".strip() or current_user.username
                 }
                 await db.change_history.insert_one(change_record)
+                slot_logger.debug("Recorded change to %s.%s", slot_machine_id, field_name, extra={"sample": True})
         
         # Update the slot machine
         result = await db.slot_machines.update_one(
-            {"id": slot_machine_id},
+            by_id(slot_machine_id),
             {"$set": update_data}
         )
         
         if result.modified_count == 0:
             raise HTTPException(status_code=400, detail="No changes made to slot machine")
         
+        if "status" in update_data or "location_id" in update_data:
+            await count_change("slot_machines", before=slot_machine, after={**slot_machine, **update_data})
+        if "game_mix_id" in update_data or "location_id" in update_data:
+            await access_scopes.equipment_changed(slot_machine.get("location_id"), update_data.get("location_id"))
+        
         # Return updated slot machine
-        updated_slot = await db.slot_machines.find_one({"id": slot_machine_id})
+        updated_slot = await db.slot_machines.find_one(by_id(slot_machine_id))
+        await record_activity(current_user, "updated", "slot_machines", updated_slot)
         return SlotMachine(**updated_slot)
         
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error updating slot machine: {e}")
+        slot_logger.exception("Error updating slot machine %s: %s", slot_machine_id, e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @api_router.delete("/slot-machines/{slot_machine_id}")
@@ -1383,19 +4181,54 @@ async def delete_slot_machine(slot_machine_id: str, current_user: User = Depends
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    slot_machine = await db.slot_machines.find_one({"id": slot_machine_id})
+    slot_machine = await db.slot_machines.find_one(by_id(slot_machine_id))
     if not slot_machine:
         raise HTTPException(status_code=404, detail="Slot machine not found")
     
     # HARD DELETE - actually remove from database
-    await db.slot_machines.delete_one({"id": slot_machine_id})
+    result = await db.slot_machines.delete_one(by_id(slot_machine_id))
+    if result.deleted_count:
+        await count_change("slot_machines", before=slot_machine)
+        await record_activity(current_user, "deleted", "slot_machines", slot_machine)
+    await access_scopes.equipment_changed(slot_machine.get("location_id"))
     return {"message": "Slot machine deleted successfully"}
 # File upload helper functions
-import base64
-import mimetypes
 
-def validate_file_upload(file_data: str, filename: str, max_size_mb: int = 50):
-    """Validate file upload data"""
+def attachment_mime_type(filename: str) -> str:
+    """MIME type for an uploaded file name; raises 400 for types that are not accepted"""
+    mime_type, _ = mimetypes.guess_type(filename)
+    if not mime_type:
+        mime_type = "application/octet-stream"
+    
+    attachment_logger.debug("Detected MIME type %s for %s", mime_type, filename)
+    
+    # Validate file types (common business file types)
+    allowed_types = [
+        'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/jpg',
+        'application/pdf', 'application/msword', 
+        'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+        'application/vnd.ms-excel',
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        'text/plain', 'text/csv'
+    ]
+    
+    # Additional check for image files by extension
+    if mime_type not in allowed_types:
+        # Check if it's an image file by extension
+        image_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tiff']
+        file_extension = filename.lower()
+        if any(file_extension.endswith(ext) for ext in image_extensions):
+            attachment_logger.debug("File has image extension, allowing: %s", filename)
+            # For image files, use a generic image mime type
+            mime_type = "image/jpeg"  # Default to jpeg for images
+        else:
+            attachment_logger.info("File type not allowed: %s for %s", mime_type, filename)
+            raise HTTPException(status_code=400, detail="File type not allowed")
+    
+    return mime_type
+
+def validate_file_upload(file_data: str, filename: str, max_size_mb: int = MAX_UPLOAD_MB):
+    """Validate base64 file upload data; returns the decoded bytes and their MIME type"""
     try:
         # Validate base64 data
         if not file_data or not isinstance(file_data, str):
@@ -1407,64 +4240,22 @@ def validate_file_upload(file_data: str, filename: str, max_size_mb: int = 50):
         # Decode base64 to get actual file size
         try:
             file_bytes = base64.b64decode(clean_file_data)
-            file_size = len(file_bytes)
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Invalid base64 data: {str(e)}")
         
         # Check file size (50MB limit)
-        if file_size > max_size_mb * 1024 * 1024:
+        if len(file_bytes) > max_size_mb * 1024 * 1024:
             raise HTTPException(status_code=400, detail=f"File size exceeds {max_size_mb}MB limit")
         
-        # Get mime type
-        mime_type, _ = mimetypes.guess_type(filename)
-        if not mime_type:
-            mime_type = "application/octet-stream"
-        
-        # Debug: Print filename and detected mime type
-        print(f"DEBUG: Filename: {filename}")
-        print(f"DEBUG: Detected MIME type: {mime_type}")
-        
-        # Validate file types (common business file types)
-        allowed_types = [
-            'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/jpg',
-            'application/pdf', 'application/msword', 
-            'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            'application/vnd.ms-excel',
-            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            'text/plain', 'text/csv'
-        ]
-        
-        # Additional check for image files by extension
-        if mime_type not in allowed_types:
-            # Check if it's an image file by extension
-            image_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tiff']
-            file_extension = filename.lower()
-            if any(file_extension.endswith(ext) for ext in image_extensions):
-                print(f"DEBUG: File has image extension, allowing: {filename}")
-                # For image files, use a generic image mime type
-                mime_type = "image/jpeg"  # Default to jpeg for images
-            else:
-                print(f"DEBUG: File type not allowed: {mime_type} for {filename}")
-                raise HTTPException(status_code=400, detail="File type not allowed")
-        
-        print(f"DEBUG: Final MIME type: {mime_type}")
-        return file_size, mime_type
+        return file_bytes, attachment_mime_type(filename)
         
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid file data: {str(e)}")
 
-# Attachment routes
-@api_router.post("/attachments", response_model=Attachment)
-async def upload_attachment(attachment_data: AttachmentCreate, current_user: User = Depends(get_current_user)):
-    if current_user.role not in [UserRole.ADMIN, UserRole.MANAGER]:
-        raise HTTPException(status_code=403, detail="Insufficient permissions")
-    
-    # Validate file
-    file_size, mime_type = validate_file_upload(attachment_data.file_data, attachment_data.filename)
-    
-    # Verify entity exists based on entity_type
+async def check_attachment_target(entity_type: str, entity_id: str):
+    """Raise unless `entity_id` names an existing entity of a type that takes attachments"""
     entity_collections = {
         'users': db.users,
         'companies': db.companies,
@@ -1484,53 +4275,183 @@ async def upload_attachment(attachment_data: AttachmentCreate, current_user: Use
         'comision_date': db.comision_dates  # Alias for comision_date
     }
     
-    if attachment_data.entity_type not in entity_collections:
+    if entity_type not in entity_collections:
         raise HTTPException(status_code=400, detail="Invalid entity type")
     
-    collection = entity_collections[attachment_data.entity_type]
+    collection = entity_collections[entity_type]
     
-    print(f"Looking for {attachment_data.entity_type} with id: {attachment_data.entity_id}")
-    print(f"Entity type: {attachment_data.entity_type}")
-    print(f"Available entity types: {list(entity_collections.keys())}")
-    print(f"Is entity_type in collections: {attachment_data.entity_type in entity_collections}")
-    
-    # For cabinets, the frontend sends the _id as string, so we need to convert it back to ObjectId
-    if attachment_data.entity_type == "cabinets":
-        print("Processing cabinet entity")
-        try:
-            entity = await collection.find_one({"_id": ObjectId(attachment_data.entity_id)})
-            print(f"Found cabinet by _id: {entity is not None}")
-            if entity:
-                print(f"Cabinet found: {entity.get('name', 'Unknown')}")
-        except Exception as e:
-            print(f"Error with _id lookup: {e}")
-            entity = None
-    else:
-        # For other entities, try to find by _id first (ObjectId), then by id (UUID string)
-        try:
-            entity = await collection.find_one({"_id": ObjectId(attachment_data.entity_id)})
-            print(f"Found by _id: {entity is not None}")
-        except Exception as e:
-            print(f"Error with _id lookup: {e}")
-            entity = await collection.find_one({"id": attachment_data.entity_id})
-            print(f"Found by id: {entity is not None}")
+    entity = await collection.find_one(by_id(entity_id), {"_id": 1})
     
     if not entity:
-        print(f"Entity not found for {attachment_data.entity_type} with id {attachment_data.entity_id}")
-        raise HTTPException(status_code=404, detail=f"{attachment_data.entity_type.title()} not found")
+        attachment_logger.info("Attachment target not found: %s %s", entity_type, entity_id)
+        raise HTTPException(status_code=404, detail=f"{entity_type.title()} not found")
+
+async def store_attachment(chunks, filename: str, original_filename: str, mime_type: str,
+                           entity_type: str, entity_id: str, current_user: User) -> Attachment:
+    """Write uploaded content to the blob store and record the attachment pointing at it"""
+    limit = MAX_UPLOAD_MB * 1024 * 1024
+    size = 0
+
+    async def counted():
+        nonlocal size
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > limit:
+                raise HTTPException(status_code=400, detail=f"File size exceeds {MAX_UPLOAD_MB}MB limit")
+            yield chunk
+
+    return await record_attachment(
+        await put_content(counted()), filename, original_filename, mime_type, entity_type, entity_id, current_user
+    )
+
+async def record_attachment(content: dict, filename: str, original_filename: str, mime_type: str,
+                            entity_type: str, entity_id: str, current_user: User) -> Attachment:
+    """Insert the attachment record for content already referenced in the store"""
+    attachment_obj = Attachment(
+        filename=filename,
+        original_filename=original_filename,
+        mime_type=mime_type,
+        entity_type=entity_type,
+        entity_id=entity_id,
+        uploaded_by=current_user.id,
+        **content
+    )
+    try:
+        await db.attachments.insert_one(keyed(attachment_obj.model_dump(exclude_none=True)))
+    except Exception:
+        await release_content(content)
+        raise
+    preview_worker.submit(content["sha256"], mime_type)
+    await record_activity(current_user, "created", "attachments", attachment_obj.model_dump())
+    return attachment_obj
+
+# Attachment routes
+@api_router.post("/attachments", response_model=Attachment)
+async def upload_attachment(attachment_data: AttachmentCreate, current_user: User = Depends(get_current_user)):
+    """Upload a file sent as base64 JSON; prefer the multipart /attachments/upload"""
+    if current_user.role not in [UserRole.ADMIN, UserRole.MANAGER]:
+        raise HTTPException(status_code=403, detail="Insufficient permissions")
     
-    attachment_dict = attachment_data.model_dump()
-    attachment_dict["file_size"] = file_size
-    attachment_dict["mime_type"] = mime_type
-    attachment_dict["uploaded_by"] = current_user.id
-    attachment_obj = Attachment(**attachment_dict)
+    # Validate file
+    file_bytes, mime_type = validate_file_upload(attachment_data.file_data, attachment_data.filename)
+    await check_attachment_target(attachment_data.entity_type, attachment_data.entity_id)
     
-    await db.attachments.insert_one(attachment_obj.model_dump())
-    return attachment_obj
+    async def content():
+        yield file_bytes
+    
+    return await store_attachment(
+        content(), attachment_data.filename, attachment_data.original_filename, mime_type,
+        attachment_data.entity_type, attachment_data.entity_id, current_user
+    )
+
+@api_router.post("/attachments/upload", response_model=Attachment)
+async def upload_attachment_file(
+    entity_type: str = Form(...),
+    entity_id: str = Form(...),
+    file: UploadFile = File(...),
+    current_user: User = Depends(get_current_user)
+):
+    """Upload a file as multipart form data.
+
+    The form is spooled before this runs; limit_multipart_uploads has already
+    refused bodies declaring more than MAX_UPLOAD_MB, and the exact file size
+    is enforced while the spooled file is copied into the blob store.
+    """
+    if current_user.role not in [UserRole.ADMIN, UserRole.MANAGER]:
+        raise HTTPException(status_code=403, detail="Insufficient permissions")
+    
+    filename = file.filename or "upload"
+    mime_type = attachment_mime_type(filename)
+    await check_attachment_target(entity_type, entity_id)
+    
+    async def content():
+        while chunk := await file.read(BLOB_CHUNK_SIZE):
+            yield chunk
+    
+    return await store_attachment(content(), filename, filename, mime_type, entity_type, entity_id, current_user)
+
+# Listings carry metadata only; content goes through the download routes
+ATTACHMENT_LIST_PROJECTION = {
+    "_id": 0, "id": 1, "filename": 1, "original_filename": 1, "file_size": 1, "mime_type": 1,
+    "entity_type": 1, "entity_id": 1, "uploaded_by": 1, "created_at": 1, "sha256": 1
+}
+
+async def add_attachment_creator_names(attachments: List[dict]) -> List[dict]:
+    """Add creator_name and has_preview to a batch of attachments"""
+    names = await display_names.resolve(attachment.get("uploaded_by") for attachment in attachments)
+    digests = {attachment["sha256"] for attachment in attachments if attachment.get("mime_type") in PREVIEW_TYPES and attachment.get("sha256")}
+    previewed = set()
+    if digests:
+        async for content in db.blob_contents.find({"_id": {"$in": list(digests)}, "previews.small": {"$exists": True}}, {"_id": 1}):
+            previewed.add(content["_id"])
+    result = []
+    for attachment in attachments:
+        attachment_data = convert_objectid_to_str(attachment)
+        attachment_data["creator_name"] = names.get(attachment_data.get("uploaded_by")) or ""
+        attachment_data["has_preview"] = attachment_data.pop("sha256", None) in previewed
+        result.append(attachment_data)
+    return result
 
-@api_router.get("/attachments/{entity_type}/{entity_id}", response_model=List[dict])
-async def get_entity_attachments(entity_type: str, entity_id: str, current_user: User = Depends(get_current_user)):
-    # Verify user has access to the entity
+async def inline_file_data(attachment: dict) -> str:
+    """Base64 content of an attachment, for the JSON routes that still embed it"""
+    if attachment.get("file_data") is not None:
+        return attachment["file_data"]
+    chunks = [chunk async for chunk in attachment_content(attachment, 0, attachment["file_size"])]
+    return base64.b64encode(b"".join(chunks)).decode("ascii")
+
+@api_router.get("/attachments/{attachment_id}/content")
+async def stream_attachment(attachment_id: str, request: Request, current_user: User = Depends(get_current_user)):
+    """Stream attachment content, honouring a single-range `Range` header"""
+    attachment = await db.attachments.find_one(by_id(attachment_id))
+    if not attachment:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    await check_entity_access(attachment["entity_type"], attachment["entity_id"], current_user)
+    
+    size = attachment["file_size"]
+    requested = byte_range(request.headers.get("range"), size)
+    start, end = requested or (0, size)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(end - start),
+        "Content-Disposition": f"inline; filename*=UTF-8''{quote(attachment['original_filename'])}",
+        "Cache-Control": "private, max-age=3600",
+    }
+    if requested:
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    return StreamingResponse(
+        attachment_content(attachment, start, end),
+        status_code=206 if requested else 200,
+        media_type=attachment["mime_type"],
+        headers=headers
+    )
+
+@api_router.get("/attachments/{attachment_id}/preview")
+async def get_attachment_preview(attachment_id: str, request: Request, size: Literal["small", "large"] = "small",
+                                 current_user: User = Depends(get_current_user)):
+    """WebP preview of an image or PDF attachment, once the background worker has made it"""
+    attachment = await db.attachments.find_one(by_id(attachment_id), {"_id": 0, "sha256": 1, "entity_type": 1, "entity_id": 1})
+    if not attachment:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    await check_entity_access(attachment["entity_type"], attachment["entity_id"], current_user)
+    
+    sha256 = attachment.get("sha256")
+    etag = f'"{sha256}-{size}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=86400"}
+    if sha256 and request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    data = preview_cache.get((sha256, size)) if sha256 else None
+    if data is None:
+        content = await db.blob_contents.find_one({"_id": sha256}, {"previews": 1}) if sha256 else None
+        preview = ((content or {}).get("previews") or {}).get(size)
+        if preview is None:
+            raise HTTPException(status_code=404, detail="No preview available")
+        data = b"".join([chunk async for chunk in blobs.read(preview["blob_id"], 0, preview["size"])])
+        preview_cache.put((sha256, size), data)
+    return Response(content=data, media_type="image/webp", headers=headers)
+
+async def check_entity_access(entity_type: str, entity_id: str, current_user: User):
+    """Raise unless the user may see the attachments of this entity"""
     entity_collections = {
         'users': db.users,
         'companies': db.companies,
@@ -1545,6 +4466,7 @@ async def get_entity_attachments(entity_type: str, entity_id: str, current_user:
         'onjn': db.onjn_reports,  # Alias for onjn
         'legal_documents': db.legal_documents,
         'metrology': db.metrology,
+        'jackpots': db.jackpots,
         'comision_dates': db.comision_dates,
         'comision_date': db.comision_dates,  # Alias for comision_date
         'marketing': db.marketing_campaigns  # Support for marketing campaigns
@@ -1555,64 +4477,46 @@ async def get_entity_attachments(entity_type: str, entity_id: str, current_user:
     
     # Check access based on entity type
     if entity_type == "companies":
-        accessible_companies = await get_user_accessible_companies(current_user)
-        if current_user.role != UserRole.ADMIN and entity_id not in accessible_companies:
+        if current_user.role != UserRole.ADMIN and entity_id not in await access_scopes.get(current_user, "companies"):
             raise HTTPException(status_code=403, detail="Access denied to this entity")
     elif entity_type == "locations":
-        accessible_locations = await get_user_accessible_locations(current_user)
-        if current_user.role != UserRole.ADMIN and entity_id not in accessible_locations:
+        if current_user.role != UserRole.ADMIN and entity_id not in await access_scopes.get(current_user, "locations"):
             raise HTTPException(status_code=403, detail="Access denied to this entity")
     elif entity_type in ["cabinets", "slot_machines"]:
         # Check if entity belongs to accessible location
         collection = entity_collections[entity_type]
-        entity = await collection.find_one({"id": entity_id})
+        entity = await collection.find_one(by_id(entity_id))
         if entity:
-            accessible_locations = await get_user_accessible_locations(current_user)
-            if current_user.role != UserRole.ADMIN and entity.get("location_id") not in accessible_locations:
+            if current_user.role != UserRole.ADMIN and entity.get("location_id") not in await access_scopes.get(current_user, "locations"):
                 raise HTTPException(status_code=403, detail="Access denied to this entity")
     elif entity_type == "marketing":
         # Check if user has access to marketing campaigns
         # Marketing campaigns are accessible to all authenticated users for now
         # You can add more specific access control here if needed
         pass
+
+@api_router.get("/attachments/{entity_type}/{entity_id}", response_model=List[dict], dependencies=[Depends(query_budget(6))])
+async def get_entity_attachments(entity_type: str, entity_id: str, request: Request, current_user: User = Depends(get_current_user)):
+    await check_entity_access(entity_type, entity_id, current_user)
     
-    attachments = await db.attachments.find({
-        "entity_type": entity_type,
-        "entity_id": entity_id
-    }).to_list(1000)
-    
-    # Convert ObjectIds to strings and add creator information
-    result = []
-    for attachment in attachments:
-        attachment_data = convert_objectid_to_str(attachment)
-        
-        # Get creator information
-        creator_info = {"first_name": "", "last_name": ""}
-        if "uploaded_by" in attachment_data:
-            creator = await db.users.find_one({"id": attachment_data["uploaded_by"]})
-            if creator:
-                creator_info = {
-                    "first_name": creator.get("first_name", ""),
-                    "last_name": creator.get("last_name", "")
-                }
-        
-        # Add creator info to attachment data
-        attachment_data["creator_name"] = f"{creator_info['first_name']} {creator_info['last_name']}".strip()
-        
-        result.append(attachment_data)
+    attachments = db.attachments.find({"entity_type": entity_type, "entity_id": entity_id}, ATTACHMENT_LIST_PROJECTION)
+    if wants_ndjson(request):
+        return ndjson_response(attachments, add_attachment_creator_names)
     
-    return result
+    return fast_response(await add_attachment_creator_names(await attachments.to_list(1000)))
 
 @api_router.get("/attachments/{attachment_id}")
 async def download_attachment(attachment_id: str, current_user: User = Depends(get_current_user)):
-    attachment = await db.attachments.find_one({"id": attachment_id})
+    """Attachment content as base64 JSON; /attachments/{id}/content streams it instead"""
+    attachment = await db.attachments.find_one(by_id(attachment_id))
     if not attachment:
         raise HTTPException(status_code=404, detail="Attachment not found")
+    await check_entity_access(attachment["entity_type"], attachment["entity_id"], current_user)
     
     return {
         "filename": attachment["original_filename"],
         "mime_type": attachment["mime_type"],
-        "file_data": attachment["file_data"]
+        "file_data": await inline_file_data(attachment)
     }
 
 @api_router.delete("/attachments/{attachment_id}")
@@ -1620,19 +4524,180 @@ async def delete_attachment(attachment_id: str, current_user: User = Depends(get
     if current_user.role not in [UserRole.ADMIN, UserRole.MANAGER]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
-    attachment = await db.attachments.find_one({"id": attachment_id})
+    attachment = await db.attachments.find_one_and_delete(by_id(attachment_id), {"file_data": 0})
     if not attachment:
         raise HTTPException(status_code=404, detail="Attachment not found")
     
-    await db.attachments.delete_one({"id": attachment_id})
+    try:
+        await release_content(attachment)
+    except Exception as e:
+        attachment_logger.error("Could not release content of attachment %s: %s", attachment_id, e)
+    await record_activity(current_user, "deleted", "attachments", attachment)
     return {"message": "Attachment deleted successfully"}
 
+# Resumable uploads: create a session, PUT the chunks in order, then commit
+def upload_session_view(session: dict) -> UploadSession:
+    return UploadSession(
+        id=session["id"],
+        filename=session["filename"],
+        file_size=session["file_size"],
+        received=session["received"],
+        chunk_size=UPLOAD_CHUNK_MB * 1024 * 1024,
+        mime_type=session.get("mime_type"),
+        expires_at=session["expires_at"]
+    )
+
+async def owned_upload(upload_id: str, current_user: User) -> dict:
+    session = await db.upload_sessions.find_one({"_id": primary_key(upload_id), "user_id": current_user.id})
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return session
+
+@api_router.post("/uploads", response_model=UploadSession)
+async def create_upload(upload: UploadSessionCreate, current_user: User = Depends(get_current_user)):
+    """Start a resumable upload; chunks then go to PUT /uploads/{id}?offset=..."""
+    if current_user.role not in [UserRole.ADMIN, UserRole.MANAGER]:
+        raise HTTPException(status_code=403, detail="Insufficient permissions")
+    
+    if upload.file_size <= 0:
+        raise HTTPException(status_code=400, detail="File is empty")
+    if upload.file_size > MAX_UPLOAD_MB * 1024 * 1024:
+        raise HTTPException(status_code=400, detail=f"File size exceeds {MAX_UPLOAD_MB}MB limit")
+    attachment_mime_type(upload.filename)
+    await check_attachment_target(upload.entity_type, upload.entity_id)
+    
+    session = {
+        "id": str(uuid.uuid4()),
+        "user_id": current_user.id,
+        "entity_type": upload.entity_type,
+        "entity_id": upload.entity_id,
+        "filename": upload.filename,
+        "original_filename": upload.original_filename or upload.filename,
+        "file_size": upload.file_size,
+        "received": 0,
+        "parts": [],
+        "created_at": datetime.utcnow(),
+        "expires_at": datetime.utcnow() + timedelta(hours=UPLOAD_SESSION_HOURS),
+    }
+    await db.upload_sessions.insert_one(keyed(session))
+    return upload_session_view(session)
+
+@api_router.get("/uploads/{upload_id}", response_model=UploadSession)
+async def get_upload(upload_id: str, current_user: User = Depends(get_current_user)):
+    """Where to resume an upload: `received` is the offset of the next chunk"""
+    return upload_session_view(await owned_upload(upload_id, current_user))
+
+@api_router.put("/uploads/{upload_id}", response_model=UploadSession)
+async def put_upload_chunk(upload_id: str, request: Request, offset: int = Query(..., ge=0),
+                           current_user: User = Depends(get_current_user)):
+    """Store one chunk, sent as the raw request body, at `offset`.
+
+    The offset must be the number of bytes received so far. The chunk is
+    streamed to the blob store as it arrives; the first one is checked by its
+    magic bytes and every one is hashed on the way through.
+    """
+    session = await owned_upload(upload_id, current_user)
+    if offset != session["received"]:
+        raise HTTPException(status_code=409, detail=f"Expected a chunk at offset {session['received']}")
+    
+    limit = min(UPLOAD_CHUNK_MB * 1024 * 1024, session["file_size"] - offset)
+    state = upload_hashers.get(upload_id)
+    if offset == 0:
+        hasher = hashlib.sha256()
+    else:
+        hasher = state[1].copy() if state and state[0] == offset else None
+    mime_type = session.get("mime_type")
+    size = 0
+    
+    async def chunk():
+        nonlocal size, mime_type
+        head = b""
+        async for piece in request.stream():
+            size += len(piece)
+            if size > limit:
+                raise HTTPException(status_code=400, detail=f"Chunk exceeds {limit} bytes")
+            if mime_type is None:
+                head += piece[:SNIFF_BYTES - len(head)]
+                if len(head) == SNIFF_BYTES:
+                    mime_type = sniff_mime_type(head, session["filename"])
+            if hasher is not None:
+                hasher.update(piece)
+            yield piece
+        if size == 0:
+            raise HTTPException(status_code=400, detail="Chunk is empty")
+        if mime_type is None:
+            mime_type = sniff_mime_type(head, session["filename"])
+    
+    blob_id = await blobs.put(chunk())
+    received = offset + size
+    expires_at = datetime.utcnow() + timedelta(hours=UPLOAD_SESSION_HOURS)
+    result = await db.upload_sessions.update_one(
+        {"_id": session["_id"], "received": offset},
+        {
+            "$set": {"received": received, "mime_type": mime_type, "expires_at": expires_at},
+            "$push": {"parts": {"offset": offset, "size": size, "blob_id": blob_id}},
+        }
+    )
+    if not result.modified_count:
+        await blobs.delete(blob_id)
+        raise HTTPException(status_code=409, detail=f"A chunk at offset {offset} was already received")
+    evict_upload_hashers()
+    if hasher is not None:
+        upload_hashers[upload_id] = (received, hasher, expires_at)
+    else:
+        upload_hashers.pop(upload_id, None)
+    session.update(received=received, mime_type=mime_type, expires_at=expires_at)
+    return upload_session_view(session)
+
+@api_router.post("/uploads/{upload_id}/commit", response_model=Attachment)
+async def commit_upload(upload_id: str, current_user: User = Depends(get_current_user)):
+    """Turn a fully received upload into an attachment"""
+    session = await owned_upload(upload_id, current_user)
+    if session["received"] != session["file_size"]:
+        raise HTTPException(status_code=409, detail=f"Upload incomplete: {session['received']} of {session['file_size']} bytes received")
+    # Claim the session so that a repeated commit cannot record it twice
+    if not (await db.upload_sessions.delete_one({"_id": session["_id"]})).deleted_count:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    
+    composed = None
+    try:
+        await check_attachment_target(session["entity_type"], session["entity_id"])
+        sha256 = await hash_upload(session)
+        # The received chunks become the stored content, without a copy
+        composed = await blobs.compose(session["parts"])
+        blob_id = await register_content(composed, sha256, session["file_size"])
+    except Exception:
+        # Leave the upload, chunks and all, to be committed again or cancelled
+        if composed is not None and composed.startswith(COMPOSED_BLOB_PREFIX):
+            await blobs.delete_blob(composed)
+        await db.upload_sessions.insert_one(session)
+        raise
+    upload_hashers.pop(upload_id, None)
+    if blob_id != composed:
+        # Identical content is already stored; drop the chunks
+        try:
+            await blobs.delete(composed)
+        except Exception as e:
+            attachment_logger.error("Could not delete the chunks of upload %s: %s", upload_id, e)
+    return await record_attachment(
+        {"blob_id": blob_id, "sha256": sha256, "file_size": session["file_size"]},
+        session["filename"], session["original_filename"], session["mime_type"],
+        session["entity_type"], session["entity_id"], current_user
+    )
+
+@api_router.delete("/uploads/{upload_id}")
+async def cancel_upload(upload_id: str, current_user: User = Depends(get_current_user)):
+    session = await owned_upload(upload_id, current_user)
+    if (await db.upload_sessions.delete_one({"_id": session["_id"]})).deleted_count:
+        await discard_upload(session)
+    return {"message": "Upload cancelled"}
+
 @api_router.get("/attachments/marketing/{campaign_id}/count")
 async def get_marketing_attachments_count(campaign_id: str, current_user: User = Depends(get_current_user)):
     """Get the count of attachments for a specific marketing campaign"""
     try:
         # Check if marketing campaign exists
-        campaign = await db.marketing_campaigns.find_one({"id": campaign_id})
+        campaign = await db.marketing_campaigns.find_one(by_id(campaign_id))
         if not campaign:
             raise HTTPException(status_code=404, detail="Marketing campaign not found")
         
@@ -1653,11 +4718,11 @@ async def create_invoice(invoice_data: InvoiceCreate, current_user: User = Depen
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
     # Verify company and location exist
-    company = await db.companies.find_one({"id": invoice_data.company_id})
+    company = await db.companies.find_one(by_id(invoice_data.company_id))
     if not company:
         raise HTTPException(status_code=400, detail="Company not found")
     
-    location = await db.locations.find_one({"id": invoice_data.location_id})
+    location = await db.locations.find_one(by_id(invoice_data.location_id))
     if not location:
         raise HTTPException(status_code=400, detail="Location not found")
     
@@ -1680,7 +4745,12 @@ async def create_invoice(invoice_data: InvoiceCreate, current_user: User = Depen
     invoice_obj = Invoice(**invoice_dict)
     
     # Create the invoice
-    await db.invoices.insert_one(invoice_obj.model_dump())
+    try:
+        await db.invoices.insert_one(keyed(invoice_obj.model_dump()))
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Invoice number already exists")
+    await count_change("invoices", after=invoice_obj.model_dump())
+    await record_activity(current_user, "created", "invoices", invoice_obj.model_dump())
     
     # Update slot machines with invoice number
     if serial_numbers:
@@ -1694,16 +4764,21 @@ async def create_invoice(invoice_data: InvoiceCreate, current_user: User = Depen
     return invoice_obj
 
 @api_router.get("/invoices", response_model=List[Invoice])
-async def get_invoices(current_user: User = Depends(get_current_user)):
+async def get_invoices(request: Request, response: Response, page: PageParams = Depends(), fields: Optional[List[str]] = Depends(field_selector(Invoice)), current_user: User = Depends(get_current_user)):
     query = await filter_by_user_access(current_user, {}, "invoices")
-    invoices = await db.invoices.find(query).to_list(1000)
-    # Convert ObjectIds to strings
-    invoices = [convert_objectid_to_str(invoice) for invoice in invoices]
-    return [Invoice(**invoice) for invoice in invoices]
+    if wants_ndjson(request):
+        if fields:
+            return ndjson_response(db.invoices.find(query, field_projection(fields)), field_rows(fields))
+        return ndjson_response(db.invoices.find(query), model_rows(Invoice))
+    invoices = await fetch_page(db.invoices, query, page, response, projection=field_projection(fields))
+    if fields:
+        return sparse_response(invoices, fields, response)
+    shape = row_shaper(Invoice)
+    return fast_response([shape(invoice) for invoice in invoices], response)
 
 @api_router.get("/invoices/{invoice_id}", response_model=Invoice)
 async def get_invoice(invoice_id: str, current_user: User = Depends(get_current_user)):
-    invoice = await db.invoices.find_one({"id": invoice_id})
+    invoice = await db.invoices.find_one(by_id(invoice_id))
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
     return Invoice(**invoice)
@@ -1713,14 +4788,19 @@ async def update_invoice(invoice_id: str, invoice_data: InvoiceCreate, current_u
     if current_user.role not in [UserRole.ADMIN, UserRole.MANAGER]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
-    invoice = await db.invoices.find_one({"id": invoice_id})
+    invoice = await db.invoices.find_one(by_id(invoice_id))
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
     
     update_data = invoice_data.model_dump()
-    await db.invoices.update_one({"id": invoice_id}, {"$set": update_data})
+    try:
+        await db.invoices.update_one(by_id(invoice_id), {"$set": update_data})
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Invoice number already exists")
+    await count_change("invoices", before=invoice, after={**invoice, **update_data})
     
-    updated_invoice = await db.invoices.find_one({"id": invoice_id})
+    updated_invoice = await db.invoices.find_one(by_id(invoice_id))
+    await record_activity(current_user, "updated", "invoices", updated_invoice)
     return Invoice(**updated_invoice)
 
 @api_router.delete("/invoices/{invoice_id}")
@@ -1728,7 +4808,10 @@ async def delete_invoice(invoice_id: str, current_user: User = Depends(get_curre
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    await db.invoices.delete_one({"id": invoice_id})
+    invoice = await db.invoices.find_one_and_delete(by_id(invoice_id))
+    if invoice:
+        await count_change("invoices", before=invoice)
+        await record_activity(current_user, "deleted", "invoices", invoice)
     return {"message": "Invoice deleted successfully"}
 
 # ONJN Report routes
@@ -1746,20 +4829,26 @@ async def create_onjn_report(report_data: ONJNReportCreate, current_user: User =
     report_dict["created_by"] = current_user.id
     report_obj = ONJNReport(**report_dict)
     
-    await db.onjn_reports.insert_one(report_obj.model_dump())
+    try:
+        await db.onjn_reports.insert_one(keyed(report_obj.model_dump()))
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Report number already exists")
+    await count_change("onjn_reports", after=report_obj.model_dump())
+    await record_activity(current_user, "created", "onjn_reports", report_obj.model_dump())
     return report_obj
 
 @api_router.get("/onjn-reports", response_model=List[ONJNReport])
-async def get_onjn_reports(current_user: User = Depends(get_current_user)):
+async def get_onjn_reports(response: Response, page: PageParams = Depends(), fields: Optional[List[str]] = Depends(field_selector(ONJNReport)), current_user: User = Depends(get_current_user)):
     query = await filter_by_user_access(current_user, {}, "onjn_reports")
-    reports = await db.onjn_reports.find(query).to_list(1000)
-    # Convert ObjectIds to strings
-    reports = [convert_objectid_to_str(report) for report in reports]
-    return [ONJNReport(**report) for report in reports]
+    reports = await fetch_page(db.onjn_reports, query, page, response, projection=field_projection(fields))
+    if fields:
+        return sparse_response(reports, fields, response)
+    shape = row_shaper(ONJNReport)
+    return fast_response([shape(report) for report in reports], response)
 
 @api_router.get("/onjn-reports/{report_id}", response_model=ONJNReport)
 async def get_onjn_report(report_id: str, current_user: User = Depends(get_current_user)):
-    report = await db.onjn_reports.find_one({"id": report_id})
+    report = await db.onjn_reports.find_one(by_id(report_id))
     if not report:
         raise HTTPException(status_code=404, detail="ONJN report not found")
     return ONJNReport(**report)
@@ -1769,14 +4858,19 @@ async def update_onjn_report(report_id: str, report_data: ONJNReportCreate, curr
     if current_user.role not in [UserRole.ADMIN, UserRole.MANAGER]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
-    report = await db.onjn_reports.find_one({"id": report_id})
+    report = await db.onjn_reports.find_one(by_id(report_id))
     if not report:
         raise HTTPException(status_code=404, detail="ONJN report not found")
     
     update_data = report_data.model_dump()
-    await db.onjn_reports.update_one({"id": report_id}, {"$set": update_data})
+    try:
+        await db.onjn_reports.update_one(by_id(report_id), {"$set": update_data})
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Report number already exists")
+    await count_change("onjn_reports", before=report, after={**report, **update_data})
     
-    updated_report = await db.onjn_reports.find_one({"id": report_id})
+    updated_report = await db.onjn_reports.find_one(by_id(report_id))
+    await record_activity(current_user, "updated", "onjn_reports", updated_report)
     return ONJNReport(**updated_report)
 
 @api_router.delete("/onjn-reports/{report_id}")
@@ -1784,7 +4878,10 @@ async def delete_onjn_report(report_id: str, current_user: User = Depends(get_cu
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    await db.onjn_reports.delete_one({"id": report_id})
+    report = await db.onjn_reports.find_one_and_delete(by_id(report_id))
+    if report:
+        await count_change("onjn_reports", before=report)
+        await record_activity(current_user, "deleted", "onjn_reports", report)
     return {"message": "ONJN report deleted successfully"}
 
 # Legal Document routes
@@ -1797,20 +4894,23 @@ async def create_legal_document(document_data: LegalDocumentCreate, current_user
     document_dict["created_by"] = current_user.id
     document_obj = LegalDocument(**document_dict)
     
-    await db.legal_documents.insert_one(document_obj.model_dump())
+    await db.legal_documents.insert_one(keyed(document_obj.model_dump()))
+    await count_change("legal_documents", after=document_obj.model_dump())
+    await record_activity(current_user, "created", "legal_documents", document_obj.model_dump())
     return document_obj
 
 @api_router.get("/legal-documents", response_model=List[LegalDocument])
-async def get_legal_documents(current_user: User = Depends(get_current_user)):
+async def get_legal_documents(response: Response, page: PageParams = Depends(), fields: Optional[List[str]] = Depends(field_selector(LegalDocument)), current_user: User = Depends(get_current_user)):
     query = await filter_by_user_access(current_user, {}, "legal_documents")
-    documents = await db.legal_documents.find(query).to_list(1000)
-    # Convert ObjectIds to strings
-    documents = [convert_objectid_to_str(document) for document in documents]
-    return [LegalDocument(**document) for document in documents]
+    documents = await fetch_page(db.legal_documents, query, page, response, projection=field_projection(fields))
+    if fields:
+        return sparse_response(documents, fields, response)
+    shape = row_shaper(LegalDocument)
+    return fast_response([shape(document) for document in documents], response)
 
 @api_router.get("/legal-documents/{document_id}", response_model=LegalDocument)
 async def get_legal_document(document_id: str, current_user: User = Depends(get_current_user)):
-    document = await db.legal_documents.find_one({"id": document_id})
+    document = await db.legal_documents.find_one(by_id(document_id))
     if not document:
         raise HTTPException(status_code=404, detail="Legal document not found")
     return LegalDocument(**document)
@@ -1820,14 +4920,16 @@ async def update_legal_document(document_id: str, document_data: LegalDocumentCr
     if current_user.role not in [UserRole.ADMIN, UserRole.MANAGER]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
-    document = await db.legal_documents.find_one({"id": document_id})
+    document = await db.legal_documents.find_one(by_id(document_id))
     if not document:
         raise HTTPException(status_code=404, detail="Legal document not found")
     
     update_data = document_data.model_dump()
-    await db.legal_documents.update_one({"id": document_id}, {"$set": update_data})
+    await db.legal_documents.update_one(by_id(document_id), {"$set": update_data})
+    await count_change("legal_documents", before=document, after={**document, **update_data})
     
-    updated_document = await db.legal_documents.find_one({"id": document_id})
+    updated_document = await db.legal_documents.find_one(by_id(document_id))
+    await record_activity(current_user, "updated", "legal_documents", updated_document)
     return LegalDocument(**updated_document)
 
 @api_router.delete("/legal-documents/{document_id}")
@@ -1835,7 +4937,10 @@ async def delete_legal_document(document_id: str, current_user: User = Depends(g
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    await db.legal_documents.delete_one({"id": document_id})
+    document = await db.legal_documents.find_one_and_delete(by_id(document_id))
+    if document:
+        await count_change("legal_documents", before=document)
+        await record_activity(current_user, "deleted", "legal_documents", document)
     return {"message": "Legal document deleted successfully"}
 
 # Metrology endpoints
@@ -1846,155 +4951,114 @@ async def create_metrology(metrology_data: MetrologyCreate, current_user: User =
         created_by=current_user.id
     )
     
-    await db.metrology.insert_one(metrology.model_dump())
+    await db.metrology.insert_one(keyed(metrology.model_dump()))
+    await count_change("metrology", after=metrology.model_dump())
+    await record_activity(current_user, "created", "metrology", metrology.model_dump())
     return metrology
 
-@api_router.get("/metrology", response_model=List[dict])
-async def get_metrology(current_user: User = Depends(get_current_user)):
-    cursor = db.metrology.find({})
-    metrology_list = await cursor.to_list(length=None)
-    
-    # Fix: Ensure all records have an 'id' field
-    for item in metrology_list:
-        if '_id' in item and 'id' not in item:
-            # Add UUID id field for records that don't have it
-            item['id'] = str(uuid.uuid4())
-            await db.metrology.update_one({'_id': item['_id']}, {'$set': {'id': item['id']}})
-            print(f"🔧 Added missing 'id' field to metrology record: {item['_id']} -> {item['id']}")
-    
+async def add_metrology_user_names(items: List[dict]) -> List[dict]:
+    """Add creator_name and updater_name to a batch of metrology records"""
+    names = await display_names.resolve(
+        user_id for item in items for user_id in (item.get("created_by"), item.get("updated_by"))
+    )
     result = []
-    for item in metrology_list:
-        # Convert ObjectId to string
+    for item in items:
         metrology_data = convert_objectid_to_str(item)
-        
-        # Get creator information
-        creator_info = {"first_name": "", "last_name": ""}
-        if "created_by" in metrology_data:
-            print(f"🔍 Looking for creator with ID: {metrology_data['created_by']}")
-            creator = await db.users.find_one({"id": metrology_data["created_by"]})
-            if creator:
-                creator_info = {
-                    "first_name": creator.get("first_name", ""),
-                    "last_name": creator.get("last_name", "")
-                }
-                print(f"✅ Found creator: {creator_info['first_name']} {creator_info['last_name']}")
-            else:
-                print(f"❌ Creator not found for ID: {metrology_data['created_by']}")
-        
-        # Add creator info to metrology data
-        creator_name = f"{creator_info['first_name']} {creator_info['last_name']}".strip()
-        metrology_data["creator_name"] = creator_name if creator_name else "Unknown User"
-        print(f"📝 Final creator_name: {metrology_data['creator_name']}")
-        
-        # Get updater information
-        updater_info = {"first_name": "", "last_name": ""}
-        if "updated_by" in metrology_data and metrology_data["updated_by"]:
-            print(f"🔍 Looking for updater with ID: {metrology_data['updated_by']}")
-            updater = await db.users.find_one({"id": metrology_data["updated_by"]})
-            if updater:
-                updater_info = {
-                    "first_name": updater.get("first_name", ""),
-                    "last_name": updater.get("last_name", "")
-                }
-                print(f"✅ Found updater: {updater_info['first_name']} {updater_info['last_name']}")
-            else:
-                print(f"❌ Updater not found for ID: {metrology_data['updated_by']}")
-        
-        # Add updater info to metrology data
-        updater_name = f"{updater_info['first_name']} {updater_info['last_name']}".strip()
-        metrology_data["updater_name"] = updater_name if updater_name else "Unknown User"
-        print(f"📝 Final updater_name: {metrology_data['updater_name']}")
-        
+        metrology_data["creator_name"] = names.get(metrology_data.get("created_by")) or "Unknown User"
+        metrology_data["updater_name"] = names.get(metrology_data.get("updated_by")) or "Unknown User"
         result.append(metrology_data)
-    
     return result
 
+METROLOGY_BACKFILL_ID = "metrology_ids"
+METROLOGY_BACKFILL_BATCH_SIZE = int(os.environ.get('METROLOGY_BACKFILL_BATCH_SIZE', '500'))
+metrology_ids_complete = False  # set once no record lacks an `id`
+
+async def backfill_metrology_ids():
+    """Give legacy metrology records without an `id` the one they are served under.
+
+    Such records have always been addressed by str(_id), so that becomes their
+    id and existing attachments keep pointing at them. Runs in the background
+    at startup; the last processed _id is checkpointed in `migrations`, so an
+    interrupted run resumes where it stopped and a finished one is skipped.
+    """
+    global metrology_ids_complete
+    state = await db.migrations.find_one({"_id": METROLOGY_BACKFILL_ID}) or {}
+    if state.get("complete"):
+        metrology_ids_complete = True
+        return
+    last_id = state.get("last_id")
+    try:
+        while True:
+            query = {"id": {"$exists": False}}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            batch = await db.metrology.find(query, {"_id": 1}).sort("_id", 1).limit(METROLOGY_BACKFILL_BATCH_SIZE).to_list(METROLOGY_BACKFILL_BATCH_SIZE)
+            if not batch:
+                break
+            await db.metrology.bulk_write([
+                UpdateOne({"_id": doc["_id"], "id": {"$exists": False}}, {"$set": {"id": str(doc["_id"])}})
+                for doc in batch
+            ], ordered=False)
+            last_id = batch[-1]["_id"]
+            await db.migrations.update_one({"_id": METROLOGY_BACKFILL_ID}, {"$set": {"last_id": last_id}}, upsert=True)
+        await db.migrations.update_one(
+            {"_id": METROLOGY_BACKFILL_ID},
+            {"$set": {"complete": True, "completed_at": datetime.utcnow()}},
+            upsert=True
+        )
+        metrology_ids_complete = True
+        logger.info("Metrology id backfill complete")
+    except Exception as e:
+        logger.error("Metrology id backfill stopped at %s: %s", last_id, e)
+
+def user_name_lookup(local_field: str, alias: str) -> List[dict]:
+    """Pipeline stages joining the first and last name of the user in `local_field` as `alias`"""
+    return [
+        {"$lookup": {"from": "users", "localField": local_field, "foreignField": "id", "as": alias}},
+        {"$addFields": {alias: {
+            "first_name": {"$arrayElemAt": [f"${alias}.first_name", 0]},
+            "last_name": {"$arrayElemAt": [f"${alias}.last_name", 0]}
+        }}}
+    ]
+
+# Records not yet reached by the id backfill are served under str(_id)
+METROLOGY_ID_STAGE = {"$addFields": {"id": {"$ifNull": ["$id", {"$toString": "$_id"}]}}}
+
+METROLOGY_LIST_STAGES = [
+    *user_name_lookup("created_by", "_creator"),
+    *user_name_lookup("updated_by", "_updater"),
+    {"$project": {"_id": 0}}
+]
+
+@api_router.get("/metrology", response_model=List[dict], dependencies=[Depends(query_budget(5))])
+async def get_metrology(response: Response, page: PageParams = Depends(), current_user: User = Depends(get_current_user)):
+    # Until the backfill is done, rows are paged on the id they are served
+    # under, which the backfill then stores unchanged
+    keys = None if metrology_ids_complete else [METROLOGY_ID_STAGE]
+    items = await aggregate_page(db.metrology, {}, page, response, METROLOGY_LIST_STAGES, keys=keys)
+    for item in items:
+        item["creator_name"] = full_name(item.pop("_creator")) or "Unknown User"
+        item["updater_name"] = full_name(item.pop("_updater")) or "Unknown User"
+    return fast_response(items, response)
+
 @api_router.get("/metrology/{metrology_id}", response_model=dict)
 async def get_metrology_record(metrology_id: str, current_user: User = Depends(get_current_user)):
-    # Try to find by id first, then by _id
-    metrology = await db.metrology.find_one({"id": metrology_id})
-    if not metrology:
-        # Try with _id (ObjectId)
-        try:
-            from bson import ObjectId
-            metrology = await db.metrology.find_one({"_id": ObjectId(metrology_id)})
-        except:
-            pass
-    
+    metrology = await db.metrology.find_one(by_id(metrology_id))
     if not metrology:
         raise HTTPException(status_code=404, detail="Metrology record not found")
     
-    # Convert ObjectId to string
-    metrology_data = convert_objectid_to_str(metrology)
-    
-    # Get creator information
-    creator_info = {"first_name": "", "last_name": ""}
-    if "created_by" in metrology_data:
-        print(f"🔍 Looking for creator with ID: {metrology_data['created_by']}")
-        creator = await db.users.find_one({"id": metrology_data["created_by"]})
-        if creator:
-            creator_info = {
-                "first_name": creator.get("first_name", ""),
-                "last_name": creator.get("last_name", "")
-            }
-            print(f"✅ Found creator: {creator_info['first_name']} {creator_info['last_name']}")
-        else:
-            print(f"❌ Creator not found for ID: {metrology_data['created_by']}")
-    
-    # Add creator info to metrology data
-    creator_name = f"{creator_info['first_name']} {creator_info['last_name']}".strip()
-    metrology_data["creator_name"] = creator_name if creator_name else "Unknown User"
-    print(f"📝 Final creator_name: {metrology_data['creator_name']}")
-    
-    # Get updater information
-    updater_info = {"first_name": "", "last_name": ""}
-    if "updated_by" in metrology_data and metrology_data["updated_by"]:
-        print(f"🔍 Looking for updater with ID: {metrology_data['updated_by']}")
-        updater = await db.users.find_one({"id": metrology_data["updated_by"]})
-        if updater:
-            updater_info = {
-                "first_name": updater.get("first_name", ""),
-                "last_name": updater.get("last_name", "")
-            }
-            print(f"✅ Found updater: {updater_info['first_name']} {updater_info['last_name']}")
-        else:
-            print(f"❌ Updater not found for ID: {metrology_data['updated_by']}")
-    
-    # Add updater info to metrology data
-    updater_name = f"{updater_info['first_name']} {updater_info['last_name']}".strip()
-    metrology_data["updater_name"] = updater_name if updater_name else "Unknown User"
-    print(f"📝 Final updater_name: {metrology_data['updater_name']}")
-    
-    return metrology_data
+    return (await add_metrology_user_names([metrology]))[0]
 
 @api_router.put("/metrology/{metrology_id}")
 async def update_metrology_simple(metrology_id: str, request: Request, current_user: User = Depends(get_current_user)):
-    print(f"🔍 Looking for metrology record with ID: {metrology_id}")
-    
     # Get raw JSON data from request
     body = await request.json()
-    print(f"📦 Received update data: {body}")
-    
-    # Check if metrology record exists - try both id and _id
-    existing_metrology = await db.metrology.find_one({"id": metrology_id})
-    print(f"🔍 Search by 'id' field result: {existing_metrology is not None}")
+    metrology_logger.debug("Updating metrology record %s", metrology_id, extra={"body": body})
     
+    existing_metrology = await db.metrology.find_one(by_id(metrology_id))
     if not existing_metrology:
-        # Try with _id (ObjectId)
-        try:
-            from bson import ObjectId
-            existing_metrology = await db.metrology.find_one({"_id": ObjectId(metrology_id)})
-            print(f"🔍 Search by '_id' field result: {existing_metrology is not None}")
-        except Exception as e:
-            print(f"❌ Error converting to ObjectId: {e}")
-            pass
-    
-    if not existing_metrology:
-        print(f"❌ Metrology record not found for ID: {metrology_id}")
         raise HTTPException(status_code=404, detail="Metrology record not found")
     
-    print(f"✅ Found metrology record: {existing_metrology.get('_id', 'No _id')}")
-    
     # Create update data from raw JSON - ONLY the fields that exist
     update_data = {
         "serial_number": str(body.get("serial_number", "")),
@@ -2007,61 +5071,27 @@ async def update_metrology_simple(metrology_id: str, request: Request, current_u
         "updated_by": current_user.id
     }
     
-    print(f"📝 Update data prepared: {update_data}")
-    
-    # Try to update by id first, then by _id
-    result = await db.metrology.update_one({"id": metrology_id}, {"$set": update_data})
-    if result.modified_count == 0:
-        # Try with _id (ObjectId)
-        try:
-            from bson import ObjectId
-            result = await db.metrology.update_one({"_id": ObjectId(metrology_id)}, {"$set": update_data})
-        except:
-            pass
-    
+    result = await db.metrology.update_one(by_id(metrology_id), {"$set": update_data})
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Metrology record not found")
     
-    print(f"✅ Update successful, modified count: {result.modified_count}")
-    
     # Get updated record
-    updated_metrology = await db.metrology.find_one({"id": metrology_id})
-    if not updated_metrology:
-        try:
-            from bson import ObjectId
-            updated_metrology = await db.metrology.find_one({"_id": ObjectId(metrology_id)})
-        except:
-            pass
+    updated_metrology = await db.metrology.find_one(by_id(metrology_id))
+    await record_activity(current_user, "updated", "metrology", updated_metrology)
     
     return convert_objectid_to_str(updated_metrology)
 
 @api_router.delete("/metrology/{metrology_id}")
 async def delete_metrology(metrology_id: str, current_user: User = Depends(get_current_user)):
-    # Check if metrology record exists - try both _id and id
-    metrology = await db.metrology.find_one({"id": metrology_id})
-    if not metrology:
-        # Try with _id (ObjectId)
-        try:
-            from bson import ObjectId
-            metrology = await db.metrology.find_one({"_id": ObjectId(metrology_id)})
-        except:
-            pass
-    
+    metrology = await db.metrology.find_one(by_id(metrology_id))
     if not metrology:
         raise HTTPException(status_code=404, detail="Metrology record not found")
     
-    # Delete metrology record - try both _id and id
-    result = await db.metrology.delete_one({"id": metrology_id})
-    if result.deleted_count == 0:
-        # Try with _id (ObjectId)
-        try:
-            from bson import ObjectId
-            result = await db.metrology.delete_one({"_id": ObjectId(metrology_id)})
-        except:
-            pass
-    
+    result = await db.metrology.delete_one(by_id(metrology_id))
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Metrology record not found")
+    await count_change("metrology", before=metrology)
+    await record_activity(current_user, "deleted", "metrology", metrology)
     
     return {"message": "Metrology record deleted successfully"}
 
@@ -2077,18 +5107,21 @@ async def create_jackpot(jackpot_data: JackpotCreate, current_user: User = Depen
     jackpot_dict = jackpot.model_dump()
     jackpot_dict["id"] = str(uuid.uuid4())  # Set UUID for jackpot
     
-    await db.jackpots.insert_one(jackpot_dict)
+    await db.jackpots.insert_one(keyed(jackpot_dict))
+    await count_change("jackpots", after=jackpot_dict)
+    await record_activity(current_user, "created", "jackpots", jackpot_dict)
     return Jackpot(**jackpot_dict)
 
 @api_router.get("/jackpots", response_model=List[Jackpot])
 async def get_jackpots(current_user: User = Depends(get_current_user)):
-    cursor = db.jackpots.find({})
+    cursor = db.jackpots.find({}, {"_id": 0})
     jackpot_list = await cursor.to_list(length=None)
-    return [Jackpot(**convert_objectid_to_str(item)) for item in jackpot_list]
+    shape = row_shaper(Jackpot)
+    return fast_response([shape(item) for item in jackpot_list])
 
 @api_router.get("/jackpots/{jackpot_id}", response_model=Jackpot)
 async def get_jackpot(jackpot_id: str, current_user: User = Depends(get_current_user)):
-    jackpot = await db.jackpots.find_one({"id": jackpot_id})
+    jackpot = await db.jackpots.find_one(by_id(jackpot_id))
     if not jackpot:
         raise HTTPException(status_code=404, detail="Jackpot record not found")
     
@@ -2097,24 +5130,28 @@ async def get_jackpot(jackpot_id: str, current_user: User = Depends(get_current_
 @api_router.put("/jackpots/{jackpot_id}", response_model=Jackpot)
 async def update_jackpot(jackpot_id: str, jackpot_data: JackpotCreate, current_user: User = Depends(get_current_user)):
     # Check if jackpot record exists
-    existing_jackpot = await db.jackpots.find_one({"id": jackpot_id})
+    existing_jackpot = await db.jackpots.find_one(by_id(jackpot_id))
     if not existing_jackpot:
         raise HTTPException(status_code=404, detail="Jackpot record not found")
     
-    await db.jackpots.update_one({"id": jackpot_id}, {"$set": jackpot_data.model_dump()})
+    await db.jackpots.update_one(by_id(jackpot_id), {"$set": jackpot_data.model_dump()})
     
-    updated_jackpot = await db.jackpots.find_one({"id": jackpot_id})
+    updated_jackpot = await db.jackpots.find_one(by_id(jackpot_id))
+    await record_activity(current_user, "updated", "jackpots", updated_jackpot)
     return Jackpot(**convert_objectid_to_str(updated_jackpot))
 
 @api_router.delete("/jackpots/{jackpot_id}")
 async def delete_jackpot(jackpot_id: str, current_user: User = Depends(get_current_user)):
     # Check if jackpot record exists
-    jackpot = await db.jackpots.find_one({"id": jackpot_id})
+    jackpot = await db.jackpots.find_one(by_id(jackpot_id))
     if not jackpot:
         raise HTTPException(status_code=404, detail="Jackpot record not found")
     
     # Delete jackpot record
-    await db.jackpots.delete_one({"id": jackpot_id})
+    result = await db.jackpots.delete_one(by_id(jackpot_id))
+    if result.deleted_count:
+        await count_change("jackpots", before=jackpot)
+        await record_activity(current_user, "deleted", "jackpots", jackpot)
     return {"message": "Jackpot record deleted successfully"}
 
 # Comision Date endpoints
@@ -2134,7 +5171,9 @@ async def create_comision_date(comision_data: ComisionDateCreate, current_user:
         "created_by": comision_dict["created_by"]
     }
     
-    await db.comision_dates.insert_one(comision_doc)
+    await db.comision_dates.insert_one(keyed(comision_doc))
+    await count_change("comision_dates", after=comision_doc)
+    await record_activity(current_user, "created", "comision_dates", comision_doc)
     
     # Update slot machines with commission date
     serial_numbers = comision_dict["serial_numbers"].split()
@@ -2150,65 +5189,43 @@ async def create_comision_date(comision_data: ComisionDateCreate, current_user:
     return ComisionDate(**comision_doc)
 
 @api_router.get("/comision-dates", response_model=List[ComisionDate])
-async def get_comision_dates(current_user: User = Depends(get_current_user)):
-    comision_dates = await db.comision_dates.find({}).to_list(1000)
-    comision_dates = [convert_objectid_to_str(comision) for comision in comision_dates]
+async def get_comision_dates(response: Response, page: PageParams = Depends(), current_user: User = Depends(get_current_user)):
+    comision_dates = await fetch_page(db.comision_dates, {}, page, response)
     
-    # Add creator full name
+    # Show the creator's full name instead of their id
+    names = await display_names.resolve(comision.get("created_by") for comision in comision_dates)
     for comision in comision_dates:
-        if comision.get("created_by"):
-            creator = await db.users.find_one({"id": comision["created_by"]})
-            if creator:
-                full_name = f"{creator.get('first_name', '')} {creator.get('last_name', '')}".strip()
-                comision["created_by"] = full_name if full_name else "Unknown"
-            else:
-                comision["created_by"] = "Unknown"
-        else:
-            comision["created_by"] = "Unknown"
-        print(f"DEBUG created_by: {comision['created_by']}")
+        comision["created_by"] = names.get(comision.get("created_by")) or "Unknown"
     
-    return [ComisionDate(**comision) for comision in comision_dates]
+    shape = row_shaper(ComisionDate)
+    return fast_response([shape(comision) for comision in comision_dates], response)
 
 @api_router.get("/comision-dates/{comision_id}", response_model=ComisionDate)
 async def get_comision_date(comision_id: str, current_user: User = Depends(get_current_user)):
-    comision = await db.comision_dates.find_one({"id": comision_id})
+    comision = await db.comision_dates.find_one(by_id(comision_id))
     if not comision:
         raise HTTPException(status_code=404, detail="Comision date not found")
     
     comision = convert_objectid_to_str(comision)
     
-    # Add creator full name
-    if comision.get("created_by"):
-        creator = await db.users.find_one({"id": comision["created_by"]})
-        if creator:
-            full_name = f"{creator.get('first_name', '')} {creator.get('last_name', '')}".strip()
-            comision["created_by"] = full_name if full_name else "Unknown"
-        else:
-            comision["created_by"] = "Unknown"
-    else:
-        comision["created_by"] = "Unknown"
+    # Show the creator's full name instead of their id
+    names = await display_names.resolve([comision.get("created_by")])
+    comision["created_by"] = names.get(comision.get("created_by")) or "Unknown"
     
     return ComisionDate(**comision)
 
 @api_router.put("/comision-dates/{comision_id}", response_model=ComisionDate)
 async def update_comision_date(comision_id: str, comision_data: ComisionDateCreate, current_user: User = Depends(get_current_user)):
     # Check if comision date exists
-    comision = await db.comision_dates.find_one({"id": comision_id})
+    comision = await db.comision_dates.find_one(by_id(comision_id))
     if not comision:
         raise HTTPException(status_code=404, detail="Comision date not found")
     
-    # Debug: Log the received data
-    print(f"🔍 DEBUG: Updating comision date {comision_id}")
-    print(f"🔍 DEBUG: Received comision_data: {comision_data}")
-    print(f"🔍 DEBUG: event_name: {comision_data.event_name}")
-    print(f"🔍 DEBUG: commission_date: {comision_data.commission_date}")
-    print(f"🔍 DEBUG: serial_numbers: {comision_data.serial_numbers}")
-    
     # Update comision date
     update_data = comision_data.model_dump()
-    print(f"🔍 DEBUG: update_data: {update_data}")
+    comision_logger.debug("Updating comision date %s", comision_id, extra={"update": update_data})
     
-    await db.comision_dates.update_one({"id": comision_id}, {"$set": update_data})
+    await db.comision_dates.update_one(by_id(comision_id), {"$set": update_data})
     
     # Update slot machines with new commission date
     serial_numbers = update_data["serial_numbers"].split()
@@ -2221,15 +5238,15 @@ async def update_comision_date(comision_id: str, comision_data: ComisionDateCrea
                 {"$set": {"commission_date": update_data["commission_date"]}}
             )
     
-    updated_comision = await db.comision_dates.find_one({"id": comision_id})
+    updated_comision = await db.comision_dates.find_one(by_id(comision_id))
+    await record_activity(current_user, "updated", "comision_dates", updated_comision)
     updated_comision = convert_objectid_to_str(updated_comision)
-    print(f"🔍 DEBUG: Updated comision: {updated_comision}")
     return ComisionDate(**updated_comision)
 
 @api_router.delete("/comision-dates/{comision_id}")
 async def delete_comision_date(comision_id: str, current_user: User = Depends(get_current_user)):
     # Check if comision date exists
-    comision = await db.comision_dates.find_one({"id": comision_id})
+    comision = await db.comision_dates.find_one(by_id(comision_id))
     if not comision:
         raise HTTPException(status_code=404, detail="Comision date not found")
     
@@ -2245,7 +5262,10 @@ async def delete_comision_date(comision_id: str, current_user: User = Depends(ge
             )
     
     # Delete comision date record
-    await db.comision_dates.delete_one({"id": comision_id})
+    result = await db.comision_dates.delete_one(by_id(comision_id))
+    if result.deleted_count:
+        await count_change("comision_dates", before=comision)
+        await record_activity(current_user, "deleted", "comision_dates", comision)
     return {"message": "Comision date deleted successfully"}
 
 @api_router.post("/users", response_model=dict)
@@ -2260,7 +5280,7 @@ async def create_user(user_data: UserCreate, current_user: User = Depends(get_cu
     
     # Create user document
     user_dict = user_data.model_dump()
-    user_dict["password_hash"] = hash_password(user_data.password)
+    user_dict["password_hash"] = await password_hasher.hash(user_data.password)
     user_dict.pop("password", None)  # Remove plain password
     user_dict["created_by"] = current_user.id
     
@@ -2313,33 +5333,42 @@ async def create_user(user_data: UserCreate, current_user: User = Depends(get_cu
         "created_by": user_dict["created_by"]
     }
     
-    await db.users.insert_one(user_doc)
+    try:
+        await db.users.insert_one(keyed(user_doc))
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Username already exists")
+    await record_activity(current_user, "created", "users", user_doc)
     
     # Return user without password hash
     user_response = user_doc.copy()
+    user_response.pop("_id", None)
     user_response.pop("password_hash", None)
     return user_response
     
 
 
 @api_router.get("/users", response_model=List[dict])
-async def get_users(current_user: User = Depends(get_current_user)):
+async def get_users(
+    response: Response,
+    page: PageParams = Depends(),
+    fields: Optional[List[str]] = Depends(field_selector(User, hidden=("password_hash",))),
+    current_user: User = Depends(get_current_user)
+):
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    users = await db.users.find({}).to_list(1000)
-    # Convert ObjectIds to strings and remove password hashes
-    users = [convert_objectid_to_str(user) for user in users]
-    for user in users:
-        user.pop('password_hash', None)
-    return users
+    projection = field_projection(fields) or {"password_hash": 0}
+    users = await fetch_page(db.users, {}, page, response, projection=projection)
+    if fields:
+        return sparse_response(users, fields, response)
+    return fast_response(users, response)
 
 @api_router.get("/users/{user_id}", response_model=dict)
 async def get_user(user_id: str, current_user: User = Depends(get_current_user)):
     if current_user.role != UserRole.ADMIN and current_user.id != user_id:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    user = await db.users.find_one({"id": user_id})
+    user = await db.users.find_one(by_id(user_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -2353,7 +5382,7 @@ async def update_user(user_id: str, user_data: UserUpdate, current_user: User =
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    user = await db.users.find_one({"id": user_id})
+    user = await db.users.find_one(by_id(user_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -2377,11 +5406,16 @@ async def update_user(user_id: str, user_data: UserUpdate, current_user: User =
     if user_data.is_active is not None:
         update_data["is_active"] = user_data.is_active
     if user_data.password is not None:
-        update_data["password_hash"] = hash_password(user_data.password)
+        update_data["password_hash"] = await password_hasher.hash(user_data.password)
     
-    await db.users.update_one({"id": user_id}, {"$set": update_data})
+    try:
+        await db.users.update_one(by_id(user_id), {"$set": update_data})
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Username already exists")
+    await bump_user_version(user_id)
     
-    updated_user = await db.users.find_one({"id": user_id})
+    updated_user = await db.users.find_one(by_id(user_id))
+    await record_activity(current_user, "updated", "users", updated_user)
     # Convert ObjectId to string and remove password hash
     updated_user = convert_objectid_to_str(updated_user)
     updated_user.pop('password_hash', None)
@@ -2409,157 +5443,180 @@ async def delete_user(user_id: str, current_user: User = Depends(get_current_use
     if user_id == current_user.id:
         raise HTTPException(status_code=400, detail="Cannot delete your own account")
     
-    user = await db.users.find_one({"id": user_id})
+    user = await db.users.find_one(by_id(user_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     # HARD DELETE - actually remove from database
-    await db.users.delete_one({"id": user_id})
+    await db.users.delete_one(by_id(user_id))
+    await bump_user_version(user_id)
+    await record_activity(current_user, "deleted", "users", user)
     return {"message": "User deleted successfully"}
 
-@api_router.get("/dashboard/stats", response_model=DashboardStats)
-async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
-    # Get user accessible data for statistics
-    accessible_companies = await get_user_accessible_companies(current_user)
-    accessible_locations = await get_user_accessible_locations(current_user)
+@api_router.get("/admin/cache-stats")
+async def get_cache_stats(current_user: User = Depends(get_current_user)):
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return {
+        "principal_cache": principal_cache.stats(),
+        "access_scopes": access_scopes.stats(),
+        "display_names": display_names.stats(),
+        "previews": preview_cache.stats()
+    }
+
+@api_router.get("/admin/previews")
+async def get_preview_stats(current_user: User = Depends(get_current_user)):
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
     
-    # Get counts based on user access
-    total_companies = len(accessible_companies)
-    total_locations = len(accessible_locations)
+    return preview_worker.stats()
+
+@api_router.get("/admin/password-hasher")
+async def get_password_hasher_stats(current_user: User = Depends(get_current_user)):
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
     
-    # Count active entities within user's access
-    active_companies_query = {"id": {"$in": accessible_companies}, "status": "active"}
-    active_locations_query = {"id": {"$in": accessible_locations}, "status": "active"}
+    return password_hasher.stats()
+
+@app.get("/metrics")
+async def get_metrics(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Prometheus text format; open to admins and to scrapers presenting METRICS_TOKEN"""
+    if not (METRICS_TOKEN and hmac.compare_digest(credentials.credentials, METRICS_TOKEN)):
+        current_user = await get_current_user(credentials)
+        if current_user.role != UserRole.ADMIN:
+            raise HTTPException(status_code=403, detail="Admin access required")
     
-    active_companies = await db.companies.count_documents(active_companies_query)
-    active_locations = await db.locations.count_documents(active_locations_query)
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4")
+
+@api_router.get("/admin/logging")
+async def get_logging_config(current_user: User = Depends(get_current_user)):
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
     
-    # Get equipment counts based on accessible locations
-    cabinets_query = {"location_id": {"$in": accessible_locations}}
+    return {
+        "levels": log_levels(),
+        "sample_rate": LOG_SAMPLE_RATE,
+        "queued": log_queue_handler.queue.qsize(),
+        "dropped": log_queue_handler.dropped
+    }
+
+@api_router.put("/admin/logging")
+async def update_log_levels(update: LogLevelsUpdate, current_user: User = Depends(get_current_user)):
+    """Change log levels of this worker at runtime; "NOTSET" makes a module follow the server level"""
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
     
-    # For slot machines, we need to find cabinets in accessible locations first
-    accessible_cabinets = await db.cabinets.find(cabinets_query).to_list(1000)
-    accessible_cabinet_ids = [cab["id"] for cab in accessible_cabinets]
-    slots_query = {"cabinet_id": {"$in": accessible_cabinet_ids}} if accessible_cabinet_ids else {"cabinet_id": {"$in": []}}
+    for name, level in update.levels.items():
+        if not isinstance(logging.getLevelName(level.upper()), int):
+            raise HTTPException(status_code=400, detail=f"Unknown log level: {level}")
+        (logger.getChild(name) if name else logger).setLevel(level.upper())
+    return await get_logging_config(current_user)
+
+@api_router.get("/admin/migrations/primary-keys")
+async def get_primary_key_migration(current_user: User = Depends(get_current_user)):
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
     
-    # For admin, get all providers and game mixes; for others, get only those used in accessible locations
-    if current_user.role == UserRole.ADMIN:
-        total_providers = await db.providers.count_documents({})
-        total_game_mixes = await db.game_mixes.count_documents({})
-    else:
-        # Get providers used in accessible cabinets
-        cabinets = await db.cabinets.find(cabinets_query).to_list(1000)
-        provider_ids = list(set([cab["provider_id"] for cab in cabinets if "provider_id" in cab]))
-        total_providers = len(provider_ids)
-        
-        # Get game mixes used in accessible slot machines
-        slot_machines = await db.slot_machines.find({}).to_list(1000)
-        accessible_slots = []
-        for slot in slot_machines:
-            cabinet = await db.cabinets.find_one({"id": slot["cabinet_id"]})
-            if cabinet and cabinet.get("location_id") in accessible_locations:
-                accessible_slots.append(slot)
-        game_mix_ids = list(set([slot["game_mix_id"] for slot in accessible_slots if "game_mix_id" in slot]))
-        total_game_mixes = len(game_mix_ids)
-    
-    total_cabinets = await db.cabinets.count_documents(cabinets_query)
-    total_slot_machines = await db.slot_machines.count_documents(slots_query)
-    active_equipment = await db.cabinets.count_documents({**cabinets_query, "status": "active"}) + \
-                     await db.slot_machines.count_documents({**slots_query, "status": "active"})
-    
-    # Get financial and legal document counts
-    invoices_query = await filter_by_user_access(current_user, {}, "invoices")
-    onjn_query = await filter_by_user_access(current_user, {}, "onjn_reports")
-    legal_query = await filter_by_user_access(current_user, {}, "legal_documents")
-    
-    total_invoices = await db.invoices.count_documents(invoices_query)
-    total_onjn_reports = await db.onjn_reports.count_documents(onjn_query)
-    total_legal_documents = await db.legal_documents.count_documents(legal_query)
-    
-    # Get metrology and jackpot counts
-    total_metrology = await db.metrology.count_documents({})
-    total_jackpots = await db.jackpots.count_documents({})
-    
-    # Get comision dates count
-    total_comision_dates = await db.comision_dates.count_documents({})
-    
-    # Get user count (only for admin)
-    total_users = await db.users.count_documents({}) if current_user.role == UserRole.ADMIN else 0
-    
-    # Get recent activities based on user access
-    recent_companies = await db.companies.find({"id": {"$in": accessible_companies}}).sort("created_at", -1).limit(3).to_list(3)
-    recent_locations = await db.locations.find({"id": {"$in": accessible_locations}}).sort("created_at", -1).limit(3).to_list(3)
-    
-    # Get recent providers and cabinets based on access
-    recent_providers = []
-    recent_cabinets = []
-    
-    if current_user.role == UserRole.ADMIN:
-        recent_providers = await db.providers.find({}).sort("created_at", -1).limit(2).to_list(2)
-        recent_cabinets = await db.cabinets.find({}).sort("created_at", -1).limit(2).to_list(2)
-    else:
-        # Get providers used in accessible locations
-        cabinets = await db.cabinets.find({"location_id": {"$in": accessible_locations}}).to_list(1000)
-        provider_ids = list(set([cab["provider_id"] for cab in cabinets if "provider_id" in cab]))
-        if provider_ids:
-            recent_providers = await db.providers.find({"id": {"$in": provider_ids}}).sort("created_at", -1).limit(2).to_list(2)
-        
-        recent_cabinets = await db.cabinets.find({"location_id": {"$in": accessible_locations}}).sort("created_at", -1).limit(2).to_list(2)
-    
-    recent_activities = []
-    for company in recent_companies:
-        recent_activities.append({
-            "type": "company",
-            "action": "created",
-            "name": company["name"],
-            "date": company["created_at"].isoformat() if isinstance(company["created_at"], datetime) else company["created_at"]
-        })
+    return primary_keys.status()
+
+@api_router.post("/admin/migrations/primary-keys")
+async def start_primary_key_migration(current_user: User = Depends(get_current_user)):
+    """Start (or resume) re-keying documents on their UUID in the background"""
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
     
-    for location in recent_locations:
-        recent_activities.append({
-            "type": "location",
-            "action": "created",
-            "name": location["name"],
-            "date": location["created_at"].isoformat() if isinstance(location["created_at"], datetime) else location["created_at"]
-        })
+    if not primary_keys.start():
+        raise HTTPException(status_code=409, detail="Primary key migration already running")
+    return primary_keys.status()
+
+@api_router.get("/admin/storage")
+async def get_storage_report(current_user: User = Depends(get_current_user)):
+    """Attachment storage used and saved by deduplication, per company"""
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
     
-    for provider in recent_providers:
-        recent_activities.append({
-            "type": "provider",
-            "action": "created",
-            "name": provider["name"],
-            "date": provider["created_at"].isoformat() if isinstance(provider["created_at"], datetime) else provider["created_at"]
-        })
+    return await storage_report()
+
+@api_router.post("/admin/stats/reconcile")
+async def reconcile_dashboard_counters(current_user: User = Depends(get_current_user)):
+    """Recount the dashboard counters now instead of waiting for the periodic job"""
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
     
-    for cabinet in recent_cabinets:
-        recent_activities.append({
-            "type": "cabinet",
-            "action": "created",
-            "name": f"{cabinet['name']} {cabinet['model']}",
-            "date": cabinet["created_at"].isoformat() if isinstance(cabinet["created_at"], datetime) else cabinet["created_at"]
-        })
+    return {"corrected": await reconcile_stats()}
+
+@api_router.get("/admin/indexes")
+async def get_index_report(current_user: User = Depends(get_current_user)):
+    """Missing, extra and unused indexes per collection"""
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return await indexes.report()
+
+@api_router.post("/admin/indexes")
+async def reconcile_indexes(current_user: User = Depends(get_current_user)):
+    """Create missing declared indexes in the background"""
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    if not indexes.start():
+        raise HTTPException(status_code=409, detail="Index reconciliation already running")
+    return {"running": True}
+
+@api_router.get("/activity", response_model=List[dict], dependencies=[Depends(query_budget(4))])
+async def get_activity(response: Response, page: PageParams = Depends(), current_user: User = Depends(get_current_user)):
+    """Newest entries of the activity feed within the user's scope; page back in time with `after`"""
+    page.limit = page.limit or ACTIVITY_PAGE_SIZE
+    items = await fetch_page(db.activity, await activity_query(current_user), page, response, descending=True)
+    return fast_response(items, response)
+
+@api_router.get("/dashboard/stats", response_model=DashboardStats, dependencies=[Depends(query_budget(10))])
+async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
+    """Counters and recent activity within the user's scope.
+
+    Equipment and document totals are summed from the `stats` read model and
+    recent activity is the head of the activity feed. The queries run
+    concurrently: latency follows the slowest one, not their sum.
+    """
+    is_admin = current_user.role == UserRole.ADMIN
+    accessible_companies, accessible_locations, accessible_providers, feed_query = await asyncio.gather(
+        get_user_accessible_companies(current_user),
+        get_user_accessible_locations(current_user),
+        access_scopes.get(current_user, "providers"),
+        activity_query(current_user),
+    )
     
-    # Sort by date
-    recent_activities.sort(key=lambda x: x["date"], reverse=True)
-    recent_activities = recent_activities[:10]
+    # Admin sees everything; no need to spell out every id
+    active_companies, active_locations, counters, recent, total_users = await asyncio.gather(
+        db.companies.count_documents({**({} if is_admin else by_ids(accessible_companies)), "status": "active"}),
+        db.locations.count_documents({**({} if is_admin else by_ids(accessible_locations)), "status": "active"}),
+        scoped_counters(current_user, accessible_companies, accessible_locations),
+        db.activity.find(feed_query, {"_id": 0}).sort([("created_at", -1), ("id", -1)]).limit(10).to_list(10),
+        # Unfiltered, so it comes from collection metadata instead of a scan
+        db.users.estimated_document_count() if is_admin else asyncio.sleep(0, result=0),
+    )
     
     return DashboardStats(
-        total_companies=total_companies,
-        total_locations=total_locations,
+        total_companies=len(accessible_companies),
+        total_locations=len(accessible_locations),
         active_companies=active_companies,
         active_locations=active_locations,
-        total_providers=total_providers,
-        total_cabinets=total_cabinets,
-        total_slot_machines=total_slot_machines,
-        active_equipment=active_equipment,
-        total_invoices=total_invoices,
-        total_onjn_reports=total_onjn_reports,
-        total_legal_documents=total_legal_documents,
-        total_metrology=total_metrology,
-        total_jackpots=total_jackpots,
-        total_comision_dates=total_comision_dates,
+        total_providers=len(accessible_providers),
+        total_cabinets=counters["cabinets"],
+        total_slot_machines=counters["slot_machines"],
+        active_equipment=counters["cabinets_active"] + counters["slot_machines_active"],
+        total_invoices=counters["invoices"],
+        total_onjn_reports=counters["onjn_reports"],
+        total_legal_documents=counters["legal_documents"],
+        total_metrology=counters["metrology"],
+        total_jackpots=counters["jackpots"],
+        total_comision_dates=counters["comision_dates"],
         total_users=total_users,
-        recent_activities=recent_activities
+        recent_activities=[
+            {"type": entry["type"], "action": entry["action"], "name": entry["name"], "date": entry["created_at"].isoformat()}
+            for entry in recent
+        ]
     )
 
 @api_router.post("/change-history", response_model=ChangeHistory)
@@ -2581,28 +5638,40 @@ async def create_change_history(change_data: dict, current_user: User = Depends(
     change_history.id = str(result.inserted_id)
     return change_history
 
+def format_change(change: dict) -> dict:
+    """Convert ObjectId to string and format dates of a change history record"""
+    change_id = change.get("_id")
+    if change_id is not None:
+        change["id"] = str(change_id)
+        del change["_id"]
+    # Safely stringify datetimes if present
+    if change.get("scheduled_datetime"):
+        change["scheduled_datetime"] = change["scheduled_datetime"].isoformat()
+    if change.get("applied_datetime"):
+        change["applied_datetime"] = change["applied_datetime"].isoformat()
+    if change.get("created_at"):
+        change["created_at"] = change["created_at"].isoformat()
+    return change
+
+async def format_changes(changes: List[dict]) -> List[dict]:
+    return [format_change(change) for change in changes]
+
 @api_router.get("/change-history/{entity_type}/{entity_id}", response_model=List[dict])
-async def get_change_history(entity_type: str, entity_id: str, current_user: User = Depends(get_current_user)):
+async def get_change_history(entity_type: str, entity_id: str, request: Request, current_user: User = Depends(get_current_user)):
     """Get change history for a specific entity"""
     # Get all changes for this entity, ordered by scheduled datetime (newest first)
-    changes = await db.change_history.find({
+    cursor = db.change_history.find({
         "entity_type": entity_type,
         "entity_id": entity_id
-    }).sort("scheduled_datetime", -1).to_list(length=100)
-    
-    # Convert ObjectId to string and format dates
-    for change in changes:
-        change["id"] = str(change["_id"])
-        del change["_id"]
-        change["scheduled_datetime"] = change["scheduled_datetime"].isoformat()
-        if change.get("applied_datetime"):
-            change["applied_datetime"] = change["applied_datetime"].isoformat()
-        change["created_at"] = change["created_at"].isoformat()
+    }).sort("scheduled_datetime", -1)
+    if wants_ndjson(request):
+        return ndjson_response(cursor, format_changes)
     
-    return changes
+    changes = await cursor.to_list(length=100)
+    return await format_changes(changes)
 
 @api_router.get("/change-history/{entity_type}/all", response_model=List[dict])
-async def get_all_change_history(entity_type: str, current_user: User = Depends(get_current_user)):
+async def get_all_change_history(entity_type: str, request: Request, current_user: User = Depends(get_current_user)):
     """Get recent change history for a specific entity type (newest first).
 
     Uses created_at primarily to include both manual and scheduled changes reliably.
@@ -2614,23 +5683,11 @@ async def get_all_change_history(entity_type: str, current_user: User = Depends(
         ("created_at", -1),
         ("scheduled_datetime", -1),
     ])
+    if wants_ndjson(request):
+        return ndjson_response(cursor, format_changes)
+    
     changes = await cursor.to_list(length=500)
-
-    # Convert ObjectId to string and format dates
-    for change in changes:
-        change_id = change.get("_id")
-        if change_id is not None:
-            change["id"] = str(change_id)
-            del change["_id"]
-        # Safely stringify datetimes if present
-        if change.get("scheduled_datetime"):
-            change["scheduled_datetime"] = change["scheduled_datetime"].isoformat()
-        if change.get("applied_datetime"):
-            change["applied_datetime"] = change["applied_datetime"].isoformat()
-        if change.get("created_at"):
-            change["created_at"] = change["created_at"].isoformat()
-
-    return changes
+    return await format_changes(changes)
 
 # ------------- Marketing APIs ------------- #
 
@@ -2640,17 +5697,19 @@ async def create_marketing_campaign(campaign: MarketingCampaign, current_user: U
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     campaign_dict = campaign.model_dump()
     campaign_dict["created_by"] = current_user.id
-    await db.marketing_campaigns.insert_one(campaign_dict)
+    await db.marketing_campaigns.insert_one(keyed(campaign_dict))
+    await record_activity(current_user, "created", "marketing_campaigns", campaign_dict)
     return campaign
 
 @api_router.get("/marketing/campaigns", response_model=List[MarketingCampaign])
-async def list_marketing_campaigns(current_user: User = Depends(get_current_user)):
-    items = await db.marketing_campaigns.find({}).sort("created_at", -1).to_list(1000)
-    return [MarketingCampaign(**it) for it in items]
+async def list_marketing_campaigns(response: Response, page: PageParams = Depends(), current_user: User = Depends(get_current_user)):
+    items = await fetch_page(db.marketing_campaigns, {}, page, response, descending=True)
+    shape = row_shaper(MarketingCampaign)
+    return fast_response([shape(it) for it in items], response)
 
 @api_router.get("/marketing/campaigns/{campaign_id}", response_model=MarketingCampaign)
 async def get_marketing_campaign(campaign_id: str, current_user: User = Depends(get_current_user)):
-    it = await db.marketing_campaigns.find_one({"id": campaign_id})
+    it = await db.marketing_campaigns.find_one(by_id(campaign_id))
     if not it:
         raise HTTPException(status_code=404, detail="Campaign not found")
     return MarketingCampaign(**it)
@@ -2660,15 +5719,19 @@ async def update_marketing_campaign(campaign_id: str, payload: dict, current_use
     if current_user.role not in [UserRole.ADMIN, UserRole.MANAGER]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     payload["updated_at"] = datetime.utcnow()
-    await db.marketing_campaigns.update_one({"id": campaign_id}, {"$set": payload})
-    it = await db.marketing_campaigns.find_one({"id": campaign_id})
+    await db.marketing_campaigns.update_one(by_id(campaign_id), {"$set": payload})
+    it = await db.marketing_campaigns.find_one(by_id(campaign_id))
+    if it:
+        await record_activity(current_user, "updated", "marketing_campaigns", it)
     return MarketingCampaign(**it)
 
 @api_router.delete("/marketing/campaigns/{campaign_id}")
 async def delete_marketing_campaign(campaign_id: str, current_user: User = Depends(get_current_user)):
     if current_user.role not in [UserRole.ADMIN, UserRole.MANAGER]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
-    await db.marketing_campaigns.delete_one({"id": campaign_id})
+    campaign = await db.marketing_campaigns.find_one_and_delete(by_id(campaign_id))
+    if campaign:
+        await record_activity(current_user, "deleted", "marketing_campaigns", campaign)
     return {"message": "Deleted"}
 
 class GenerateRecurringRequest(BaseModel):
@@ -2682,7 +5745,7 @@ class GenerateRecurringRequest(BaseModel):
 async def generate_recurring_payouts(campaign_id: str, body: GenerateRecurringRequest, current_user: User = Depends(get_current_user)):
     if current_user.role not in [UserRole.ADMIN, UserRole.MANAGER]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
-    camp = await db.marketing_campaigns.find_one({"id": campaign_id})
+    camp = await db.marketing_campaigns.find_one(by_id(campaign_id))
     if not camp:
         raise HTTPException(status_code=404, detail="Campaign not found")
     payouts = camp.get("payouts", [])
@@ -2700,7 +5763,7 @@ async def generate_recurring_payouts(campaign_id: str, body: GenerateRecurringRe
             year = cursor.year + (1 if month > 12 else 0)
             month = 1 if month > 12 else month
             cursor = cursor.replace(year=year, month=month)
-    await db.marketing_campaigns.update_one({"id": campaign_id}, {"$set": {"payouts": payouts, "updated_at": datetime.utcnow()}})
+    await db.marketing_campaigns.update_one(by_id(campaign_id), {"$set": {"payouts": payouts, "updated_at": datetime.utcnow()}})
     return {"added": len(payouts)}
 
 
@@ -2875,13 +5938,6 @@ async def check_users():
         user_list.append(user_info)
     return {"users": user_list}
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
-
 @app.on_event("startup")
 async def startup_db_client():
     # Check if admin user exists
@@ -2897,10 +5953,28 @@ async def startup_db_client():
             logger.info("Updated admin user with default names")
     else:
         logger.info("No admin user found - please create one manually")
+    
+    await primary_keys.load()
+    if INDEX_RECONCILE_ON_STARTUP:
+        indexes.start()
+    app.state.cache_sync_task = asyncio.create_task(cache_sync_loop())
+    app.state.metrology_backfill_task = asyncio.create_task(backfill_metrology_ids())
+    app.state.stats_reconcile_task = asyncio.create_task(stats_reconcile_loop())
+    app.state.activity_backfill_task = asyncio.create_task(backfill_activity())
+    app.state.attachment_blob_task = asyncio.create_task(migrate_attachment_blobs())
+    app.state.upload_cleanup_task = asyncio.create_task(upload_cleanup_loop())
+    preview_worker.start()
+    app.state.preview_backfill_task = asyncio.create_task(queue_missing_previews())
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    app.state.cache_sync_task.cancel()
+    app.state.stats_reconcile_task.cancel()
+    app.state.upload_cleanup_task.cancel()
+    preview_worker.stop()
+    password_hasher._executor.shutdown(wait=False)
     client.close()
+    log_listener.stop()
 
 @api_router.get("/games")
 async def get_games_from_sheets(current_user: User = Depends(get_current_user)):
@@ -0,0 +1,107 @@
+import contextvars
+import itertools
+import os
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+os.environ.setdefault("INDEX_RECONCILE_ON_STARTUP", "false")
+os.environ.setdefault("BLOB_STORE", "local")
+os.environ.setdefault("BLOB_STORE_PATH", tempfile.mkdtemp(prefix="cashpot-blobs-"))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mongomock.collection
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient
+
+import server
+
+# pymongo's CommandListener never sees mongomock traffic, so collection calls
+# are reported to the request's QueryLog here, one event per round trip.
+COMMANDS = {
+    "find": "find",
+    "find_one": "find",
+    "find_one_and_update": "findAndModify",
+    "find_one_and_replace": "findAndModify",
+    "find_one_and_delete": "findAndModify",
+    "insert_one": "insert",
+    "insert_many": "insert",
+    "update_one": "update",
+    "update_many": "update",
+    "replace_one": "update",
+    "delete_one": "delete",
+    "delete_many": "delete",
+    "aggregate": "aggregate",
+    "count_documents": "count",
+    "distinct": "distinct",
+    "bulk_write": "bulkWrite",
+}
+request_ids = itertools.count()
+in_command = contextvars.ContextVar("in_command", default=False)
+
+def counted(method_name, command_name):
+    method = getattr(mongomock.collection.Collection, method_name)
+
+    def wrapper(self, *args, **kwargs):
+        queries = server.current_queries.get()
+        # mongomock implements some methods on top of others (find_one on find)
+        if queries is not None and not in_command.get():
+            command = {command_name: self.name}
+            selector = args[0] if args else kwargs.get("filter")
+            if command_name == "aggregate":
+                command["pipeline"] = selector
+            elif command_name in ("update", "delete"):
+                command["updates" if command_name == "update" else "deletes"] = [{"q": selector}]
+            elif command_name in ("count", "distinct"):
+                command["query"] = selector if command_name == "count" else kwargs.get("filter")
+            elif command_name != "insert":
+                command["filter"] = selector
+            event = SimpleNamespace(command_name=command_name, command=command, request_id=next(request_ids),
+                                    database_name=self.database.name, duration_micros=0)
+            queries.started(event)
+            queries.finished(event)
+        token = in_command.set(True)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            in_command.reset(token)
+    return wrapper
+
+for method_name, command_name in COMMANDS.items():
+    setattr(mongomock.collection.Collection, method_name, counted(method_name, command_name))
+
+PASSWORD_HASH = server.bcrypt.hashpw(b"password", server.bcrypt.gensalt(4)).decode()
+
+@pytest.fixture(scope="session")
+def app_client():
+    server.client = AsyncMongoMockClient(uuidRepresentation="standard")
+    server.db = server.client["test"]
+    with TestClient(server.app) as client:
+        yield client
+
+@pytest.fixture
+def client(app_client, monkeypatch):
+    """A client on an empty database with cold caches, seeded with an admin and an operator"""
+    monkeypatch.setattr(server, "db", server.client[f"test-{next(request_ids)}"])
+    monkeypatch.setattr(server, "primary_keys", server.PrimaryKeyMigration())
+    monkeypatch.setattr(server, "access_scopes", server.AccessScopeService())
+    monkeypatch.setattr(server, "principal_cache", server.PrincipalCache(server.PRINCIPAL_CACHE_SIZE, server.PRINCIPAL_CACHE_TTL_SECONDS))
+    monkeypatch.setattr(server, "display_names", server.DisplayNameResolver(server.DISPLAY_NAME_CACHE_SIZE, server.DISPLAY_NAME_TTL_SECONDS))
+    users = [("admin-1", "admin", "admin", []), ("op-1", "op", "operator", ["loc-1"])]
+    for user_id, username, role, locations in users:
+        app_client.portal.call(server.db.users.insert_one, {
+            "id": user_id, "username": username, "email": f"{username}@example.com", "password_hash": PASSWORD_HASH,
+            "role": role, "first_name": username.title(), "last_name": "User", "is_active": True,
+            "permissions": server.UserPermissions().model_dump(), "assigned_locations": locations,
+            "created_at": datetime.utcnow()
+        })
+    return app_client
+
+def login(client, username="admin"):
+    response = client.post("/api/auth/login", json={"username": username, "password": "password"})
+    assert response.status_code == 200, response.text
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
@@ -0,0 +1,39 @@
+import server
+from .conftest import login
+
+
+def feed(client, username):
+    response = client.get("/api/activity", headers=login(client, username))
+    assert response.status_code == 200, response.text
+    return [(entry["type"], entry["action"], entry["name"]) for entry in response.json()]
+
+
+def test_user_changes_are_in_the_admin_feed_only(client):
+    headers = login(client)
+    response = client.post("/api/users", headers=headers, json={
+        "username": "new", "email": "new@example.com", "password": "password", "role": "operator"
+    })
+    assert response.status_code == 200, response.text
+    user_id = response.json()["id"]
+    assert client.put(f"/api/users/{user_id}", headers=headers, json={"first_name": "New"}).status_code == 200
+    assert client.delete(f"/api/users/{user_id}", headers=headers).status_code == 200
+
+    assert feed(client, "admin") == [("user", action, "new") for action in ("deleted", "updated", "created")]
+    assert feed(client, "op") == []
+
+
+def test_attachments_follow_the_scope_of_their_entity(client):
+    headers = login(client)
+    for location_id in ("loc-1", "loc-2"):
+        client.portal.call(server.db.locations.insert_one, {"id": location_id, "company_id": "co-1", "name": location_id})
+        client.portal.call(server.db.cabinets.insert_one, {"id": f"cab-{location_id}", "name": "Cab", "location_id": location_id})
+        response = client.post("/api/attachments/upload", headers=headers,
+                               data={"entity_type": "cabinets", "entity_id": f"cab-{location_id}"},
+                               files={"file": (f"{location_id}.txt", b"0123456789", "text/plain")})
+        assert response.status_code == 200, response.text
+    assert client.delete(f"/api/attachments/{response.json()['id']}", headers=headers).status_code == 200
+
+    assert feed(client, "admin") == [
+        ("attachment", "deleted", "loc-2.txt"), ("attachment", "created", "loc-2.txt"), ("attachment", "created", "loc-1.txt")
+    ]
+    assert feed(client, "op") == [("attachment", "created", "loc-1.txt")]
@@ -0,0 +1,105 @@
+import mongomock.collection
+import pytest
+
+import server
+from .conftest import login
+
+
+@pytest.fixture
+def attachments(client):
+    """One text attachment on the operator's location and one on another location"""
+    headers = login(client)
+    ids = {}
+    for location_id in ("loc-1", "loc-2"):
+        client.portal.call(server.db.locations.insert_one, {"id": location_id, "company_id": "co-1", "name": location_id})
+        response = client.post("/api/attachments/upload", headers=headers,
+                               data={"entity_type": "locations", "entity_id": location_id},
+                               files={"file": (f"{location_id}.txt", b"0123456789", "text/plain")})
+        assert response.status_code == 200, response.text
+        ids[location_id] = response.json()["id"]
+    return ids
+
+
+@pytest.mark.parametrize("path", ["/api/attachments/{}/content", "/api/attachments/{}/preview", "/api/attachments/{}"])
+def test_attachment_content_follows_entity_access(client, attachments, path):
+    headers = login(client, "op")
+    assert client.get(path.format(attachments["loc-2"]), headers=headers).status_code == 403
+    # Text files have no preview, but the operator may ask for one
+    assert client.get(path.format(attachments["loc-1"]), headers=headers).status_code in (200, 404)
+
+
+def test_upload_declaring_more_than_the_limit_is_refused_unread(client, monkeypatch):
+    monkeypatch.setattr(server, "MAX_UPLOAD_MB", 1)
+    response = client.post("/api/attachments/upload", headers=login(client),
+                           data={"entity_type": "locations", "entity_id": "loc-1"},
+                           files={"file": ("big.txt", b"x" * (1024 * 1024 + 128 * 1024), "text/plain")})
+    assert response.status_code == 413
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=2-4", (2, 5)),
+    ("bytes=-3", (7, 10)),
+    ("bytes=8-", (8, 10)),
+    ("bytes=5-3", None),
+    ("bytes=abc", None),
+])
+def test_byte_range(header, expected):
+    assert server.byte_range(header, 10) == expected
+
+
+def test_unsatisfiable_range(client, attachments):
+    response = client.get(f"/api/attachments/{attachments['loc-1']}/content", headers={**login(client), "Range": "bytes=20-30"})
+    assert response.status_code == 416
+    response = client.get(f"/api/attachments/{attachments['loc-1']}/content", headers={**login(client), "Range": "bytes=5-3"})
+    assert response.status_code == 200 and response.content == b"0123456789"
+
+
+def test_content_migration_skips_a_missing_blob(client):
+    async def seed():
+        async def content():
+            yield b"hello"
+        blob_id = await server.blobs.put(content())
+        await server.db.attachments.insert_one({"id": "gone", "blob_id": "missing", "file_size": 5, "mime_type": "text/plain"})
+        await server.db.attachments.insert_one({"id": "kept", "blob_id": blob_id, "file_size": 5, "mime_type": "text/plain"})
+    client.portal.call(seed)
+
+    client.portal.call(server.migrate_attachment_blobs)
+
+    kept = client.portal.call(server.db.attachments.find_one, {"id": "kept"})
+    gone = client.portal.call(server.db.attachments.find_one, {"id": "gone"})
+    assert kept["sha256"] == server.hashlib.sha256(b"hello").hexdigest()
+    assert "sha256" not in gone
+    assert client.portal.call(server.db.migrations.find_one, {"_id": server.ATTACHMENT_CONTENT_MIGRATION_ID}) is None
+
+
+def test_content_migration_reads_attachments_through_one_cursor(client, monkeypatch):
+    documents = [{"id": f"inline-{n}", "file_data": server.base64.b64encode(b"x" * n).decode(), "file_size": n,
+                  "mime_type": "text/plain"} for n in range(1, 6)]
+    documents.append({"id": "broken", "file_data": "not base64!", "file_size": 1, "mime_type": "text/plain"})
+    client.portal.call(server.db.attachments.insert_many, documents)
+    selections = []
+    find, find_one = mongomock.collection.Collection.find, mongomock.collection.Collection.find_one
+
+    def recording(method):
+        def record(self, *args, **kwargs):
+            if self.name == "attachments":
+                selections.append(args[0] if args else kwargs.get("filter"))
+            return method(self, *args, **kwargs)
+        return record
+    monkeypatch.setattr(mongomock.collection.Collection, "find", recording(find))
+    monkeypatch.setattr(mongomock.collection.Collection, "find_one", recording(find_one))
+
+    client.portal.call(server.migrate_attachment_blobs)
+
+    assert selections == [{"sha256": {"$exists": False}}]
+    assert client.portal.call(server.db.attachments.count_documents, {"sha256": {"$exists": True}}) == 5
+
+
+def test_base64_upload_response_carries_metadata_only(client):
+    client.portal.call(server.db.locations.insert_one, {"id": "loc-1", "company_id": "co-1", "name": "Hall"})
+    response = client.post("/api/attachments", headers=login(client), json={
+        "filename": "a.txt", "original_filename": "a.txt", "file_size": 5, "mime_type": "text/plain",
+        "file_data": server.base64.b64encode(b"hello").decode(), "entity_type": "locations", "entity_id": "loc-1"
+    })
+    assert response.status_code == 200, response.text
+    assert response.json().get("file_data") is None
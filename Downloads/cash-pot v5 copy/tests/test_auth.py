@@ -0,0 +1,38 @@
+import server
+from .conftest import login
+
+
+def test_access_token_claims_authorize_without_reading_users(client):
+    headers = login(client, "op")
+    client.portal.call(server.db.users.delete_one, {"id": "op-1"})
+
+    response = client.get("/api/auth/me", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["username"] == "op"
+    assert response.json()["role"] == "operator"
+    assert response.json()["permissions"] == server.UserPermissions().model_dump()
+
+    # Once the user changes the claims are stale, and the user is gone
+    client.portal.call(server.bump_user_version, "op-1")
+    assert client.get("/api/auth/me", headers=headers).status_code == 401
+
+
+def test_permission_digest_round_trips():
+    permissions = server.UserPermissions().model_dump()
+    permissions["modules"]["invoices"] = True
+    permissions["actions"]["invoices"]["update"] = True
+    permissions["actions"]["users"]["delete"] = True
+    decoded = server.permissions_from_digest(server.permission_digest(permissions), {"locations": ["loc-1"]})
+    assert decoded.modules == permissions["modules"]
+    assert decoded.actions == permissions["actions"]
+    assert decoded.accessible_locations == ["loc-1"]
+
+
+def test_refresh_token_is_revoked_by_a_newer_version(client):
+    tokens = client.post("/api/auth/login", json={"username": "op", "password": "password"}).json()
+    response = client.post("/api/auth/refresh", json={"refresh_token": tokens["refresh_token"]})
+    assert response.status_code == 200
+
+    client.portal.call(server.bump_user_version, "op-1")
+    response = client.post("/api/auth/refresh", json={"refresh_token": tokens["refresh_token"]})
+    assert response.status_code == 401
@@ -0,0 +1,53 @@
+import asyncio
+import threading
+
+import pytest
+from fastapi.responses import StreamingResponse
+
+import server
+
+SLOW_STREAM_ROUTE = ("GET", "/test/slow-stream")
+
+
+async def slow_stream():
+    async def chunks():
+        for _ in range(3):
+            await asyncio.sleep(0.05)
+            yield b"chunk\n"
+    return StreamingResponse(chunks())
+
+server.app.add_api_route("/test/slow-stream", slow_stream)
+
+
+def test_latency_covers_the_whole_streamed_body(client):
+    assert client.get("/test/slow-stream").text == "chunk\n" * 3
+
+    series = server.http_request_duration._series[SLOW_STREAM_ROUTE]
+    assert series[-1] >= 0.15
+    assert server.http_in_flight._values[()] == 0
+
+
+@pytest.mark.parametrize("metric, observe", [
+    (server.Counter("test_total", "Test counter", ("n",)), lambda metric, n: metric.inc((str(n),))),
+    (server.Histogram("test_seconds", "Test histogram", ("n",)), lambda metric, n: metric.observe((str(n),), 0.01)),
+])
+def test_scrape_while_new_labels_are_observed(metric, observe):
+    # A scrape waits for an observation in progress instead of iterating under it
+    with metric._lock:
+        scrape = threading.Thread(target=metric.render)
+        scrape.start()
+        scrape.join(0.05)
+        assert scrape.is_alive()
+    scrape.join()
+
+    def observer(start):
+        for n in range(start, start + 2000):
+            observe(metric, n)
+    observers = [threading.Thread(target=observer, args=(start,)) for start in (0, 2000)]
+    for thread in observers:
+        thread.start()
+    while any(thread.is_alive() for thread in observers):
+        metric.render()
+    for thread in observers:
+        thread.join()
+    assert sum(line.startswith(("test_total{", "test_seconds_count{")) for line in metric.render()) == 4000
@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta
+
+import server
+from .conftest import login
+
+
+def test_unlimited_list_keeps_the_paged_order(client):
+    start = datetime(2024, 1, 1)
+    for day in (2, 0, 3, 1):
+        client.portal.call(server.db.marketing_campaigns.insert_one, {
+            "id": f"mc-{day}", "type": "promotion", "name": f"Day {day}",
+            "start_at": start, "end_at": start, "created_at": start + timedelta(days=day)
+        })
+    headers = login(client)
+
+    everything = client.get("/api/marketing/campaigns", headers=headers).json()
+    assert [campaign["id"] for campaign in everything] == ["mc-3", "mc-2", "mc-1", "mc-0"]
+
+    first = client.get("/api/marketing/campaigns", headers=headers, params={"limit": 2})
+    rest = client.get("/api/marketing/campaigns", headers=headers, params={"limit": 2, "after": first.headers["X-Next-Cursor"]})
+    assert [campaign["id"] for campaign in first.json() + rest.json()] == [campaign["id"] for campaign in everything]
+
+
+def test_metrology_pages_stay_whole_while_ids_are_backfilled(client, monkeypatch):
+    monkeypatch.setattr(server, "metrology_ids_complete", False)
+    created_at = datetime(2024, 1, 1)
+    client.portal.call(server.db.metrology.insert_many, [{"certificate_number": str(n), "created_at": created_at} for n in range(3)])
+    client.portal.call(server.db.metrology.insert_one, {"id": "m-new", "certificate_number": "new", "created_at": created_at})
+    headers = login(client)
+
+    seen, params = [], {"limit": 1}
+    while True:
+        response = client.get("/api/metrology", headers=headers, params=params)
+        seen += [item["id"] for item in response.json()]
+        if len(seen) == 2:
+            client.portal.call(server.backfill_metrology_ids)
+        if "X-Next-Cursor" not in response.headers:
+            break
+        params["after"] = response.headers["X-Next-Cursor"]
+
+    assert len(seen) == 4
+    assert sorted(seen) == sorted(item["id"] for item in client.get("/api/metrology", headers=headers).json())
+    assert server.metrology_ids_complete
+
+
+def test_document_being_rekeyed_is_listed_once(client):
+    start = datetime(2024, 1, 1)
+    for day in range(3):
+        client.portal.call(server.db.marketing_campaigns.insert_one, {
+            "id": f"mc-{day}", "type": "promotion", "name": f"Day {day}",
+            "start_at": start, "end_at": start, "created_at": start + timedelta(days=day)
+        })
+    # The migration's moment between inserting the re-keyed copy and deleting the old one
+    moving = client.portal.call(server.db.marketing_campaigns.find_one, {"id": "mc-1"}, {"_id": 0})
+    client.portal.call(server.db.marketing_campaigns.insert_one, server.keyed(moving))
+    headers = login(client)
+
+    everything = client.get("/api/marketing/campaigns", headers=headers).json()
+    assert [campaign["id"] for campaign in everything] == ["mc-2", "mc-1", "mc-0"]
+    first = client.get("/api/marketing/campaigns", headers=headers, params={"limit": 2})
+    rest = client.get("/api/marketing/campaigns", headers=headers, params={"limit": 2, "after": first.headers["X-Next-Cursor"]})
+    assert [campaign["id"] for campaign in first.json() + rest.json()] == ["mc-2", "mc-1", "mc-0"]
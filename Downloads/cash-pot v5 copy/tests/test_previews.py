@@ -0,0 +1,56 @@
+from datetime import datetime
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import server
+
+
+@pytest.fixture
+def png(client):
+    """A stored 40x30 PNG without previews; returns its digest"""
+    buffer = BytesIO()
+    Image.new("RGB", (40, 30), "red").save(buffer, "PNG")
+
+    async def store():
+        async def single():
+            yield buffer.getvalue()
+        blob_id = await server.blobs.put(single())
+        await server.db.blob_contents.insert_one({"_id": "sha-png", "blob_id": blob_id, "size": len(buffer.getvalue())})
+    client.portal.call(store)
+    return "sha-png"
+
+
+def render(client, sha256):
+    async def run():
+        server.preview_worker.submit(sha256, "image/png")
+        await server.preview_worker.queue.join()
+        return await server.db.blob_contents.find_one({"_id": sha256})
+    return client.portal.call(run)
+
+
+def test_preview_is_rendered_and_claim_released(client, png):
+    content = render(client, png)
+    assert set(content["previews"]) == set(server.PREVIEW_SIZES)
+    assert "preview_claimed_at" not in content and "preview_claimed_by" not in content
+
+
+def test_image_over_the_pixel_limit_gets_no_previews(client, png, monkeypatch):
+    monkeypatch.setattr(server, "PREVIEW_MAX_PIXELS", 40 * 30 - 1)
+    assert render(client, png)["previews"] == {}
+
+
+def test_transient_failure_leaves_content_for_a_later_attempt(client, png, monkeypatch):
+    def unavailable(*args):
+        raise OSError("blob store unavailable")
+    monkeypatch.setattr(server.blobs, "read", unavailable)
+    content = render(client, png)
+    assert "previews" not in content and "preview_claimed_at" not in content
+
+
+def test_content_claimed_by_another_process_is_left_to_it(client, png):
+    client.portal.call(server.db.blob_contents.update_one, {"_id": png},
+                       {"$set": {"preview_claimed_by": "other", "preview_claimed_at": datetime.utcnow()}})
+    assert "previews" not in render(client, png)
+    assert not client.portal.call(server.claim_preview, png)
@@ -0,0 +1,38 @@
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+import server
+from .conftest import login
+
+
+def test_migration_runs_under_the_declared_indexes(client):
+    for name in ("Alpha", "Beta"):
+        client.portal.call(server.db.companies.insert_one, {"id": f"co-{name}", "name": name})
+    client.portal.call(server.db.providers.insert_one, {"id": "p1", "name": "Prov"})
+    client.portal.call(server.indexes.reconcile)
+    assert "username_1" not in client.portal.call(server.db.users.index_information)
+
+    async def migrate():
+        await server.primary_keys.run()
+        await server.indexes.task
+    client.portal.call(migrate)
+
+    status = server.primary_keys.status()
+    assert status["complete"] and status["error"] is None
+    assert not any(status["conflicts"].values())
+    assert status["moved"]["users"] == 2 and status["moved"]["companies"] == 2
+    assert server.indexes.failed == {}
+    for name, field in (("users", "username"), ("companies", "name"), ("providers", "name")):
+        existing = client.portal.call(server.db[name].index_information)
+        assert f"{field}_1" in existing
+        assert "id_1" not in existing
+    with pytest.raises(DuplicateKeyError):
+        client.portal.call(server.db.companies.insert_one, {"id": "co-other", "name": "Alpha"})
+
+
+def test_created_user_is_returned_without_its_primary_key(client):
+    response = client.post("/api/users", headers=login(client), json={
+        "username": "new", "email": "new@example.com", "password": "password", "role": "operator"
+    })
+    assert response.status_code == 200, response.text
+    assert "_id" not in response.json() and "password_hash" not in response.json()
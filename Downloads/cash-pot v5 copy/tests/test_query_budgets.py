@@ -0,0 +1,53 @@
+import pytest
+from fastapi import Depends
+
+import server
+from .conftest import login
+
+ATTACHMENTS_ROUTE = ("GET", "/api/attachments/{entity_type}/{entity_id}")
+
+
+async def two_queries():
+    await server.db.companies.find_one({"id": "a"})
+    await server.db.companies.find_one({"id": "b"})
+    return {}
+
+server.app.add_api_route("/test/over-budget", two_queries, dependencies=[Depends(server.query_budget(1))])
+
+@pytest.fixture
+def strict(monkeypatch):
+    monkeypatch.setattr(server, "QUERY_BUDGET_STRICT", True)
+    monkeypatch.setattr(server, "QUERY_COUNT_HEADER", True)
+
+
+def test_strict_mode_rejects_a_route_over_its_budget(client, strict):
+    response = client.get("/test/over-budget")
+    assert response.status_code == 500
+    assert response.json()["detail"] == "Query budget exceeded: 2 queries, budget 1"
+
+
+def test_company_list_stays_within_its_budget(client, strict):
+    for i in range(20):
+        client.portal.call(server.db.companies.insert_one, {"id": f"co-{i}", "name": f"Company {i}"})
+    response = client.get("/api/companies", headers=login(client), params={"limit": 10, "include_total": True})
+    assert response.status_code == 200
+    assert int(response.headers["X-Query-Count"]) <= 6
+
+
+def test_queries_of_a_streamed_body_are_counted(client, strict, monkeypatch):
+    monkeypatch.setattr(server, "STREAM_BATCH_SIZE", 1)
+    for i, uploader in enumerate(("admin-1", "op-1", "someone-else")):
+        client.portal.call(server.db.attachments.insert_one, {
+            "id": f"att-{i}", "entity_type": "marketing", "entity_id": "mc-1", "uploaded_by": uploader,
+            "original_filename": f"{i}.txt", "mime_type": "text/plain", "file_size": 1
+        })
+    counted_before = server.mongo_queries_per_request._series.get(ATTACHMENTS_ROUTE, [0])[-1]
+
+    response = client.get("/api/attachments/marketing/mc-1", headers={**login(client), "Accept": server.NDJSON_MEDIA_TYPE})
+    assert response.status_code == 200 and response.text.count("\n") == 3
+
+    # The attachment find, then one name lookup per streamed batch
+    counted = server.mongo_queries_per_request._series[ATTACHMENTS_ROUTE][-1] - counted_before
+    assert counted == 4
+    # The header only covers what ran before it was sent
+    assert int(response.headers["X-Query-Count"]) < counted
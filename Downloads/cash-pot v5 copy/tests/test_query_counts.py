@@ -0,0 +1,40 @@
+import pytest
+
+import server
+from .conftest import login
+
+
+@pytest.fixture
+def counted_client(client, monkeypatch):
+    monkeypatch.setattr(server, "QUERY_COUNT_HEADER", True)
+    client.portal.call(server.db.locations.insert_one, {"id": "loc-1", "company_id": "co-1", "name": "Hall"})
+    for provider_id in ("p0", "p1"):
+        client.portal.call(server.db.providers.insert_one, {"id": provider_id, "name": provider_id})
+    for game_mix_id in ("g0", "g1", "g2"):
+        client.portal.call(server.db.game_mixes.insert_one, {"id": game_mix_id, "name": game_mix_id})
+    return client
+
+def grow_fleet(client, size):
+    """Put `size` cabinets, each with one slot, in the operator's location"""
+    existing = client.portal.call(server.db.cabinets.count_documents, {})
+    for i in range(existing, size):
+        client.portal.call(server.db.cabinets.insert_one, {"id": f"cab-{i}", "location_id": "loc-1", "provider_id": f"p{i % 2}"})
+        client.portal.call(server.db.slot_machines.insert_one, {
+            "id": f"s-{i}", "cabinet_id": f"cab-{i}", "location_id": "loc-1", "game_mix_id": f"g{i % 3}", "serial_number": f"SN{i}"
+        })
+    # Measure the cold path, where the scope sets are derived from the fleet
+    server.access_scopes.clear()
+
+def query_counts(client, headers):
+    return {path: int(client.get(path, headers=headers).headers["X-Query-Count"])
+            for path in ("/api/providers", "/api/game-mixes")}
+
+
+def test_operator_lists_cost_the_same_for_any_fleet_size(counted_client):
+    headers = login(counted_client, "op")
+    grow_fleet(counted_client, 10)
+    small = query_counts(counted_client, headers)
+    grow_fleet(counted_client, 100)
+    large = query_counts(counted_client, headers)
+    assert small == large
+    assert all(count <= 2 for count in large.values())
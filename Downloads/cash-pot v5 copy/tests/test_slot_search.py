@@ -0,0 +1,51 @@
+import mongomock.collection
+
+import server
+from .conftest import login
+
+
+def test_facets_leave_out_their_own_selection(client):
+    machines = [("p1", "active"), ("p1", "inactive"), ("p2", "active"), ("p3", "active")]
+    client.portal.call(server.db.slot_machines.insert_many, [
+        {"id": f"s{n}", "serial_number": f"S{n}", "provider_id": provider_id, "status": status, "location_id": "loc-1"}
+        for n, (provider_id, status) in enumerate(machines)
+    ])
+    response = client.get("/api/slot-machines/search", headers=login(client),
+                          params={"provider_id": ["p1", "p2"], "status": "active"})
+    assert response.status_code == 200, response.text
+    body = response.json()
+
+    assert sorted(item["id"] for item in body["items"]) == ["s0", "s2"] and body["total"] == 2
+    counts = {name: {bucket["value"]: bucket["count"] for bucket in buckets} for name, buckets in body["facets"].items()}
+    # Providers are counted among active machines, statuses among p1 and p2
+    assert counts["provider_id"] == {"p1": 1, "p2": 1, "p3": 1}
+    assert counts["status"] == {"active": 2, "inactive": 1}
+    assert counts["location_id"] == {"loc-1": 2}
+
+
+def test_page_is_selected_and_sorted_ahead_of_facet(client, monkeypatch):
+    pipelines = []
+    aggregate = mongomock.collection.Collection.aggregate
+
+    def recording(self, pipeline, *args, **kwargs):
+        pipelines.append(pipeline)
+        return aggregate(self, pipeline, *args, **kwargs)
+    monkeypatch.setattr(mongomock.collection.Collection, "aggregate", recording)
+
+    response = client.get("/api/slot-machines/search", headers=login(client),
+                          params={"provider_id": "p1", "status": "active", "sort": "-created_at"})
+    assert response.status_code == 200, response.text
+
+    # The page, then one count for each of the two facets with a selection
+    assert len(pipelines) == 3
+    page = next(pipeline for pipeline in pipelines if "$facet" in pipeline[-1])
+    assert page[0] == {"$match": {"$and": [{"provider_id": "p1"}, {"status": "active"}]}}
+    assert page[1] == {"$sort": {"created_at": -1, "id": -1}}
+    facet = page[2]["$facet"]
+    assert [list(stage) for stage in facet["items"]] == [["$skip"], ["$limit"], ["$project"]]
+    assert facet["total"] == [{"$count": "count"}]
+    assert "provider_id" not in facet and "status" not in facet
+
+    # Planned as an index scan: equality fields first, then the sort key
+    keys = [list(index.document["key"]) for index in server.INDEXES["slot_machines"]]
+    assert ["provider_id", "status", "created_at"] in keys
@@ -0,0 +1,138 @@
+from datetime import datetime
+
+import pytest
+
+import server
+from .conftest import login
+
+DAY = "2024-01-01T00:00:00"
+
+
+@pytest.fixture
+def places(client):
+    """Two companies with a location each, a provider and a game mix"""
+    for n in (1, 2):
+        client.portal.call(server.db.companies.insert_one, {"id": f"co-{n}", "name": f"Company {n}", "status": "active"})
+        client.portal.call(server.db.locations.insert_one, {"id": f"loc-{n}", "company_id": f"co-{n}", "name": f"Location {n}", "status": "active"})
+    client.portal.call(server.db.providers.insert_one, {"id": "p1", "name": "Provider"})
+    client.portal.call(server.db.game_mixes.insert_one, {"id": "gm-1", "name": "Mix", "provider_id": "p1"})
+    client.portal.call(server.db.cabinets.insert_one, {"id": "cab-0", "name": "Cabinet", "provider_id": "p1", "location_id": "loc-1"})
+    client.portal.call(server.reconcile_stats)
+    return client
+
+
+def slot(location_id, status):
+    return {"cabinet_id": "cab-0", "game_mix_id": "gm-1", "provider_id": "p1", "model": "M", "serial_number": "S1",
+            "denomination": 0.1, "max_bet": 10, "rtp": 95, "gaming_places": 1, "location_id": location_id, "status": status}
+
+def invoice(location_id, status):
+    return {"invoice_number": "INV-1", "company_id": location_id.replace("loc", "co"), "location_id": location_id,
+            "serial_numbers": "", "issue_date": DAY, "due_date": DAY, "amount": 1, "status": status, "description": ""}
+
+def onjn_report(location_id, status):
+    return {"report_number": "R-1", "report_type": "monthly", "company_id": location_id.replace("loc", "co"),
+            "location_id": location_id, "report_date": DAY, "equipment_data": {}}
+
+def legal_document(location_id, status):
+    return {"title": "Licence", "document_type": "licence", "company_id": location_id.replace("loc", "co"),
+            "location_id": location_id, "issue_date": DAY, "issuing_authority": "ONJN", "description": ""}
+
+def metrology(location_id, status):
+    return {"serial_number": "S1", "certificate_number": "C-1", "issue_date": "2024-01-01",
+            "issuing_authority": "BRML", "status": status, "description": ""}
+
+def jackpot(location_id, status):
+    return {"serial_number": "S1", "jackpot_type": "mystery", "jackpot_name": "Big", "increment_rate": 1, "description": status}
+
+def comision_date(location_id, status):
+    return {"event_name": status, "commission_date": DAY, "serial_numbers": ""}
+
+# Collection, route, document before and after its update
+COUNTED = [
+    ("cabinets", "/api/cabinets", lambda location_id, status: {"name": status, "provider_id": "p1"}),
+    ("slot_machines", "/api/slot-machines", slot),
+    ("invoices", "/api/invoices", invoice),
+    ("onjn_reports", "/api/onjn-reports", onjn_report),
+    ("legal_documents", "/api/legal-documents", legal_document),
+    ("metrology", "/api/metrology", metrology),
+    ("jackpots", "/api/jackpots", jackpot),
+    ("comision_dates", "/api/comision-dates", comision_date),
+]
+
+
+def assert_counted(client):
+    """The stored counters equal a fresh count of the source collections"""
+    assert client.portal.call(server.reconcile_stats) == 0
+
+
+@pytest.mark.parametrize("collection, route, document", COUNTED, ids=[counted[0] for counted in COUNTED])
+def test_writes_keep_counters_equal_to_a_fresh_count(places, collection, route, document):
+    headers = login(places)
+    response = places.post(route, headers=headers, json=document("loc-1", "active"))
+    assert response.status_code == 200, response.text
+    entity_id = response.json()["id"]
+    assert_counted(places)
+
+    response = places.put(f"{route}/{entity_id}", headers=headers, json=document("loc-2", "inactive"))
+    assert response.status_code == 200, response.text
+    assert_counted(places)
+
+    assert places.delete(f"{route}/{entity_id}", headers=headers).status_code == 200
+    assert places.portal.call(server.db[collection].count_documents, {"id": entity_id}) == 0
+    assert_counted(places)
+
+
+@pytest.fixture
+def fleet(places):
+    """Documents on both locations, counted from scratch"""
+    seed = {
+        "cabinets": [{"id": "cab-2", "location_id": "loc-2", "provider_id": "p2", "status": "active"}],
+        "slot_machines": [{"id": "s1", "location_id": "loc-1", "status": "active"},
+                          {"id": "s2", "location_id": "loc-1", "status": "inactive"},
+                          {"id": "s3", "location_id": "loc-2", "status": "active"}],
+        "invoices": [{"id": "i1", "company_id": "co-1", "location_id": "loc-1"},
+                     {"id": "i2", "company_id": "co-2", "location_id": "loc-2"}],
+        "onjn_reports": [{"id": "o1", "company_id": "co-1", "location_id": "loc-1"},
+                         {"id": "o2", "company_id": "co-2", "location_id": "loc-2"}],
+        "legal_documents": [{"id": "l1", "company_id": "co-2", "location_id": "loc-2"}],
+        "metrology": [{"id": "m1"}],
+    }
+    places.portal.call(server.db.providers.insert_one, {"id": "p2", "name": "Other provider"})
+    places.portal.call(server.db.cabinets.update_one, {"id": "cab-0"}, {"$set": {"status": "active"}})
+    for collection, docs in seed.items():
+        places.portal.call(server.db[collection].insert_many, [{**doc, "created_at": datetime(2024, 1, 1)} for doc in docs])
+    places.portal.call(server.reconcile_stats)
+    return places
+
+
+def dashboard(client, username):
+    response = client.get("/api/dashboard/stats", headers=login(client, username))
+    assert response.status_code == 200, response.text
+    stats = response.json()
+    return {field: stats[field] for field in (
+        "total_providers", "total_cabinets", "total_slot_machines", "active_equipment", "total_invoices",
+        "total_onjn_reports", "total_legal_documents", "total_metrology"
+    )}
+
+
+EVERYTHING = {"total_providers": 2, "total_cabinets": 2, "total_slot_machines": 3, "active_equipment": 4, "total_invoices": 2,
+              "total_onjn_reports": 2, "total_legal_documents": 1, "total_metrology": 1}
+
+
+def test_operator_sees_the_counters_of_their_locations_only(fleet):
+    assert dashboard(fleet, "admin") == EVERYTHING
+    assert dashboard(fleet, "op") == {
+        "total_providers": 1, "total_cabinets": 1, "total_slot_machines": 2, "active_equipment": 2, "total_invoices": 1,
+        "total_onjn_reports": 1, "total_legal_documents": 0, "total_metrology": 1
+    }
+
+
+def test_reconcile_corrects_corrupted_counters(fleet):
+    fleet.portal.call(server.db.stats.update_one, {"_id": server.stat_row_id("loc-1", None)}, {"$inc": {"slot_machines": 5}})
+    fleet.portal.call(server.db.stats.delete_one, {"_id": server.stat_row_id("loc-2", "co-2")})
+    fleet.portal.call(server.db.stats.insert_one, {"_id": "gone:", "location_id": "gone", "company_id": None, "cabinets": 3})
+    assert dashboard(fleet, "admin") != EVERYTHING
+
+    assert fleet.portal.call(server.reconcile_stats) == 3
+    assert dashboard(fleet, "admin") == EVERYTHING
+    assert_counted(fleet)
@@ -0,0 +1,16 @@
+import server
+from .conftest import login
+
+COMPANY = {"registration_number": "r", "tax_id": "t", "address": "a", "phone": "p", "email": "e", "contact_person": "c"}
+
+
+def test_renaming_onto_a_unique_name_is_rejected(client):
+    client.portal.call(server.db.companies.create_indexes, [server.unique("name")])
+    headers = login(client)
+    for name in ("Alpha", "Beta"):
+        assert client.post("/api/companies", headers=headers, json={**COMPANY, "name": name}).status_code == 200
+    beta = next(company for company in client.get("/api/companies", headers=headers).json() if company["name"] == "Beta")
+
+    response = client.put(f"/api/companies/{beta['id']}", headers=headers, json={**COMPANY, "name": "Alpha"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Company name already exists"
@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+from .conftest import login
+
+CHUNKS = [b"first chunk, ", b"second chunk, ", b"last chunk"]
+
+
+@pytest.fixture
+def location(client):
+    client.portal.call(server.db.locations.insert_one, {"id": "loc-1", "company_id": "co-1", "name": "Hall"})
+    return "loc-1"
+
+def upload(client, headers, chunks, filename="notes.txt"):
+    session = client.post("/api/uploads", headers=headers, json={
+        "filename": filename, "file_size": sum(map(len, chunks)), "entity_type": "locations", "entity_id": "loc-1"
+    }).json()
+    offset = 0
+    for chunk in chunks:
+        assert client.put(f"/api/uploads/{session['id']}", headers=headers, params={"offset": offset}, content=chunk).status_code == 200
+        offset += len(chunk)
+    response = client.post(f"/api/uploads/{session['id']}/commit", headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+def stored_blobs():
+    return sorted(path.name for path in server.blobs.root.rglob("*") if path.is_file())
+
+
+def test_commit_stores_the_received_chunks_without_copying(client, location):
+    headers = login(client)
+    before = stored_blobs()
+    attachment = upload(client, headers, CHUNKS)
+
+    assert attachment["blob_id"].startswith(server.COMPOSED_BLOB_PREFIX)
+    assert len(stored_blobs()) == len(before) + len(CHUNKS) + 1
+    content = client.get(f"/api/attachments/{attachment['id']}/content", headers=headers)
+    assert content.content == b"".join(CHUNKS)
+    ranged = client.get(f"/api/attachments/{attachment['id']}/content", headers={**headers, "Range": "bytes=8-20"})
+    assert ranged.status_code == 206 and ranged.content == b"".join(CHUNKS)[8:21]
+
+
+def test_identical_upload_reuses_the_content_and_drops_its_chunks(client, location):
+    headers = login(client)
+    before = stored_blobs()
+    first = upload(client, headers, CHUNKS)
+    after_first = stored_blobs()
+    second = upload(client, headers, [b"".join(CHUNKS[:2]), CHUNKS[2]])
+
+    assert second["blob_id"] == first["blob_id"]
+    assert stored_blobs() == after_first
+
+    for attachment in (first, second):
+        assert client.delete(f"/api/attachments/{attachment['id']}", headers=headers).status_code == 200
+    # The last reference takes the manifest and every chunk with it
+    assert stored_blobs() == before
+
+
+def test_hashers_of_expired_sessions_are_evicted():
+    server.upload_hashers["stale"] = (1, server.hashlib.sha256(), datetime.utcnow() - timedelta(seconds=1))
+    server.upload_hashers["live"] = (1, server.hashlib.sha256(), datetime.utcnow() + timedelta(hours=1))
+    server.evict_upload_hashers()
+    assert "stale" not in server.upload_hashers
+    assert server.upload_hashers.pop("live")
+
+
+def test_failed_registration_leaves_the_upload_to_retry(client, location, monkeypatch):
+    headers = login(client)
+    session = client.post("/api/uploads", headers=headers, json={
+        "filename": "notes.txt", "file_size": sum(map(len, CHUNKS)), "entity_type": "locations", "entity_id": "loc-1"
+    }).json()
+    offset = 0
+    for chunk in CHUNKS:
+        client.put(f"/api/uploads/{session['id']}", headers=headers, params={"offset": offset}, content=chunk)
+        offset += len(chunk)
+    received = stored_blobs()
+    register_content = server.register_content
+
+    async def unavailable(*args):
+        raise OSError("database unavailable")
+    monkeypatch.setattr(server, "register_content", unavailable)
+    with pytest.raises(OSError):
+        client.post(f"/api/uploads/{session['id']}/commit", headers=headers)
+    # The manifest is gone, the chunks and the session are kept
+    assert stored_blobs() == received
+    monkeypatch.setattr(server, "register_content", register_content)
+
+    response = client.post(f"/api/uploads/{session['id']}/commit", headers=headers)
+    assert response.status_code == 200, response.text
+    content = client.get(f"/api/attachments/{response.json()['id']}/content", headers=headers)
+    assert content.content == b"".join(CHUNKS)